@@ -18,6 +18,7 @@ from buddysuite import buddy_resources as br
 import re
 import sys
 from collections import OrderedDict
+from copy import copy
 import os
 import argparse
 
@@ -123,6 +124,7 @@ def main():
 
     cluster_file = prepare_clusters(in_args.clusters, hierarchy=True)
     seqbuddy = Sb.SeqBuddy(in_args.sequence_file)
+    seq_index = helpers.SeqIndex(seqbuddy)
     output = OrderedDict()
 
     for rank, node in cluster_file.items():
@@ -142,8 +144,8 @@ def main():
         if in_args.strip_taxa:
             node = [re.sub("^.*?\-", "", x) for x in node]
 
-        ids = "^%s$" % "$|^".join(node)
-        subset = Sb.pull_recs(Sb.make_copy(seqbuddy), ids)
+        subset = seq_index.subset(node)
+        subset.records = [copy(rec) for rec in subset.records]  # Descriptions are modified below
         subset = Sb.order_ids(subset)
 
         rank_output = ""
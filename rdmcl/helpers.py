@@ -1,19 +1,27 @@
 #!/usr/bin/env python3
 import sqlite3
 import json
+import fcntl
+import atexit
 import logging
 import shutil
 import os
+import threading
+import tempfile
 import pandas as pd
 import numpy as np
 from math import log, sqrt
 from time import time, sleep
 from copy import copy
 from hashlib import md5
-from multiprocessing import SimpleQueue, Process, Pipe
+from multiprocessing import SimpleQueue, Process, Pipe, BoundedSemaphore, Array
+from threading import current_thread, main_thread, local
+from contextlib import contextmanager
 from subprocess import PIPE, check_output, CalledProcessError
+from urllib.request import pathname2url
 
 from buddysuite import buddy_resources as br
+from buddysuite import SeqBuddy as Sb
 import signal
 
 # Set global precision levels
@@ -53,10 +61,18 @@ class ExclusiveConnect(object):
         self.log_path = log_path
         self.priority = 0.5 if not priority else 1000
         self.max_lock = max_lock
+        self.watchdog = None
+        self.expired = False
 
     def raise_timeout(self, *args):
         raise EnvironmentError("ExclusiveConnect Lock held for over %s seconds" % self.max_lock)
 
+    def _expire(self):
+        # Signal handlers can only be set from the main thread, so other threads get a watchdog that aborts whatever
+        # statement is running on the connection. __exit__() then rolls back and raises the timeout.
+        self.expired = True
+        self.connection.interrupt()
+
     def __enter__(self):
         # Note that there is a pseudo-priority counter
         while True:
@@ -78,11 +94,24 @@ class ExclusiveConnect(object):
 
         cursor = AttrWrapper(self.connection.cursor())
         cursor.lag = time() - self.start_time
-        signal.signal(signal.SIGALRM, self.raise_timeout)
-        signal.alarm(self.max_lock)
+        if current_thread() is main_thread():
+            signal.signal(signal.SIGALRM, self.raise_timeout)
+            signal.alarm(self.max_lock)
+        elif self.max_lock:
+            self.expired = False
+            self.watchdog = threading.Timer(self.max_lock, self._expire)
+            self.watchdog.daemon = True
+            self.watchdog.start()
         return cursor
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.watchdog:
+            self.watchdog.cancel()
+            self.watchdog = None
+        if self.expired:
+            self.connection.rollback()
+            self.connection.close()
+            self.raise_timeout()
         self.connection.commit()
         self.connection.close()
         if self.log_message:
@@ -92,7 +121,195 @@ class ExclusiveConnect(object):
             log_output = "%s\n" % "\t".join([str(x) for x in self.log_output])
             with open(self.log_path, "a") as ofile:
                 ofile.write(log_output)
-        signal.alarm(0)
+        if current_thread() is main_thread():
+            signal.alarm(0)
+
+
+class ImmediateConnect(object):
+    def __init__(self, db_path, timeout=60):
+        """
+        Short write transaction for hot paths (i.e., workers claiming jobs). 'BEGIN IMMEDIATE' only blocks other
+        writers, and waiting is left to SQLite's own busy handler instead of ExclusiveConnect's sleep/retry loop.
+        :param db_path: Database file
+        :param timeout: Seconds to wait for the write lock before sqlite3.OperationalError is raised
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        self.lock_wait = 0
+
+    def __enter__(self):
+        start_time = time()
+        self.connection = sqlite3.connect(self.db_path, isolation_level=None, timeout=self.timeout)
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            self.lock_wait = time() - start_time  # Waiting the whole timeout out still counts
+            self.connection.close()
+            raise
+        self.lock_wait = time() - start_time
+        cursor = AttrWrapper(self.connection.cursor())
+        cursor.lag = self.lock_wait
+        return cursor
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.connection.rollback()
+        else:
+            self.connection.commit()
+        self.connection.close()
+
+
+class SnapshotConnect(object):
+    def __init__(self, db_path, timeout=60):
+        """
+        Read-only transaction for looking at a database without getting in anyone's way (i.e., monitoring). The file is
+        opened with mode=ro, and 'BEGIN' is deferred, so it only holds a SHARED lock while reading (no lock at all if
+        the database is in WAL mode, see enable_wal()). Readers don't block each other, and everything read comes from
+        one snapshot.
+        :param db_path: Database file (sqlite3.OperationalError is raised if it doesn't exist)
+        :param timeout: Seconds to wait if a writer is in the middle of committing
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        self.lock_wait = 0
+
+    def __enter__(self):
+        start_time = time()
+        self.connection = sqlite3.connect("file:%s?mode=ro" % pathname2url(os.path.abspath(self.db_path)),
+                                          uri=True, isolation_level=None, timeout=self.timeout)
+        self.connection.execute("BEGIN")
+        # A deferred BEGIN doesn't touch the file, so start the snapshot with a read. That is where the SHARED lock is
+        # taken, and where any wait on a writer shows up in cursor.lag.
+        self.connection.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        cursor = AttrWrapper(self.connection.cursor())
+        cursor.lag = self.lock_wait = time() - start_time
+        return cursor
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.connection.rollback()  # Nothing to commit
+        self.connection.close()
+
+
+# Worker queue ordering. Each job is queued with a fixed priority (see job_priority()) and a timestamp, and workers
+# claim the highest 'priority + seconds spent in the queue / QUEUE_AGING' first. Every job ages at the same rate, so
+# this is the same order as queue_rank(), which doesn't depend on when the claim is made. That makes it a fixed
+# property of each row, so the queue keeps an index on it (QUEUE_RANK_SQL) and claims don't have to sort the table.
+QUEUE_AGING = 300  # Five minutes in the queue is worth as much as doubling a job's cost
+QUEUE_RANK_SQL = "priority - queued / %s" % QUEUE_AGING  # queue_rank() as an SQL expression (matches the index)
+DEPTH_WEIGHT = 0.5  # Bump per level of recursion, because deep clusters are what hold up the end of a branch
+MASTER_AGE_WEIGHT = 1 / 3600  # Runs that have been going for longer get one point per hour
+
+
+def job_cost(num_seqs):
+    """
+    :param num_seqs: Number of sequences in an all-by-all job
+    :return: Number of pairwise comparisons, which is what dominates the run time of a job
+    """
+    return num_seqs * (num_seqs - 1) / 2
+
+
+def job_priority(cost, depth=0, master_start=None):
+    """
+    Static part of a queued job's priority. Larger jobs go first (longest-processing-time-first), so the long tail
+    isn't left to start after everything else has finished.
+    :param cost: Estimated cost of the job (see job_cost())
+    :param depth: Recursion depth of the cluster that the job was queued for
+    :param master_start: Time that the run queuing the job started
+    :return: float
+    """
+    priority = log(1 + cost, 2) + depth * DEPTH_WEIGHT
+    if master_start:
+        priority += max(0., time() - master_start) * MASTER_AGE_WEIGHT
+    return round(priority, 6)
+
+
+def queue_rank(priority, queued):
+    """
+    :param priority: From job_priority()
+    :param queued: Time the job was queued
+    :return: Jobs with the highest rank are claimed first
+    """
+    return priority - queued / QUEUE_AGING
+
+
+# Tables in work_db.sqlite, followed by the changes that bring databases set up by older versions up to date
+WORK_DB_SCHEMA = ['CREATE TABLE queue (hash TEXT PRIMARY KEY, psi_pred_dir TEXT, '
+                  'align_m TEXT, align_p TEXT, trimal TEXT, gap_open FLOAT, gap_extend FLOAT, '
+                  'cost FLOAT DEFAULT 0, priority FLOAT DEFAULT 0, queued FLOAT DEFAULT 0)',
+                  'CREATE TABLE processing (hash TEXT PRIMARY KEY, worker_id INTEGER, claimed FLOAT DEFAULT 0)',
+                  'CREATE TABLE complete   (hash TEXT PRIMARY KEY, secs FLOAT DEFAULT 0)',
+                  'CREATE TABLE proc_comp   (hash TEXT PRIMARY KEY, master_id INTEGER)',
+                  'CREATE TABLE waiting (hash TEXT, master_id INTEGER)',
+                  'CREATE TABLE throughput (worker_id INTEGER PRIMARY KEY, rate FLOAT, updated FLOAT)',
+                  'ALTER TABLE queue ADD COLUMN cost FLOAT DEFAULT 0',
+                  'ALTER TABLE queue ADD COLUMN priority FLOAT DEFAULT 0',
+                  'ALTER TABLE queue ADD COLUMN queued FLOAT DEFAULT 0',
+                  'ALTER TABLE processing ADD COLUMN claimed FLOAT DEFAULT 0',
+                  'ALTER TABLE complete ADD COLUMN secs FLOAT DEFAULT 0',
+                  'CREATE INDEX queue_rank ON queue (%s DESC)' % QUEUE_RANK_SQL]
+
+
+def prepare_work_db(wdb_path):
+    """
+    Create anything missing from a work database. Every statement that has already been applied fails and is skipped,
+    so masters and workers can all run this on start up, and whichever starts first brings an old database up to date.
+    :param wdb_path: work_db.sqlite (created if it doesn't exist)
+    :return: None
+    """
+    with ExclusiveConnect(wdb_path) as cursor:
+        for sql in WORK_DB_SCHEMA:
+            try:
+                cursor.execute(sql)
+            except sqlite3.OperationalError:
+                pass
+    enable_wal(wdb_path)
+    return
+
+
+# File system types (from /proc/mounts) that can't be trusted with the shared memory index that WAL mode relies on
+NETWORK_FILE_SYSTEMS = ["nfs", "nfs4", "cifs", "smb3", "smbfs", "afs", "lustre", "gpfs", "beegfs", "ceph",
+                        "glusterfs", "fuse.glusterfs", "fuse.sshfs"]
+
+
+def network_file_system(path):
+    """
+    :param path: Any file or directory
+    :return: The type of network file system that path is on, or None if it's local (or there's no /proc/mounts)
+    """
+    path = os.path.realpath(path)
+    mount_point, fs_type = "", None
+    try:
+        with open("/proc/mounts", "r") as ifile:
+            for line in ifile:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                point = fields[1].replace("\\040", " ")
+                if (path == point or path.startswith(point.rstrip(os.sep) + os.sep)) and len(point) > len(mount_point):
+                    mount_point, fs_type = point, fields[2]
+    except OSError:
+        return None
+    return fs_type if fs_type in NETWORK_FILE_SYSTEMS else None
+
+
+def enable_wal(db_path):
+    """
+    Switch a database to write-ahead logging, so readers (e.g., SnapshotConnect) and writers stop blocking each other.
+    The journal mode is stored in the database file, so this only has to succeed once. WAL doesn't work for
+    processes on different machines sharing a network file system, so databases on one keep their rollback journal.
+    :param db_path: Database file
+    :return: True if the database is in WAL mode
+    """
+    if network_file_system(db_path):
+        return False
+    connection = sqlite3.connect(db_path, timeout=60)
+    try:
+        mode = connection.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    except sqlite3.OperationalError:  # Still locked after the timeout, so leave it for whoever starts up next
+        mode = None
+    finally:
+        connection.close()
+    return mode == "wal"
 
 
 class SQLiteBroker(object):
@@ -248,6 +465,171 @@ class Timer(object):
         return "%s%s%s" % (prefix, br.pretty_time(round(time()) - self.start), postfix)
 
 
+class CpuBudget(object):
+    """
+    Run-wide governor for CPU-bound work. A fixed number of tokens are shared by every thread and (forked) process, and
+    each parallel stage holds tokens while it works. A stage that is already running inside another token holder
+    (e.g., an all-by-all called by an MCMCMC walker) reuses its parent's token and only picks up spare tokens, so
+    nested stages never block and can't deadlock.
+    """
+    def __init__(self, cpus, stages=("mcl", "mcmcmc", "alignment", "all_by_all", "psipred", "placement")):
+        self.cpus = max(1, int(cpus))
+        self.tokens = BoundedSemaphore(self.cpus)
+        self.stages = list(stages)
+        self.usage = Array("d", len(self.stages) * 3)  # [token-seconds, calls, peak tokens] for each stage
+        self.start_time = time()
+        self._local = local()  # Tokens held by the current thread (copied into forked child processes)
+
+    def held(self):
+        return getattr(self._local, "held", 0)
+
+    def available(self):
+        """
+        Best guess at how many tokens are free right now
+        :return: int
+        """
+        try:
+            return self.tokens.get_value()
+        except NotImplementedError:  # sem_getvalue() isn't available on macOS
+            return self.cpus
+
+    @contextmanager
+    def hold(self, stage, max_tokens=1):
+        """
+        Acquire up to max_tokens for the duration of a `with` block, waiting for the first one if necessary
+        :param stage: Name of the stage doing the work (for utilization logging)
+        :param max_tokens: Upper limit on the number of processes the stage could make use of
+        :return: The number of processes the stage is allowed to run
+        """
+        if stage not in self.stages:
+            raise ValueError("Unknown CpuBudget stage '%s'. Select from %s" % (stage, self.stages))
+        nested = 1 if self.held() else 0
+        acquired = 0
+        if not nested:
+            self.tokens.acquire()
+            acquired += 1
+        while acquired + nested < min(max_tokens, self.cpus) and self.tokens.acquire(block=False):
+            acquired += 1
+
+        tokens = acquired + nested
+        self._local.held = self.held() + acquired
+        start_time = time()
+        try:
+            yield tokens
+        finally:
+            for _ in range(acquired):
+                self.tokens.release()
+            self._local.held -= acquired
+            self._record(stage, tokens, time() - start_time)
+
+    def _record(self, stage, tokens, seconds):
+        indx = self.stages.index(stage) * 3
+        with self.usage.get_lock():
+            self.usage[indx] += tokens * seconds
+            self.usage[indx + 1] += 1
+            self.usage[indx + 2] = max(self.usage[indx + 2], tokens)
+        return
+
+    def report(self):
+        """
+        Summarize how much of the budget each stage has used since the governor was created
+        :return: list of strings, one per stage that has done any work
+        """
+        elapsed = max(time() - self.start_time, 1e-6)
+        output = []
+        for indx, stage in enumerate(self.stages):
+            token_secs, calls, peak = self.usage[indx * 3:indx * 3 + 3]
+            if not calls:
+                continue
+            output.append("%s: %s%% of %s cores (%s calls, peak %s cores)"
+                          % (stage, round(token_secs / (elapsed * self.cpus) * 100, 1), self.cpus, int(calls),
+                             int(peak)))
+        return output
+
+
+class SingleFlight(object):
+    def __init__(self, lock_dir=None):
+        """
+        Cross-process guard so that only one thread or (forked) process at a time works on a given key. Everyone else
+        asking for the same key waits for the first one to finish, and can then go and pick up its result.
+        :param lock_dir: Where to keep lock files. Nothing is created until the first claim, and if not provided a
+                         directory named after the creating process is used in the system temp dir (so forked
+                         children still share it). That one is removed when the process exits.
+        """
+        self.owner = os.getpid()
+        if not lock_dir:
+            lock_dir = os.path.join(tempfile.gettempdir(), "rdmcl_locks_%s" % self.owner)
+            atexit.register(self.cleanup)
+        self.lock_dir = lock_dir
+
+    def cleanup(self):
+        """
+        Remove the lock directory once nothing is going to claim anything anymore (i.e., at the end of a run). Only the
+        process that made the guard does this, so forked children can't pull it out from under each other.
+        :return: None
+        """
+        if os.getpid() == self.owner:
+            shutil.rmtree(self.lock_dir, ignore_errors=True)
+        return
+
+    @contextmanager
+    def claim(self, key):
+        """
+        Hold the lock on `key` for the duration of a `with` block. The lock file is removed again by its holder.
+        :param key: String that is safe to use in a file name (e.g., an md5 hash)
+        :return: True if another holder had to be waited on (so its result should be checked for), otherwise False
+        """
+        os.makedirs(self.lock_dir, exist_ok=True)
+        lock_path = os.path.join(self.lock_dir, "%s.lock" % key)
+        waited = False
+        while True:
+            lock_file = open(lock_path, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                waited = True
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            # The previous holder removed this file on its way out, so anyone arriving since has locked a new one
+            lock_file.close()
+        try:
+            yield waited
+        finally:
+            os.remove(lock_path)  # Still holding the lock, so nobody else can be relying on this file
+            lock_file.close()
+
+
+class SeqIndex(object):
+    def __init__(self, seqbuddy):
+        """
+        Look up records by id, so subsets of a SeqBuddy object can be built without deep copying or regex searches
+        :param seqbuddy: SeqBuddy object to index
+        """
+        self.seqbuddy = seqbuddy
+        self.positions = {}  # Record ids are not guaranteed to be unique, so map each id to a list of indices
+        for indx, rec in enumerate(seqbuddy.records):
+            self.positions.setdefault(rec.id, []).append(indx)
+
+    def subset(self, seq_ids):
+        """
+        Create a new SeqBuddy object holding only the requested records. Records keep their original order and are
+        shared with the indexed SeqBuddy object, so modify the subset with care.
+        :param seq_ids: List of record ids (ids not in the index are ignored)
+        :return: SeqBuddy object
+        """
+        indices = sorted(set([indx for seq_id in seq_ids for indx in self.positions.get(seq_id, [])]))
+        records = [self.seqbuddy.records[indx] for indx in indices]
+        return Sb.SeqBuddy(records, in_format=self.seqbuddy.in_format, out_format=self.seqbuddy.out_format,
+                           alpha=self.seqbuddy.alpha)
+
+    def __len__(self):
+        return len(self.seqbuddy.records)
+
+
 def mean(series):
     return np.around(np.mean(series), 12)
 
@@ -271,6 +653,73 @@ def md5_hash(in_str):
     return md5(in_str).hexdigest()
 
 
+def file_state(path):
+    """
+    Cheap fingerprint of a marker file (no locks, no reads)
+    :param path: File path
+    :return: (mtime in ns, size), or None if the file doesn't exist
+    """
+    try:
+        stats = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stats.st_mtime_ns, stats.st_size
+
+
+def wait_for_change(path, last_state, timeout, interval=0.1):
+    """
+    Block until a marker file is created, touched, or removed, or until timeout runs out.
+    On NFS, stat() is answered from the client's attribute cache, so a change made on another host can take up to
+    acregmax seconds to show up (acdirmax for a file being created or removed; both default to 60). How quickly this
+    notices a change therefore depends on the mount options, and callers have to treat a timeout as 'check the
+    database now' rather than 'nothing happened'. Mounting with lower ac*max values (or 'actimeo=') shortens the lag.
+    :param path: File path
+    :param last_state: The previous output of file_state()
+    :param timeout: Max seconds to wait
+    :param interval: Seconds between checks
+    :return: The new file_state()
+    """
+    end_time = time() + timeout
+    while True:
+        state = file_state(path)
+        if state != last_state or time() >= end_time:
+            return state
+        sleep(min(interval, max(end_time - time(), 0)))
+
+
+def write_graph(sim_scores, handle):
+    """
+    Save an all-by-all graph as binary arrays instead of CSV: the sequence ids, each edge as a pair of indices into
+    those ids, and the score columns as floats
+    :param sim_scores: pd.DataFrame with 'seq1' and 'seq2' columns, all others being scores
+    :param handle: File path or binary file object
+    :return: None
+    """
+    if isinstance(handle, str):
+        with open(handle, "wb") as ofile:  # np.savez() tacks '.npz' onto paths that don't already have it
+            return write_graph(sim_scores, ofile)
+    columns = [col for col in sim_scores.columns if col not in ["seq1", "seq2"]]
+    seq_ids = np.concatenate([sim_scores["seq1"].values, sim_scores["seq2"].values]).astype(str)
+    ids, pairs = np.unique(seq_ids, return_inverse=True)
+    np.savez(handle, ids=ids, pairs=pairs.reshape(2, -1).T.astype(np.int32),
+             scores=sim_scores[columns].values.astype(float), columns=np.array(columns, dtype=str))
+    return
+
+
+def read_graph(handle):
+    """
+    Load a graph saved by write_graph()
+    :param handle: File path or binary file object
+    :return: pd.DataFrame
+    """
+    with np.load(handle, allow_pickle=False) as arrays:
+        ids, pairs = arrays["ids"], arrays["pairs"]
+        sim_scores = pd.DataFrame(arrays["scores"], columns=list(arrays["columns"]))
+    sim_scores.insert(0, "seq2", ids[pairs[:, 1]])
+    sim_scores.insert(0, "seq1", ids[pairs[:, 0]])
+    return sim_scores
+
+
 def make_full_mat(subsmat):
     for key in copy(subsmat):
         try:
@@ -0,0 +1,619 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Created on: Oct 18 2026
+
+"""
+Socket based job broker for RD-MCL workers. This is an alternative to sharing work_db.sqlite and heartbeat_db.sqlite
+over a network filesystem: the queue lives in memory in a single server process, every change is journaled to disk,
+and job inputs (sequences and psipred files) and results (alignment and graph) travel in the message bodies.
+
+Start the server with `job_server -a tcp://host:port` (or unix:///path/to/socket), then pass the same address to
+`launch_worker -wdb` and `rdmcl -wdb`. TCP servers will not start unless RDMCL_JOB_KEY is set, and every worker and
+master needs the same key.
+"""
+
+import os
+import re
+import json
+import time
+import socket
+import logging
+from hashlib import md5
+from threading import Thread, Condition, Event, RLock, Timer
+from collections import OrderedDict
+from multiprocessing.connection import Listener, Client, AuthenticationError, deliver_challenge, answer_challenge
+from buddysuite import buddy_resources as br
+
+try:
+    from . import helpers
+except ImportError:
+    import helpers
+
+VERSION = helpers.VERSION
+VERSION.name = "job_server"
+LOCAL_AUTHKEY = b"rdmcl"  # Only ever used on unix sockets, where file permissions decide who can connect
+COMPACT_EVERY = 10000  # Journal lines appended before it is rewritten from the current state
+AUTH_TIMEOUT = 10  # Seconds a new connection gets to authenticate before it is hung up on
+
+
+class JobServerError(Exception):
+    pass
+
+
+def is_server_address(address):
+    """
+    :param address: Whatever was passed in to -wdb
+    :return: True if it points at a job server instead of a worker directory
+    """
+    return bool(re.match("^(tcp|unix)://", str(address)))
+
+
+def parse_address(address):
+    """
+    :param address: 'tcp://host:port' or 'unix:///path/to/socket'
+    :return: (address, family) as used by multiprocessing.connection
+    """
+    tcp = re.match("^tcp://(.+):([0-9]+)$", address)
+    if tcp:
+        return (tcp.group(1), int(tcp.group(2))), "AF_INET"
+    unix = re.match("^unix://(.+)$", address)
+    if unix:
+        return os.path.abspath(unix.group(1)), "AF_UNIX"
+    raise ValueError("Job server address must look like tcp://host:port or unix:///path, not '%s'" % address)
+
+
+def get_authkey(family):
+    """
+    Messages are pickled, so anyone who can authenticate can run code on the other end. There is no default key for
+    TCP; RDMCL_JOB_KEY must be set on the server, workers, and masters.
+    :param family: 'AF_INET' or 'AF_UNIX', see parse_address()
+    :return: Shared secret as bytes
+    """
+    authkey = os.environ.get("RDMCL_JOB_KEY")
+    if authkey:
+        return authkey.encode()
+    if family == "AF_INET":
+        raise JobServerError("Set RDMCL_JOB_KEY on the server, workers, and masters before using a tcp:// job server")
+    return LOCAL_AUTHKEY
+
+
+class JobServer(object):
+    def __init__(self, address, journal=None, authkey=None, dead_thread_wait=120):
+        """
+        :param address: 'tcp://host:port' or 'unix:///path/to/socket'
+        :param journal: File that every change to the queue is appended to, and replayed from on start up. Results are
+        kept next to it in <journal>.results/ until their masters pick them up.
+        :param authkey: Shared secret that clients must present (default from get_authkey())
+        :param dead_thread_wait: Seconds without a pulse before a master or worker is considered dead
+        """
+        self.address = address
+        self.listen_address, self.family = parse_address(address)
+        self.authkey = authkey if authkey is not None else get_authkey(self.family)
+        if self.family == "AF_INET" and self.authkey == LOCAL_AUTHKEY:
+            raise JobServerError("Refusing to listen on TCP with the default key, set RDMCL_JOB_KEY")
+        self.journal = journal
+        self.results_dir = "%s.results" % journal if journal else None
+        self.journal_lines = 0
+        self.dead_thread_wait = dead_thread_wait
+        self.running = False
+        self.lock = Condition(RLock())
+
+        self.thread_counter = 0
+        self.threads = OrderedDict()     # {thread_id: [thread_type, last pulse]}
+        self.queue = OrderedDict()       # {job_id: job}
+        self.processing = OrderedDict()  # {job_id: [worker_id, job]}
+        self.results = OrderedDict()     # {job_id: {"alignment": str, "graph": bytes}}
+        self.waiting = OrderedDict()     # {job_id: set of master ids}
+        if self.journal:
+            self._replay()
+
+    # ##### Journal ##### #
+    def _log(self, op, **kwargs):
+        if not self.journal:
+            return
+        kwargs["op"] = op
+        with open(self.journal, "a") as ofile:
+            ofile.write("%s\n" % json.dumps(kwargs))
+        self.journal_lines += 1
+        if self.journal_lines >= COMPACT_EVERY:
+            self._compact()
+        return
+
+    def _result_path(self, job_id):
+        return os.path.join(self.results_dir, md5(job_id.encode()).hexdigest())
+
+    def _save_result(self, job_id, result):
+        """
+        Graphs and alignments are too big to journal, so they go in a file per job that _drop() removes again
+        """
+        os.makedirs(self.results_dir, exist_ok=True)
+        path = self._result_path(job_id)
+        with open("%s.tmp" % path, "wb") as ofile:
+            alignment = result["alignment"].encode()
+            ofile.write(b"%d\n" % len(alignment))
+            ofile.write(alignment)
+            ofile.write(result["graph"] if isinstance(result["graph"], bytes) else result["graph"].encode())
+        os.replace("%s.tmp" % path, path)
+        return
+
+    def _load_result(self, job_id):
+        with open(self._result_path(job_id), "rb") as ifile:
+            aln_len = int(ifile.readline())
+            alignment = ifile.read(aln_len).decode()
+            graph = ifile.read()
+        return {"alignment": alignment, "graph": graph}
+
+    def _compact(self):
+        """
+        Rewrite the journal so it only holds what is needed to rebuild the current state, and clear out result files
+        that nothing refers to anymore
+        """
+        with open("%s.tmp" % self.journal, "w") as ofile:
+            ofile.write("%s\n" % json.dumps({"op": "register", "thread_id": self.thread_counter}))
+            for job_id, job in self.queue.items():
+                ofile.write("%s\n" % json.dumps({"op": "queue", "job": job}))
+            for worker_id, job in self.processing.values():
+                ofile.write("%s\n" % json.dumps({"op": "queue", "job": job}))
+            for job_id in self.results:
+                ofile.write("%s\n" % json.dumps({"op": "complete", "job_id": job_id}))
+            for job_id, masters in self.waiting.items():
+                for master_id in masters:
+                    ofile.write("%s\n" % json.dumps({"op": "wait", "job_id": job_id, "master_id": master_id}))
+        os.replace("%s.tmp" % self.journal, self.journal)
+        self.journal_lines = 0
+
+        if os.path.isdir(self.results_dir):
+            keep = set([os.path.basename(self._result_path(job_id)) for job_id in self.results])
+            for file in os.listdir(self.results_dir):
+                if file not in keep:
+                    os.remove(os.path.join(self.results_dir, file))
+        return
+
+    def _replay(self):
+        """
+        Rebuild state from the journal. Anything that was being processed goes back on the queue (the worker is
+        gone), and masters get a fresh dead_thread_wait to check back in. The journal is then compacted.
+        """
+        if os.path.isfile(self.journal):
+            with open(self.journal, "r") as ifile:
+                for line in ifile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # Partial line from a crash
+                        continue
+                    op = entry["op"]
+                    if op == "register":
+                        self.thread_counter = max(self.thread_counter, entry["thread_id"])
+                    elif op == "queue":
+                        self.queue[entry["job"]["job_id"]] = entry["job"]
+                    elif op == "wait":
+                        self.waiting.setdefault(entry["job_id"], set()).add(entry["master_id"])
+                        self.threads[entry["master_id"]] = ["master", time.time()]
+                    elif op == "complete":
+                        try:
+                            self.results[entry["job_id"]] = self._load_result(entry["job_id"])
+                        except (OSError, ValueError):  # Result file is gone, so the job needs to be run again
+                            continue
+                        self.queue.pop(entry["job_id"], None)
+                    elif op == "drop":
+                        for table in [self.queue, self.results, self.waiting]:
+                            table.pop(entry["job_id"], None)
+                    elif op == "unwait":
+                        self.waiting.get(entry["job_id"], set()).discard(entry["master_id"])
+        self._compact()
+        return
+
+    # ##### Bookkeeping ##### #
+    def _pulse(self, thread_id, thread_type):
+        self.threads[thread_id] = [thread_type, time.time()]
+        return
+
+    def _live(self, thread_type):
+        return len([1 for _type, pulse in self.threads.values() if _type == thread_type])
+
+    def _drop(self, job_id):
+        self.queue.pop(job_id, None)
+        self.waiting.pop(job_id, None)
+        if self.results.pop(job_id, None) is not None and self.results_dir:
+            try:
+                os.remove(self._result_path(job_id))
+            except FileNotFoundError:
+                pass
+        self._log("drop", job_id=job_id)
+        return
+
+    def _reap(self):
+        """
+        Requeue jobs held by dead workers, forget dead masters, and drop any job that nobody is waiting on anymore
+        """
+        min_pulse = time.time() - self.dead_thread_wait
+        for thread_id, (thread_type, pulse) in list(self.threads.items()):
+            if pulse >= min_pulse:
+                continue
+            del self.threads[thread_id]
+            if thread_type == "worker":
+                for job_id, (worker_id, job) in list(self.processing.items()):
+                    if worker_id == thread_id:
+                        del self.processing[job_id]
+                        self.queue[job_id] = job
+                        self.lock.notify_all()
+            else:
+                for job_id, masters in self.waiting.items():
+                    masters.discard(thread_id)
+
+        for job_id, masters in list(self.waiting.items()):
+            if not masters:
+                self._drop(job_id)
+        for job_id in list(self.queue.keys()) + list(self.results.keys()):
+            if job_id not in self.waiting:
+                self._drop(job_id)
+        return
+
+    # ##### Commands ##### #
+    def cmd_register(self, thread_type):
+        self.thread_counter += 1
+        self._pulse(self.thread_counter, thread_type)
+        self._log("register", thread_id=self.thread_counter)
+        return self.thread_counter
+
+    def cmd_pulse(self, thread_id, thread_type):
+        self._pulse(thread_id, thread_type)
+        return True
+
+    def cmd_end(self, thread_id):
+        if thread_id in self.threads:
+            self.threads[thread_id][1] = 0
+        self._reap()
+        return True
+
+    def cmd_status(self):
+        self._reap()
+        return {"masters": self._live("master"), "workers": self._live("worker"), "queue": len(self.queue),
+                "processing": len(self.processing), "complete": len(self.results),
+                "waiting": sum([len(masters) for masters in self.waiting.values()])}
+
+    def cmd_submit(self, job_id, master_id, seqs, params, priority=0):
+        self._pulse(master_id, "master")
+        if master_id not in self.waiting.get(job_id, set()):
+            self.waiting.setdefault(job_id, set()).add(master_id)
+            self._log("wait", job_id=job_id, master_id=master_id)
+        if job_id in self.results:
+            return "complete"
+        if job_id not in self.queue and job_id not in self.processing:
+            job = {"job_id": job_id, "seqs": seqs, "params": params, "priority": priority, "queued": time.time()}
+            self.queue[job_id] = job
+            self._log("queue", job=job)
+            self.lock.notify_all()
+        return "queued"
+
+    def cmd_claim(self, worker_id, timeout=0):
+        self._pulse(worker_id, "worker")
+        end_time = time.time() + timeout
+        while not self.queue and time.time() < end_time:
+            self.lock.wait(end_time - time.time())
+        self._reap()
+        if not self.queue:
+            return None
+        # Same ordering as the work_db queue (see helpers.queue_rank()), first in first out among equals
+        job_id = max(self.queue, key=lambda x: helpers.queue_rank(self.queue[x]["priority"], self.queue[x]["queued"]))
+        job = self.queue.pop(job_id)
+        job["claimed"] = time.time()
+        self.processing[job_id] = [worker_id, job]
+        return job
+
+    def cmd_complete(self, job_id, worker_id, alignment, graph):
+        self._pulse(worker_id, "worker")
+        processing = self.processing.pop(job_id, None)
+        # The worker may have been given up for dead and its job put back on the queue. It's done now, so don't hand
+        # it out again (replaying the 'complete' entry below takes it off of the queue as well).
+        requeued = self.queue.pop(job_id, None)
+        if not self.waiting.get(job_id):
+            if requeued:
+                self._drop(job_id)
+            return False
+        # Service time (claim to completion) goes back to the master for its offload cost model
+        job = processing[1] if processing else requeued
+        secs = time.time() - job["claimed"] if job and "claimed" in job else None
+        self.results[job_id] = {"alignment": alignment, "graph": graph, "secs": secs}
+        if self.journal:
+            self._save_result(job_id, self.results[job_id])
+        self._log("complete", job_id=job_id)
+        self.lock.notify_all()
+        return True
+
+    def cmd_result(self, job_id, master_id, timeout=0):
+        self._pulse(master_id, "master")
+        end_time = time.time() + timeout
+        while job_id not in self.results and (job_id in self.queue or job_id in self.processing) \
+                and time.time() < end_time:
+            self.lock.wait(end_time - time.time())
+            self._pulse(master_id, "master")
+
+        if job_id in self.results:
+            result = dict(self.results[job_id], status="complete")
+            self.cmd_cancel(job_id, master_id)
+            return result
+        if job_id not in self.queue and job_id not in self.processing:
+            return {"status": "missing"}
+        self._reap()
+        return {"status": "pending", "workers": self._live("worker")}
+
+    def cmd_cancel(self, job_id, master_id):
+        masters = self.waiting.get(job_id, set())
+        if master_id in masters:
+            masters.discard(master_id)
+            self._log("unwait", job_id=job_id, master_id=master_id)
+        if not masters:
+            self._drop(job_id)
+        return True
+
+    # ##### Networking ##### #
+    @staticmethod
+    def _hang_up(conn):
+        # Closing the descriptor doesn't wake up a thread blocked reading from it, but shutting the socket down does
+        try:
+            sock = socket.socket(fileno=conn.fileno())
+        except OSError:  # Already closed
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        finally:
+            sock.detach()  # The connection still owns the descriptor
+        return
+
+    def _authenticate(self, conn):
+        """
+        Same handshake that Listener.accept() does when it has an authkey, but run from the connection's own thread so
+        a client that stalls can't hold up accept() for everyone else. Anything not done within AUTH_TIMEOUT is dropped.
+        :return: True if the client knows the key
+        """
+        watchdog = Timer(AUTH_TIMEOUT, self._hang_up, args=(conn,))
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            deliver_challenge(conn, self.authkey)
+            answer_challenge(conn, self.authkey)
+            return True
+        except (AuthenticationError, OSError, EOFError):
+            conn.close()
+            return False
+        finally:
+            watchdog.cancel()
+
+    def _handle(self, conn):
+        if not self._authenticate(conn):
+            return
+        try:
+            cmd, kwargs = conn.recv()
+            func = getattr(self, "cmd_%s" % cmd, None)
+            if not func:
+                raise JobServerError("Unknown command '%s'" % cmd)
+            with self.lock:
+                reply = ("ok", func(**kwargs))
+        except (EOFError, OSError):
+            conn.close()
+            return
+        except Exception as err:
+            reply = ("error", "%s: %s" % (type(err).__name__, err))
+        try:
+            conn.send(reply)
+        except (EOFError, OSError):
+            pass
+        conn.close()
+        return
+
+    def serve_forever(self):
+        if self.family == "AF_UNIX" and os.path.exists(self.listen_address):
+            try:  # Only clear out the socket file if nothing is listening on it
+                Client(self.listen_address, self.family, authkey=self.authkey).close()
+                raise JobServerError("A job server is already running at %s" % self.address)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.listen_address)
+
+        self.running = True
+        with Listener(self.listen_address, self.family) as listener:  # Clients authenticate in _handle()
+            while self.running:
+                try:
+                    conn = listener.accept()
+                except OSError:
+                    continue
+                if not self.running:
+                    conn.close()
+                    break
+                Thread(target=self._handle, args=(conn,), daemon=True).start()
+        return
+
+    def shutdown(self):
+        self.running = False
+        try:  # Knock once to get serve_forever() out of accept()
+            Client(self.listen_address, self.family, authkey=self.authkey).close()
+        except (OSError, EOFError):
+            pass
+        return
+
+
+class JobClient(object):
+    def __init__(self, address, authkey=None):
+        self.address = address
+        self.connect_address, self.family = parse_address(address)
+        self.authkey = authkey if authkey is not None else get_authkey(self.family)
+
+    def call(self, cmd, **kwargs):
+        conn = Client(self.connect_address, self.family, authkey=self.authkey)
+        try:
+            conn.send((cmd, kwargs))
+            status, reply = conn.recv()
+        finally:
+            conn.close()
+        if status == "error":
+            raise JobServerError(reply)
+        return reply
+
+    def register(self, thread_type):
+        return self.call("register", thread_type=thread_type)
+
+    def pulse(self, thread_id, thread_type):
+        return self.call("pulse", thread_id=thread_id, thread_type=thread_type)
+
+    def end(self, thread_id):
+        return self.call("end", thread_id=thread_id)
+
+    def status(self):
+        return self.call("status")
+
+    def submit(self, job_id, master_id, seqs, params, priority=0):
+        return self.call("submit", job_id=job_id, master_id=master_id, seqs=seqs, params=params, priority=priority)
+
+    def claim(self, worker_id, timeout=0):
+        return self.call("claim", worker_id=worker_id, timeout=timeout)
+
+    def complete(self, job_id, worker_id, alignment, graph):
+        return self.call("complete", job_id=job_id, worker_id=worker_id, alignment=alignment, graph=graph)
+
+    def result(self, job_id, master_id, timeout=0):
+        return self.call("result", job_id=job_id, master_id=master_id, timeout=timeout)
+
+    def cancel(self, job_id, master_id):
+        return self.call("cancel", job_id=job_id, master_id=master_id)
+
+
+class ServerHeartBeat(object):
+    def __init__(self, address, pulse_rate, thread_type="master"):
+        """
+        Same interface as rdmcl.HeartBeat/MasterHeartBeat, but pulses go to a job server from a thread in this process
+        :param address: Job server address
+        :param pulse_rate: Seconds between pulses
+        :param thread_type: 'master' or 'worker'
+        """
+        self.location = address
+        self.client = JobClient(address)
+        self.pulse_rate = pulse_rate
+        self.thread_type = thread_type
+        self.id = None
+        self.jobs = set()
+        self.keep_alive = False
+        self.owner_pid = None
+        self._stop = Event()
+        self._thread = None
+        self._lock = RLock()
+
+    def _run(self, stop):
+        while not stop.wait(self.pulse_rate):
+            try:
+                self.client.pulse(self.id, self.thread_type)
+            except (OSError, EOFError, JobServerError) as err:
+                logging.warning("Job server pulse failed: %s" % err)
+        return
+
+    def _owned(self):
+        return self.id is not None and self.owner_pid == os.getpid()
+
+    def _ensure_running(self):
+        if not self._owned():
+            if self.id is not None and self.keep_alive:
+                return  # Forked from a process whose run-wide heartbeat is already pulsing for this id
+            # Anything inherited from a parent process that only pulsed for its own jobs is not ours to reuse
+            self.id = self.client.register(self.thread_type)
+            self.owner_pid = os.getpid()
+            self.jobs = set()
+            self._stop.set()
+            self._thread = None
+        # A stopped thread may still be winding down
+        if not self._thread or not self._thread.is_alive() or self._stop.is_set():
+            self._stop = Event()
+            self._thread = Thread(target=self._run, args=(self._stop,), daemon=True)
+            self._thread.start()
+        return
+
+    def start(self):
+        with self._lock:
+            self._ensure_running()
+            self.keep_alive = True
+        return
+
+    def end(self):
+        with self._lock:
+            self._stop.set()
+            if self._owned():
+                try:
+                    self.client.end(self.id)
+                except (OSError, EOFError, JobServerError):
+                    pass
+            self.id = None
+            self.keep_alive = False
+            self.jobs = set()
+        return
+
+    def attach(self, job_id):
+        with self._lock:
+            self._ensure_running()
+            self.jobs.add(job_id)
+            return self.id
+
+    def detach(self, job_id):
+        with self._lock:
+            self.jobs.discard(job_id)
+            if not self.jobs and not self.keep_alive:
+                self._stop.set()
+        return
+
+
+def argparse_init():
+    import argparse
+
+    def fmt(prog):
+        return br.CustomHelpFormatter(prog)
+
+    parser = argparse.ArgumentParser(prog="job_server", formatter_class=fmt, add_help=False, usage=argparse.SUPPRESS,
+                                     description='''\
+\033[1mJob Server\033[m
+  Hand out all-by-all jobs to workers over a socket, instead of
+  through SQLite databases on a shared filesystem.
+
+  Point `launch_worker -wdb` and `rdmcl -wdb` at the same address.
+
+  TCP servers need the same RDMCL_JOB_KEY environment variable
+  set on the server, workers, and masters.
+
+\033[1mUsage\033[m:
+  job_server -a tcp://host:port [-options]
+''')
+
+    parser_flags = parser.add_argument_group(title="\033[1mAvailable commands\033[m")
+
+    parser_flags.add_argument("-a", "--address", action="store", required=True, metavar="",
+                              help="tcp://host:port or unix:///path/to/socket")
+    parser_flags.add_argument("-j", "--journal", action="store", default="job_server.journal", metavar="",
+                              help="File to journal the queue to (default=./job_server.journal)")
+    parser_flags.add_argument("-dtw", "--dead_thread_wait", action="store", type=int, default=120, metavar="",
+                              help="Specify the maximum time to wait for a heartbeat before dropping a master "
+                                   "or worker (default=120)")
+
+    # Misc
+    misc = parser.add_argument_group(title="\033[1mMisc options\033[m")
+    misc.add_argument('-v', '--version', action='version', version=str(VERSION))
+    misc.add_argument('-h', '--help', action="help", help="Show this help message and exit")
+
+    in_args = parser.parse_args()
+    return in_args
+
+
+def main():
+    in_args = argparse_init()
+    try:
+        server = JobServer(in_args.address, journal=os.path.abspath(in_args.journal),
+                           dead_thread_wait=in_args.dead_thread_wait)
+    except JobServerError as err:
+        print(err)
+        return
+    print("Job server listening at %s" % in_args.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -7,8 +7,10 @@ DESCRIPTION OF PROGRAM
 """
 
 import pandas as pd
+import numpy as np
 import sqlite3
-from multiprocessing import Lock, cpu_count
+from multiprocessing import Lock, Process, Pipe, cpu_count
+from multiprocessing.connection import wait
 from buddysuite import buddy_resources as br
 from buddysuite import AlignBuddy as Alb
 from buddysuite import SeqBuddy as Sb
@@ -17,31 +19,323 @@ import sys
 import re
 import time
 from random import random
+from io import BytesIO
+from statistics import median
 from collections import OrderedDict
 import shutil
 import traceback
 
+try:  # Python >= 3.8
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = resource_tracker = None
+
 # My packages
 try:
     from . import helpers
     from . import rdmcl
+    from . import job_server
 except ImportError:
     import helpers
     import rdmcl
+    import job_server
 
 
 # Globals
 WORKERLOCK = Lock()
 VERSION = helpers.VERSION
 VERSION.name = "launch_worker"
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)  # 'DELETE ... RETURNING' claims a job in one statement
+THROUGHPUT_WINDOW = 3600  # Ignore throughput measurements from workers that haven't scored anything in this long (sec)
+THROUGHPUT_SMOOTHING = 0.3  # Weight given to the newest measurement in each worker's running throughput estimate
 
 # Set global precision levels
 pd.set_option("display.precision", 12)
 
 
+class _JobCache(object):
+    """
+    Bounded, least-recently-used map of parsed job inputs (sequences, alignments, and psipred dataframes), so a worker
+    that picks up several subjobs of the same job only reads and parses them once. Each entry is stored with a version
+    (the file_state() of the file it came from) and anything cached from a different version of the file is a miss.
+    """
+    def __init__(self, max_size=2000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        """
+        :param key: Hashable key, e.g., ("ss2", id_hash, rec_id)
+        :param version: file_state() of the source file (None means the file can't be checked, so don't use the cache)
+        :return: The cached object, or None
+        """
+        if version is None:
+            return None
+        if key not in self.entries or self.entries[key][0] != version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][1]
+
+    def put(self, key, version, value):
+        if self.max_size <= 0 or version is None:
+            return
+        self.entries[key] = (version, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return "Cache hits %s/%s (%s%%), %s entries" % (self.hits, lookups,
+                                                         round(100 * self.hits / max(lookups, 1), 1),
+                                                         len(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class _SharedJob(object):
+    """
+    Read-only view of a job published by _ScoringPool.publish(). Sequences and psipred probabilities live in two
+    numpy arrays, which are views on multiprocessing.shared_memory blocks (or plain copies that came down the pipe if
+    shared_memory isn't available), and only the header that says where each record sits is pickled.
+    """
+    def __init__(self, header):
+        self.header = header
+        self.rows = {rec_id: indx for indx, rec_id in enumerate(header["seq_ids"])}
+        self.blocks = []
+        self.arrays = {}
+        for key, (source, shape, dtype) in header["arrays"].items():
+            if isinstance(source, str):
+                block = shared_memory.SharedMemory(name=source)
+                self.blocks.append(block)
+                self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            else:
+                self.arrays[key] = source
+
+    def seq(self, rec_id):
+        row = self.rows[rec_id]
+        return self.arrays["seqs"][row, :self.header["seq_lens"][row]].tobytes().decode()
+
+    def psipred(self, rec_id):
+        start, end = self.header["psipred_rows"][rec_id]
+        return self.arrays["psipred"][start:end]
+
+    def close(self):
+        self.arrays = {}  # Views have to go before the blocks can be closed
+        for block in self.blocks:
+            block.close()
+        self.blocks = []
+        return
+
+
+class _ScoringPool(object):
+    """
+    Long-lived processes that score the all-by-all comparisons of every job a worker picks up, instead of forking a
+    fresh set for each job (as br.run_multicore_function() did). Each job's aligned sequences and psipred
+    probabilities are packed into numpy arrays and published once in shared memory, so every process reads the same
+    copy, and only chunks of (seq1, seq2) ids go down the pipes, with the next chunk going to whichever process
+    finishes first. Consecutive subjobs over the same cached objects reuse what has already been published.
+    Results are appended to the job's data file in the same format as rdmcl.mc_score_sequences().
+    """
+    def __init__(self, processes, chunk_size=50):
+        self.num_processes = max(processes, 1)
+        self.chunk_size = chunk_size
+        self.connections = []
+        self.processes = []
+        self.job = None  # [alignment, psipred_dfs, gap_open, gap_extend, data_file] that has been published
+        self.blocks = []  # Shared memory backing the published job
+
+    def _worker_loop(self, conn):
+        # Drop the parent-side pipes inherited from processes forked earlier
+        for inherited_conn in self.connections:
+            inherited_conn.close()
+        job = None
+        params = None
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, KeyboardInterrupt):
+                break
+            if message is None:  # Poison pill
+                break
+            try:
+                if message[0] == "job":
+                    if job:
+                        job.close()
+                        job = None
+                    job, params = _SharedJob(message[1]), message[2]
+                    conn.send(("ready", None))
+                else:
+                    self._score_chunk(job, message[1], *params)
+                    conn.send(("done", None))
+            except Exception:
+                conn.send(("error", traceback.format_exc()))
+        if job:
+            job.close()
+        conn.close()
+        return
+
+    @staticmethod
+    def _score_chunk(job, chunk, gap_open, gap_extend, data_file):
+        results = ["" for _ in chunk]
+        for indx, (id1, id2) in enumerate(chunk):
+            subs_mat_score = rdmcl.compare_aligned_seqs(job.seq(id1), job.seq(id2), gap_open, gap_extend)
+            ss_score = rdmcl.compare_psi_pred_arrays(job.psipred(id1), job.psipred(id2))
+            results[indx] = "\n%s,%s,%s,%s" % (id1, id2, subs_mat_score, ss_score)
+        with rdmcl.LOCK:
+            with open(data_file, "a") as ofile:
+                ofile.write("".join(results))
+        return
+
+    def start(self):
+        if self.processes:
+            return
+        if resource_tracker:
+            # Start the tracker before forking so the children share it, otherwise each child would start its own
+            # and try to clean up shared memory blocks that the parent is still using
+            resource_tracker.ensure_running()
+        for _ in range(self.num_processes):
+            parent_conn, child_conn = Pipe()
+            p = Process(target=self._worker_loop, args=(child_conn,), daemon=True)
+            p.start()
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.processes.append(p)
+        return
+
+    def _published(self, job):
+        """Check whether this exact job (the same objects, not just equal ones) is the one already published"""
+        if not self.job:
+            return False
+        alignment, psipred_dfs, gap_open, gap_extend, data_file = job
+        if self.job[0] is not alignment or self.job[2:] != [gap_open, gap_extend, data_file]:
+            return False
+        held_dfs = self.job[1]
+        return all(held_dfs.get(rec_id) is psipred_df for rec_id, psipred_df in psipred_dfs.items())
+
+    def publish(self, job):
+        """
+        Pack a job into numpy arrays, put them in shared memory, and hand every process the header
+        :param job: [alignment, psipred_dfs, gap_open, gap_extend, data_file]
+        :return: None
+        """
+        self.release()
+        alignment, psipred_dfs, gap_open, gap_extend, data_file = job
+        records = alignment.records()
+        seqs = [str(rec.seq).encode() for rec in records]
+        seq_array = np.full((len(seqs), max([len(seq) for seq in seqs] + [0])), ord("-"), dtype=np.uint8)
+        for indx, seq in enumerate(seqs):
+            seq_array[indx, :len(seq)] = np.frombuffer(seq, dtype=np.uint8)
+
+        psipred_rows = OrderedDict()
+        psipred_arrays = []
+        num_rows = 0
+        for rec_id, psipred_df in psipred_dfs.items():
+            psipred_arrays.append(psipred_df[rdmcl.PSIPRED_COLUMNS].to_numpy(dtype=float))
+            psipred_rows[rec_id] = (num_rows, num_rows + len(psipred_arrays[-1]))
+            num_rows += len(psipred_arrays[-1])
+        psipred_array = np.concatenate(psipred_arrays) if psipred_arrays else np.zeros((0, len(rdmcl.PSIPRED_COLUMNS)))
+
+        header = {"seq_ids": [rec.id for rec in records], "seq_lens": [len(seq) for seq in seqs],
+                  "psipred_rows": psipred_rows, "arrays": OrderedDict()}
+        for key, array in [("seqs", seq_array), ("psipred", psipred_array)]:
+            if shared_memory:
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+                self.blocks.append(block)
+                header["arrays"][key] = (block.name, array.shape, array.dtype.str)
+            else:
+                header["arrays"][key] = (array, array.shape, array.dtype.str)
+
+        self.job = job
+        for conn in self.connections:
+            conn.send(("job", header, [gap_open, gap_extend, data_file]))
+        # Hold off on scoring until every process has the new job, so none of them are left reading the old one
+        for conn in self.connections:
+            status, value = conn.recv()
+            if status == "error":
+                raise RuntimeError("Scoring process failed:\n%s" % value)
+        return
+
+    def release(self):
+        """Free the shared memory of the published job (processes that still have it open keep their mapping)"""
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        self.job = None
+        return
+
+    def score(self, data, psipred_dfs, alignment, gap_open, gap_extend, data_file):
+        """
+        :param data: Comparisons, as lists of (seq1, seq2, psipred1, psipred2) (only the ids are sent to the processes)
+        :param psipred_dfs: {rec_id: pd.DataFrame} covering every id in data
+        :param alignment: AlignBuddy object
+        :param gap_open: Gap open penalty
+        :param gap_extend: Gap extend penalty
+        :param data_file: File that results are appended to
+        :return: None
+        """
+        pairs = [(pair[0], pair[1]) for chunk in data for pair in chunk]
+        if not pairs:
+            return
+        chunks = [pairs[i:i + self.chunk_size] for i in range(0, len(pairs), self.chunk_size)][::-1]
+        job = [alignment, psipred_dfs, gap_open, gap_extend, data_file]
+        try:
+            self.start()
+            if not self._published(job):
+                self.publish(job)
+            outstanding = set()
+            for conn in self.connections:
+                if chunks:
+                    conn.send(("pairs", chunks.pop()))
+                    outstanding.add(conn)
+            while outstanding:
+                for conn in wait(list(outstanding)):
+                    status, value = conn.recv()
+                    outstanding.discard(conn)
+                    if status == "error":
+                        raise RuntimeError("Scoring process failed:\n%s" % value)
+                    if chunks:
+                        conn.send(("pairs", chunks.pop()))
+                        outstanding.add(conn)
+        except BaseException:
+            self.shutdown()  # Replies still in flight would be picked up by the next job, so start over
+            raise
+        return
+
+    def shutdown(self):
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for conn, p in zip(self.connections, self.processes):
+            p.join(timeout=5)
+            if p.is_alive():  # Stuck part way through a chunk
+                p.terminate()
+                p.join()
+            conn.close()
+        self.connections = []
+        self.processes = []
+        self.release()
+        return
+
+    def __len__(self):
+        return len(self.processes)
+
+
 class Worker(object):
+    split_jobs = True  # Large jobs are broken into subjobs that other workers pick up through the shared directory
+
     def __init__(self, location, heartrate=60, max_wait=600, dead_thread_wait=120, cpus=cpu_count(),
-                 job_size_coff=300, log=False, quiet=False):
+                 job_size_coff=300, chunk_time=60, cache_size=2000, log=False, quiet=False):
         self.working_dir = os.path.abspath(location)
         self.wrkdb_path = os.path.join(self.working_dir, "work_db.sqlite")
         self.hbdb_path = os.path.join(self.working_dir, "heartbeat_db.sqlite")
@@ -49,11 +343,12 @@ class Worker(object):
         os.makedirs(self.output, exist_ok=True)
 
         self.heartrate = heartrate
-        self.heartbeat = rdmcl.HeartBeat(self.hbdb_path, self.heartrate, thread_type="worker")
+        self.heartbeat = self.make_heartbeat()
         self.max_wait = max_wait
         self.dead_thread_wait = dead_thread_wait
         self.cpus = cpus - 1 if cpus > 1 else 1
         self.job_size_coff = job_size_coff
+        self.chunk_time = chunk_time
         self.worker_file = ""
         self.data_file = ""
         self.start_time = time.time()
@@ -64,14 +359,24 @@ class Worker(object):
         self.subjob_num = 1
         self.num_subjobs = 1
         self.job_id_hash = None
+        self.job_priority = (0., time.time())  # (priority, queued) of the job most recently claimed
+        self.claim_stats = {"attempts": 0, "claimed": 0, "latency": 0., "lock_wait": 0., "max_lock_wait": 0.}
+        self.cache = _JobCache(cache_size)
+        self.pool = _ScoringPool(self.cpus)
+        self.throughput = None  # This worker's smoothed scoring rate, see record_throughput()
+        self.throughput_pending = False  # Set when self.throughput still needs to go into the throughput table
         self.printer = br.DynamicPrint(quiet=quiet)
         if log:
             self.printer._writer = _write(self.printer)
 
+    def make_heartbeat(self):
+        return rdmcl.HeartBeat(self.hbdb_path, self.heartrate, thread_type="worker")
+
     def start(self):
         self.split_time = time.time()
         self.start_time = time.time()
 
+        self.pool.start()  # Fork the scoring processes before the heartbeat gets going
         self.heartbeat.start()
         self.worker_file = os.path.join(self.working_dir, "Worker_%s" % self.heartbeat.id)
         with open(self.worker_file, "w") as ofile:
@@ -90,7 +395,7 @@ class Worker(object):
         while os.path.isfile(self.worker_file):
             idle = round(100 * self.idle / (self.idle + self.running), 2)
             if not idle_countdown:
-                self.printer.write("Idle %s%%" % idle)
+                self.printer.write("Idle %s%%. %s. %s" % (idle, self.claim_report(), self.cache.report()))
                 idle_countdown = 5
 
             # Make sure there are some masters still kicking around
@@ -119,7 +424,7 @@ class Worker(object):
 
             try:
                 idle_countdown = 1
-                seqbuddy = Sb.SeqBuddy("%s/%s.seqs" % (self.output, id_hash), in_format="fasta")
+                seqbuddy = self.load_seqs(id_hash)
 
                 # Prepare alignment
                 if len(seqbuddy) == 1:
@@ -131,10 +436,10 @@ class Worker(object):
                                                      params=align_p, quiet=True)
                     else:
                         self.printer.write("Reading MSA (%s seqs)" % len(seqbuddy))
-                        alignment = Alb.AlignBuddy(os.path.join(self.output, "%s.aln" % id_hash))
+                        alignment = self.load_alignment(id_hash)
 
-                # Prepare psipred dataframes
-                psipred_dfs = self.prepare_psipred_dfs(seqbuddy, psipred_dir)
+                # Prepare psipred dataframes (only subjobs use the cache, full jobs modify them in place)
+                psipred_dfs = self.prepare_psipred_dfs(seqbuddy, psipred_dir, id_hash if num_subjobs > 1 else None)
 
                 if num_subjobs == 1:  # This is starting a full job from scratch, not a sub-job
                     # Need to specify what columns the PsiPred files map to now that there are gaps.
@@ -144,10 +449,12 @@ class Worker(object):
                     self.printer.write("Trimal (%s seqs)" % len(seqbuddy))
                     alignment = rdmcl.trimal(seqbuddy, trimal, alignment)
 
+                    wrote_aln = False
                     with helpers.ExclusiveConnect(os.path.join(self.output, "write.lock"), max_lock=0):
                         # Place these write commands in ExclusiveConnect to ensure a writing lock
                         if not os.path.isfile(os.path.join(self.output, "%s.aln" % id_hash)):
                             alignment.write(os.path.join(self.output, "%s.aln" % id_hash), out_format="fasta")
+                            wrote_aln = True
 
                     # Re-update PsiPred files now that some columns, possibly including non-gap characters, are removed
                     self.printer.write("Updating %s psipred dataframes" % len(seqbuddy))
@@ -157,9 +464,16 @@ class Worker(object):
                 self.printer.write("Preparing all-by-all data")
                 data_len, data = rdmcl.prepare_all_by_all(seqbuddy, psipred_dfs, self.cpus)
 
-                if num_subjobs == 1 and data_len > self.cpus * self.job_size_coff:
+                width = alignment.lengths()[0]
+                num_chunks = self.plan_subjobs(data_len, width) if self.split_jobs and num_subjobs == 1 else 1
+                if num_chunks > 1:
+                    self.printer.write("Splitting %s (%s comparisons) into %s subjobs" % (id_hash, data_len,
+                                                                                         num_chunks))
+                    self.printer.new_line(1)
                     data_len, data, subjob_num, num_subjobs = self.spawn_subjobs(id_hash, data, psipred_dfs,
-                                                                                 gap_open, gap_extend)
+                                                                                 gap_open, gap_extend, num_chunks)
+                    if wrote_aln:  # Otherwise another worker's alignment is the one the subjobs will use
+                        self.cache_job(id_hash, alignment, psipred_dfs)
                 elif subjob_num > 1:
                     data_len, data = self.load_subjob(id_hash, subjob_num, num_subjobs, psipred_dfs)
 
@@ -168,8 +482,9 @@ class Worker(object):
                 with open(self.data_file, "w") as ofile:
                     ofile.write("seq1,seq2,subsmat,psi")
 
-                br.run_multicore_function(data, rdmcl.mc_score_sequences, quiet=True, max_processes=self.cpus,
-                                          func_args=[alignment, gap_open, gap_extend, self.data_file])
+                score_start = time.time()
+                self.pool.score(data, psipred_dfs, alignment, gap_open, gap_extend, self.data_file)
+                self.record_throughput(data_len, width, time.time() - score_start)
 
                 self.printer.write("Processing final results")
                 self.process_final_results(id_hash, subjob_num, num_subjobs)
@@ -208,6 +523,61 @@ class Worker(object):
             active_jobs += 1 if job not in subjobs else 0
         return workers - active_jobs if active_jobs < workers else 0  # This can happen if a worker died
 
+    def record_throughput(self, pairs, width, secs):
+        """
+        Update this worker's running estimate of how fast it scores all-by-all comparisons, measured in
+        pairs * alignment columns per second so that it carries over between families of different lengths. The
+        throughput table is only updated once the job is done (see flush_throughput()).
+        :param pairs: Number of comparisons scored
+        :param width: Number of columns in the alignment
+        :param secs: Time it took
+        """
+        if pairs < self.cpus or secs <= 0:  # Too small to say anything useful about the node
+            return
+        rate = pairs * width / secs
+        if self.throughput is not None:
+            rate = THROUGHPUT_SMOOTHING * rate + (1 - THROUGHPUT_SMOOTHING) * self.throughput
+        self.throughput = rate
+        self.throughput_pending = True
+        return
+
+    def flush_throughput(self, cursor):
+        """
+        Write out the estimate from record_throughput(). This is called from inside the transaction that moves a job
+        into `complete`, so it doesn't cost another round-trip on the work database.
+        :param cursor: Cursor of an open write transaction on the work database
+        """
+        if self.throughput_pending:
+            cursor.execute("INSERT OR REPLACE INTO throughput (worker_id, rate, updated) VALUES (?, ?, ?)",
+                           (self.heartbeat.id, self.throughput, time.time(),))
+            self.throughput_pending = False
+        return
+
+    def plan_subjobs(self, data_len, width):
+        """
+        Work out how many subjobs an all-by-all should be broken into. Chunks are sized so a typical worker (median
+        recorded throughput) gets through one in about chunk_time seconds, and a job that needs splitting is cut into
+        enough pieces for every idle worker to pick one up. Until some throughput has been recorded, chunks are
+        capped at #CPUs * job_size_coff comparisons.
+        :param data_len: Number of comparisons in the full job
+        :param width: Number of columns in the alignment
+        :return: Number of subjobs (1 means leave the job whole)
+        """
+        with helpers.SnapshotConnect(self.wrkdb_path) as cursor:
+            rates = cursor.execute("SELECT rate FROM throughput WHERE updated>?",
+                                   (time.time() - THROUGHPUT_WINDOW,)).fetchall()
+        if rates:
+            chunk_size = median([x[0] for x in rates]) * self.chunk_time / max(width, 1)
+            chunk_size = max(int(chunk_size), self.cpus)
+        else:
+            chunk_size = self.cpus * self.job_size_coff
+
+        num_subjobs = int(rdmcl.ceil(data_len / chunk_size))
+        if num_subjobs > 1:
+            # Spread over the idle workers as well, but never so thin that a chunk can't keep all of a node's CPUs busy
+            num_subjobs = max(num_subjobs, min(self.idle_workers() + 1, data_len // self.cpus))
+        return num_subjobs
+
     def check_masters(self, idle):
         if time.time() - self.last_heartbeat_from_master > self.max_wait:
             terminate = False
@@ -247,6 +617,7 @@ class Worker(object):
             # Remove any jobs in the 'processing' table where the worker is dead
             if dead_workers:
                 cursor.execute("DELETE FROM processing WHERE worker_id IN (%s)" % dead_workers)
+                cursor.execute("DELETE FROM throughput WHERE worker_id IN (%s)" % dead_workers)
             # Add master ids from orphaned entries to the dead masters list
             orphans = cursor.execute("SELECT master_id FROM waiting "
                                      "WHERE master_id NOT IN (%s)" % master_ids).fetchall()
@@ -283,11 +654,27 @@ class Worker(object):
         return
 
     def fetch_queue_job(self):
-        while True:
-            with helpers.ExclusiveConnect(self.wrkdb_path, priority=True) as cursor:
-                data = cursor.execute('SELECT * FROM queue').fetchone()
-                if data:
-                    id_hash, psipred_dir, align_m, align_p, trimal, gap_open, gap_extend = data
+        """
+        Claim the highest priority job in the queue. Moving it from 'queue' to 'processing' happens in one short
+        'BEGIN IMMEDIATE' transaction, with the row picked and removed by a single statement.
+        :return: [id_hash, psipred_dir, align_m, align_p, trimal, gap_open, gap_extend] or None
+        """
+        start_time = time.time()
+        data = None
+        connect = helpers.ImmediateConnect(self.wrkdb_path)
+        try:
+            with connect as cursor:
+                while True:
+                    claim = self._claim_next(cursor)
+                    if not claim:
+                        break
+                    id_hash, psipred_dir, align_m, align_p, trimal, gap_open, gap_extend, priority, queued = claim
+                    if cursor.execute('SELECT worker_id FROM processing WHERE hash=?', (id_hash,)).fetchone():
+                        continue
+                    self.job_priority = (priority, queued)  # Passed on to subjobs, if the job gets split up
+
+                    cursor.execute("INSERT INTO processing (hash, worker_id, claimed)"
+                                   " VALUES (?, ?, ?)", (id_hash, self.heartbeat.id, time.time(),))
                     if trimal:
                         trimal = trimal.split()
                         for indx, arg in enumerate(trimal):
@@ -295,27 +682,99 @@ class Worker(object):
                                 trimal[indx] = float(arg)
                             except ValueError:
                                 pass
-
-                    cursor.execute("DELETE FROM queue WHERE hash=?", (id_hash,))
-                    if cursor.execute('SELECT worker_id FROM processing WHERE hash=?', (id_hash,)).fetchone():
-                        continue
-
-                    cursor.execute("INSERT INTO processing (hash, worker_id)"
-                                   " VALUES (?, ?)", (id_hash, self.heartbeat.id,))
                     data = [id_hash, psipred_dir, align_m, align_p, trimal, gap_open, gap_extend]
-                break
+                    break
+        except sqlite3.OperationalError as err:
+            if "database is locked" not in str(err):
+                raise err
+            # Couldn't get the write lock, so treat it like an empty queue and try again next time around
+
+        self.claim_stats["attempts"] += 1
+        self.claim_stats["claimed"] += 1 if data else 0
+        self.claim_stats["lock_wait"] += connect.lock_wait
+        self.claim_stats["max_lock_wait"] = max(self.claim_stats["max_lock_wait"], connect.lock_wait)
+        self.claim_stats["latency"] += time.time() - start_time
         return data
 
-    def prepare_psipred_dfs(self, seqbuddy, psipred_dir):
+    @staticmethod
+    def _claim_next(cursor):
+        """
+        Pop the highest ranked row off of the queue (see helpers.queue_rank()), oldest first among equals
+        :param cursor: Cursor inside an open write transaction
+        :return: The queue row, or None if the queue is empty
+        """
+        columns = "hash, psi_pred_dir, align_m, align_p, trimal, gap_open, gap_extend, priority, queued"
+        order = "ORDER BY %s DESC, rowid LIMIT 1" % helpers.QUEUE_RANK_SQL  # Walks the queue_rank index
+        if SQLITE_RETURNING:
+            return cursor.execute("DELETE FROM queue WHERE rowid=(SELECT rowid FROM queue %s) RETURNING %s"
+                                  % (order, columns)).fetchone()
+        row = cursor.execute("SELECT rowid, %s FROM queue %s" % (columns, order)).fetchone()
+        if not row:
+            return None
+        cursor.execute("DELETE FROM queue WHERE rowid=?", (row[0],))
+        return row[1:]
+
+    def claim_report(self):
+        """
+        :return: Summary of how long this worker has spent getting jobs off of the queue
+        """
+        attempts = max(self.claim_stats["attempts"], 1)
+        return "Claimed %s jobs in %s attempts; mean claim latency %sms, mean lock wait %sms (max %sms)" \
+               % (self.claim_stats["claimed"], self.claim_stats["attempts"],
+                  round(1000 * self.claim_stats["latency"] / attempts, 2),
+                  round(1000 * self.claim_stats["lock_wait"] / attempts, 2),
+                  round(1000 * self.claim_stats["max_lock_wait"], 2))
+
+    def load_seqs(self, id_hash):
+        seqs_file = os.path.join(self.output, "%s.seqs" % id_hash)
+        version = helpers.file_state(seqs_file)
+        seqbuddy = self.cache.get(("seqs", id_hash), version)
+        if seqbuddy is None:
+            seqbuddy = Sb.SeqBuddy(seqs_file, in_format="fasta")
+            self.cache.put(("seqs", id_hash), version, seqbuddy)
+        return seqbuddy
+
+    def load_alignment(self, id_hash):
+        aln_file = os.path.join(self.output, "%s.aln" % id_hash)
+        version = helpers.file_state(aln_file)
+        alignment = self.cache.get(("aln", id_hash), version)
+        if alignment is None:
+            alignment = Alb.AlignBuddy(aln_file)
+            self.cache.put(("aln", id_hash), version, alignment)
+        return alignment
+
+    def prepare_psipred_dfs(self, seqbuddy, psipred_dir, id_hash=None):
+        """
+        :param seqbuddy: Records that need psipred data
+        :param psipred_dir: Directory holding the .ss2 files
+        :param id_hash: Subjobs pass their job hash so the dataframes can be cached (tied to the job's alignment file)
+        :return: OrderedDict of {rec_id: pd.DataFrame}
+        """
         psipred_dfs = OrderedDict()
         self.printer.write("Preparing %s psipred dataframes" % len(seqbuddy))
+        version = helpers.file_state(os.path.join(self.output, "%s.aln" % id_hash)) if id_hash else None
         for rec in seqbuddy.records:
+            psipred_dfs[rec.id] = self.cache.get(("ss2", id_hash, rec.id), version)
+            if psipred_dfs[rec.id] is not None:
+                continue
             psipred_file = os.path.join(psipred_dir, "%s.ss2" % rec.id)
             if not os.path.isfile(psipred_file):
                 raise FileNotFoundError(psipred_file)
             psipred_dfs[rec.id] = rdmcl.read_ss2_file(psipred_file)
+            self.cache.put(("ss2", id_hash, rec.id), version, psipred_dfs[rec.id])
         return psipred_dfs
 
+    def cache_job(self, id_hash, alignment, psipred_dfs):
+        """
+        Hold on to the trimmed alignment and psipred dataframes of a job that has just been split up, so any of its
+        subjobs that come back to this worker can skip straight to scoring
+        """
+        version = helpers.file_state(os.path.join(self.output, "%s.aln" % id_hash))
+        self.cache.put(("aln", id_hash), version, alignment)
+        for rec_id, psipred_df in psipred_dfs.items():
+            self.cache.put(("ss2", id_hash, rec_id), version, psipred_df)
+        return
+
     def process_final_results(self, id_hash, subjob_num, num_subjobs):
         with open(self.data_file, "r") as ifile:
             sim_scores = pd.read_csv(ifile, index_col=False)
@@ -329,18 +788,22 @@ class Worker(object):
 
             with helpers.ExclusiveConnect(os.path.join(self.output, "write.lock"), max_lock=0):
                 # Place these write commands in ExclusiveConnect to ensure a writing lock
-                sim_scores.to_csv(os.path.join(self.output, "%s.graph" % id_hash), header=None, index=False)
+                helpers.write_graph(sim_scores, os.path.join(self.output, "%s.graph" % id_hash))
 
             with helpers.ExclusiveConnect(self.wrkdb_path) as cursor:
                 # Confirm that the job is still being waited on and wasn't killed before adding to the `complete` table
                 waiting = cursor.execute("SELECT master_id FROM waiting WHERE hash=?", (id_hash,)).fetchall()
-                processing = cursor.execute("SELECT worker_id FROM processing WHERE hash=?",
+                processing = cursor.execute("SELECT worker_id, claimed FROM processing WHERE hash=?",
                                             (id_hash,)).fetchall()
+                notify = False
                 if waiting and processing:
-                    cursor.execute("INSERT INTO complete (hash) "
-                                   "VALUES (?)", (id_hash,))
+                    # Service time (claim to completion) goes back to the master for its offload cost model
+                    claimed = processing[0][1]
+                    cursor.execute("INSERT INTO complete (hash, secs) "
+                                   "VALUES (?, ?)", (id_hash, time.time() - claimed if claimed else 0,))
+                    notify = True
                 elif not waiting:
-                    for del_file in ["%s.%s" % (id_hash, x) for x in ["graph", "aln", "seqs"]]:
+                    for del_file in ["%s.%s" % (id_hash, x) for x in ["graph", "aln", "seqs", "done"]]:
                         try:
                             os.remove(os.path.join(self.output, del_file))
                         except FileNotFoundError:
@@ -348,11 +811,16 @@ class Worker(object):
 
                 cursor.execute("DELETE FROM processing WHERE hash=?", (id_hash,))
                 cursor.execute("DELETE FROM complete WHERE hash LIKE '%%_%s'" % id_hash)
+                self.flush_throughput(cursor)
+            if notify:
+                # Wake up any masters waiting on this job (only once the `complete` entry has been committed)
+                with open(os.path.join(self.output, "%s.done" % id_hash), "w") as ofile:
+                    ofile.write(str(time.time()))
             if os.path.isdir(os.path.join(self.output, id_hash)):
                 shutil.rmtree(os.path.join(self.output, id_hash))
         return
 
-    def spawn_subjobs(self, id_hash, data, psipred_dfs, gap_open, gap_extend):
+    def spawn_subjobs(self, id_hash, data, psipred_dfs, gap_open, gap_extend, num_subjobs=None):
         subjob_out_dir = os.path.join(self.output, id_hash)
         os.makedirs(subjob_out_dir, exist_ok=True)
         # Flatten the data jobs list back down
@@ -362,26 +830,31 @@ class Worker(object):
         for rec_id, df in psipred_dfs.items():
             df.to_csv(os.path.join(subjob_out_dir, "%s.ss2" % rec_id), header=None, index=False, sep=" ")
 
-        # Break it up again into min number of chunks where len(each chunk) < #CPUs * job_size_coff
-        num_subjobs = int(rdmcl.ceil(len_data / (self.cpus * self.job_size_coff)))
+        # Break it up again, by default into min number of chunks where len(each chunk) < #CPUs * job_size_coff
+        if not num_subjobs:
+            num_subjobs = int(rdmcl.ceil(len_data / (self.cpus * self.job_size_coff)))
         job_size = int(rdmcl.ceil(len_data / num_subjobs))
         data = [data[i:i + job_size] for i in range(0, len_data, job_size)]
+        num_subjobs = len(data)  # Rounding up job_size can leave fewer chunks than asked for
 
         for indx, subjob in enumerate(data):
             with open(os.path.join(subjob_out_dir, "%s_of_%s.txt" % (indx + 1, num_subjobs)), "w") as ofile:
                 for pair in subjob:
                     ofile.write("%s %s\n" % (pair[0], pair[1]))
 
-        # Push all jobs into the queue except the first job, which is held back for the current node to work on
+        # Push all jobs into the queue except the first job, which is held back for the current node to work on.
+        # Subjobs keep the priority and queue time of their parent, so they go out ahead of anything queued since.
+        priority, queued = self.job_priority
         with helpers.ExclusiveConnect(self.wrkdb_path) as cursor:
             for indx, subjob in enumerate(data[1:]):
                 # NOTE: the 'indx + 2' is necessary to push index to '1' start and account for the job already removed
-                cursor.execute("INSERT INTO queue (hash, psi_pred_dir, gap_open, gap_extend) "
-                               "VALUES (?, ?, ?, ?)", ("%s_%s_%s" % (indx + 2, num_subjobs, id_hash),
-                                                       subjob_out_dir, gap_open, gap_extend,))
+                cursor.execute("INSERT INTO queue (hash, psi_pred_dir, gap_open, gap_extend, cost, priority, queued) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?)", ("%s_%s_%s" % (indx + 2, num_subjobs, id_hash),
+                                                                subjob_out_dir, gap_open, gap_extend, len(subjob),
+                                                                priority, queued,))
 
-            cursor.execute("INSERT INTO processing (hash, worker_id) VALUES (?, ?)",
-                           ("1_%s_%s" % (num_subjobs, id_hash), self.heartbeat.id,))
+            cursor.execute("INSERT INTO processing (hash, worker_id, claimed) VALUES (?, ?, ?)",
+                           ("1_%s_%s" % (num_subjobs, id_hash), self.heartbeat.id, time.time(),))
 
         n = int(rdmcl.ceil(len(data[0]) / self.cpus))
         data = [data[0][i:i + n] for i in range(0, len(data[0]), n)]
@@ -406,7 +879,7 @@ class Worker(object):
         subjob_out_dir = os.path.join(self.output, id_hash)
         if os.path.isdir(subjob_out_dir):
             full_id_hash = "%s_%s_%s" % (subjob_num, num_subjobs, id_hash)
-            sim_scores.to_csv(os.path.join(subjob_out_dir, "%s_of_%s.sim_df" % (subjob_num, num_subjobs)), index=False)
+            helpers.write_graph(sim_scores, os.path.join(subjob_out_dir, "%s_of_%s.graph" % (subjob_num, num_subjobs)))
 
             with helpers.ExclusiveConnect(self.wrkdb_path) as cursor:
                 # Confirm that the job is still being waited on and wasn't killed before adding to the `complete` table
@@ -420,28 +893,132 @@ class Worker(object):
                                    "VALUES (?)", (full_id_hash,))
 
                 cursor.execute("DELETE FROM processing WHERE hash=?", (full_id_hash,))
+                self.flush_throughput(cursor)
                 complete_count = cursor.execute("SELECT COUNT(*) FROM complete "
                                                 "WHERE hash LIKE '%%_%s'" % id_hash).fetchone()[0]
 
             if complete_count == num_subjobs:
-                output = pd.DataFrame(columns=["seq1", "seq2", "subsmat", "psi"])
-                for indx in range(1, num_subjobs + 1):
-                    next_df = os.path.join(subjob_out_dir, "%s_of_%s.sim_df" % (indx, num_subjobs))
-                    output = output.append(pd.read_csv(next_df, index_col=False))
+                output = [helpers.read_graph(os.path.join(subjob_out_dir, "%s_of_%s.graph" % (indx, num_subjobs)))
+                          for indx in range(1, num_subjobs + 1)]
+                output = pd.concat(output, ignore_index=True)
         return output
 
     def terminate(self, message):
         self.printer.write("Terminating Worker_%s because of %s." % (self.heartbeat.id, message))
         self.printer.new_line(1)
-        with helpers.ExclusiveConnect(self.wrkdb_path) as cursor:
-            cursor.execute("DELETE FROM processing WHERE worker_id=?", (self.heartbeat.id,))
+        self.printer.write(self.claim_report())
+        self.printer.new_line(1)
+        self.release_jobs()
         if os.path.isfile(self.data_file):
             os.remove(self.data_file)
         if os.path.isfile(self.worker_file):
             os.remove(self.worker_file)
+        self.pool.shutdown()
         self.heartbeat.end()
         sys.exit()
 
+    def release_jobs(self):
+        """
+        Give up anything this worker was processing (it will be requeued by a master)
+        :return: None
+        """
+        with helpers.ExclusiveConnect(self.wrkdb_path) as cursor:
+            cursor.execute("DELETE FROM processing WHERE worker_id=?", (self.heartbeat.id,))
+        return
+
+
+class ServerWorker(Worker):
+    """
+    Worker for a job_server backend. Jobs arrive with their sequences and psipred files, and results are sent straight
+    back, so location is only used for scratch files and the 'Worker_#' check file.
+    """
+    split_jobs = False  # Subjobs are passed around through the shared directory, which a job server doesn't have
+
+    def __init__(self, address, location=None, claim_wait=5, **kwargs):
+        """
+        :param address: Job server address
+        :param location: Local working directory (defaults to the current directory)
+        :param claim_wait: Seconds that the server holds a claim request open while the queue is empty
+        :param kwargs: Passed on to Worker
+        """
+        self.address = address
+        self.client = job_server.JobClient(address)
+        self.claim_wait = claim_wait
+        Worker.__init__(self, location if location else os.getcwd(), **kwargs)
+
+    def make_heartbeat(self):
+        return job_server.ServerHeartBeat(self.address, self.heartrate, thread_type="worker")
+
+    def check_masters(self, idle):
+        if time.time() - self.last_heartbeat_from_master > self.max_wait:
+            masters = self.client.status()["masters"]
+            self.last_heartbeat_from_master = time.time()
+            if not masters:
+                self.terminate("%s of master inactivity (spent %s%% time idle)" %
+                               (br.pretty_time(self.max_wait), idle))
+        return
+
+    def clean_dead_threads(self):
+        return  # The job server keeps track of dead threads itself
+
+    def idle_workers(self):
+        return 0  # Claims already wait on the server for new jobs, so there's no need to back off
+
+    def record_throughput(self, pairs, width, secs):
+        return  # Jobs are never split, so there's nothing to size with it
+
+    def fetch_queue_job(self):
+        start_time = time.time()
+        job = self.client.claim(self.heartbeat.id, timeout=self.claim_wait)
+        self.claim_stats["attempts"] += 1
+        self.claim_stats["latency"] += time.time() - start_time
+        if not job:
+            return None
+        self.claim_stats["claimed"] += 1
+
+        id_hash, params = job["job_id"], job["params"]
+        with open(os.path.join(self.output, "%s.seqs" % id_hash), "w") as ofile:
+            ofile.write(job["seqs"])
+        psipred_dir = os.path.join(self.output, "%s_psipred" % id_hash)
+        os.makedirs(psipred_dir, exist_ok=True)
+        for rec_id, ss2 in params["psipred"].items():
+            with open(os.path.join(psipred_dir, "%s.ss2" % rec_id), "w") as ofile:
+                ofile.write(ss2)
+
+        trimal = params["trimal"].split() if params["trimal"] else params["trimal"]
+        for indx, arg in enumerate(trimal if trimal else []):
+            try:
+                trimal[indx] = float(arg)
+            except ValueError:
+                pass
+        return [id_hash, psipred_dir, params["align_m"], params["align_p"], trimal, params["gap_open"],
+                params["gap_extend"]]
+
+    def process_final_results(self, id_hash, subjob_num, num_subjobs):
+        with open(self.data_file, "r") as ifile:
+            sim_scores = pd.read_csv(ifile, index_col=False)
+
+        if not sim_scores.empty:
+            sim_scores = rdmcl.set_final_sim_scores(sim_scores)
+            with open(os.path.join(self.output, "%s.aln" % id_hash), "r") as ifile:
+                alignment = ifile.read()
+            graph = BytesIO()
+            helpers.write_graph(sim_scores, graph)
+            self.client.complete(id_hash, self.heartbeat.id, alignment, graph.getvalue())
+
+        for del_file in ["%s.%s" % (id_hash, x) for x in ["aln", "seqs"]]:
+            if os.path.isfile(os.path.join(self.output, del_file)):
+                os.remove(os.path.join(self.output, del_file))
+        shutil.rmtree(os.path.join(self.output, "%s_psipred" % id_hash), ignore_errors=True)
+        return
+
+    def release_jobs(self):
+        try:  # Ending this worker's heartbeat requeues anything it was working on
+            self.client.end(self.heartbeat.id)
+        except (OSError, EOFError, job_server.JobServerError):
+            pass
+        return
+
 
 # Used to patch br.DynamicPrint() when the -log flag is thrown
 def _write(self):
@@ -476,7 +1053,8 @@ def argparse_init():
     parser_flags = parser.add_argument_group(title="\033[1mAvailable commands\033[m")
 
     parser_flags.add_argument("-wdb", "--workdb", action="store", default=os.getcwd(), metavar="",
-                              help="Specify the directory where sqlite databases will be fed by RD-MCL", )
+                              help="Specify the directory where sqlite databases will be fed by RD-MCL, or the "
+                                   "address of a job_server (tcp://host:port or unix:///path)", )
     parser_flags.add_argument("-hr", "--heart_rate", type=int, default=60, metavar="",
                               help="Specify how often the worker should check in (default=60)")
     parser_flags.add_argument("-mw", "--max_wait", action="store", type=int, default=600, metavar="",
@@ -489,6 +1067,12 @@ def argparse_init():
                               help="Specify the maximum number of cores the worker can use (default=%s)" % cpu_count())
     parser_flags.add_argument("-js", "--job_size", type=int, action="store", default=cpu_count(), metavar="",
                               help="Set job size coffactor to adjust… well, job size. (default=300)")
+    parser_flags.add_argument("-ct", "--chunk_time", type=int, action="store", default=60, metavar="",
+                              help="Target run time (sec) for each subjob once worker throughput is known "
+                                   "(default=60)")
+    parser_flags.add_argument("-cs", "--cache_size", type=int, action="store", default=2000, metavar="",
+                              help="Max number of parsed alignments and psipred files to keep between subjobs "
+                                   "(default=2000)")
     parser_flags.add_argument("-log", "--log", help="Stream log data one line at a time", action="store_true")
     parser_flags.add_argument("-q", "--quiet", help="Suppress all output", action="store_true")
 
@@ -504,24 +1088,23 @@ def argparse_init():
 def main():
     in_args = argparse_init()
 
+    if job_server.is_server_address(in_args.workdb):
+        try:
+            job_server.get_authkey(job_server.parse_address(in_args.workdb)[1])
+        except job_server.JobServerError as err:
+            print(err)
+            sys.exit()
+        wrkr = ServerWorker(in_args.workdb, heartrate=in_args.heart_rate, max_wait=in_args.max_wait,
+                            dead_thread_wait=in_args.dead_thread_wait, cpus=in_args.max_cpus,
+                            job_size_coff=in_args.job_size, chunk_time=in_args.chunk_time,
+                            cache_size=in_args.cache_size, log=in_args.log, quiet=in_args.quiet)
+        run_worker(wrkr)
+        return
+
     workdb = os.path.join(in_args.workdb, "work_db.sqlite")
     heartbeatdb = os.path.join(in_args.workdb, "heartbeat_db.sqlite")
 
-    connection = sqlite3.connect(workdb)
-    cur = connection.cursor()
-    for sql in ['CREATE TABLE queue (hash TEXT PRIMARY KEY, psi_pred_dir TEXT, '
-                'align_m TEXT, align_p TEXT, trimal TEXT, gap_open FLOAT, gap_extend FLOAT)',
-                'CREATE TABLE processing (hash TEXT PRIMARY KEY, worker_id INTEGER)',
-                'CREATE TABLE complete   (hash TEXT PRIMARY KEY)',
-                'CREATE TABLE proc_comp   (hash TEXT PRIMARY KEY, master_id INTEGER)',
-                'CREATE TABLE waiting (hash TEXT, master_id INTEGER)']:
-        try:
-            cur.execute(sql)
-        except sqlite3.OperationalError:
-            pass
-
-    cur.close()
-    connection.close()
+    helpers.prepare_work_db(workdb)
 
     connection = sqlite3.connect(heartbeatdb)
     cur = connection.cursor()
@@ -533,10 +1116,16 @@ def main():
 
     cur.close()
     connection.close()
+    helpers.enable_wal(heartbeatdb)
 
     wrkr = Worker(in_args.workdb, heartrate=in_args.heart_rate, max_wait=in_args.max_wait,
                   dead_thread_wait=in_args.dead_thread_wait, cpus=in_args.max_cpus,
-                  job_size_coff=in_args.job_size, log=in_args.log, quiet=in_args.quiet)
+                  job_size_coff=in_args.job_size, chunk_time=in_args.chunk_time, cache_size=in_args.cache_size,
+                  log=in_args.log, quiet=in_args.quiet)
+    run_worker(wrkr)
+
+
+def run_worker(wrkr):
     valve = br.SafetyValve(5)
     while True:  # The only way out is through Worker.terminate
         try:
@@ -547,8 +1136,7 @@ def main():
             wrkr.terminate("KeyboardInterrupt")
 
         except Exception as err:
-            with helpers.ExclusiveConnect(wrkr.wrkdb_path) as cursor:
-                cursor.execute("DELETE FROM processing WHERE worker_id=?", (wrkr.heartbeat.id,))
+            wrkr.release_jobs()
 
             if "Too many Worker crashes detected" in str(err):
                 wrkr.terminate("too many Worker crashes")
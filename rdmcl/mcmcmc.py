@@ -10,47 +10,128 @@ import os
 import sys
 import random
 import string
+import traceback
+import warnings
+from time import time
 from scipy.stats import norm
-from buddysuite.buddy_resources import TempFile, SafetyValve
+from buddysuite.buddy_resources import SafetyValve
 from copy import deepcopy
-from multiprocessing import Process
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 from collections import OrderedDict
 import pandas as pd
+import numpy as np
 import dill
-import shutil
 
 
 # Set global precision levels
 pd.set_option("display.precision", 12)
 
 
+def _reflect(values, mins, maxs):
+    """
+    Fold values back into [min, max], bouncing off the boundaries as many times as needed
+    :param values: Scalar or numpy array
+    :param mins: Lower bounds (broadcast against values)
+    :param maxs: Upper bounds (broadcast against values)
+    :return: numpy array
+    """
+    spans = np.asarray(maxs, dtype=float) - mins
+    safe_spans = np.where(spans > 0, spans, 1.)
+    offsets = np.mod(np.asarray(values, dtype=float) - mins, 2 * safe_spans)
+    return np.where(spans > 0, mins + safe_spans - np.abs(offsets - safe_spans), mins)
+
+
+class _RingBuffer(object):
+    """
+    Fixed-capacity history of floats. Once full, the oldest value is overwritten by each new one. If a spill_file is
+    set, every block of `capacity` values is appended to it (one per line) just before it starts being overwritten.
+    """
+    def __init__(self, capacity=1000, spill_file=None):
+        self.capacity = max(int(capacity), 1)
+        self.data = np.zeros(self.capacity)
+        self.size = 0  # Number of values currently held
+        self.total = 0  # Number of values ever appended
+        self.logged = 0  # self.total at the last checkpoint
+        self.spill_file = spill_file
+
+    def append(self, value):
+        """
+        :param value: float
+        :return: The value that was pushed out of the buffer, or None if it wasn't full yet
+        """
+        indx = self.total % self.capacity
+        evicted = float(self.data[indx]) if self.size == self.capacity else None
+        self.data[indx] = value
+        self.total += 1
+        self.size = min(self.size + 1, self.capacity)
+        if self.spill_file and self.total % self.capacity == 0:
+            with open(self.spill_file, "a") as ofile:
+                ofile.write("".join(["%s\n" % round(value, 12) for value in self.data]))
+        return evicted
+
+    def values(self):
+        """
+        :return: numpy array of the values currently held, oldest first
+        """
+        return self.data[(self.total - self.size + np.arange(self.size)) % self.capacity]
+
+    def truncate(self, total):
+        """
+        Drop the most recent values, so that only the first `total` values appended remain
+        """
+        if total < self.total:
+            self.size = max(self.size - (self.total - total), 0)
+            self.total = total
+        return
+
+    def _dump_obj(self):
+        """
+        :return: (position of the first value, [values appended since the last dump])
+        """
+        start = max(self.logged, self.total - self.size)
+        self.logged = self.total
+        return start, self.values()[self.size - (self.total - start):].tolist()
+
+    def _apply_dump(self, dump):
+        start, values = dump
+        self.truncate(start)
+        for value in values:
+            self.append(value)
+        self.logged = self.total
+        return
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.values().tolist())
+
+    def __getitem__(self, item):
+        return self.values().tolist()[item]
+
+    def __repr__(self):
+        return str(self.values().tolist())
+
+
 class Variable:
-    def __init__(self, var_name, min_val, max_val, r_seed=None):
+    def __init__(self, var_name, min_val, max_val, r_seed=None, history_size=1000):
         self.name = var_name
         self.min = min_val
         self.max = max_val
         val_range = max_val - min_val
 
         # select a random start value
-        self.rand_gen = random.Random(r_seed)
+        self.rand_gen = np.random.default_rng(r_seed)
         self.current_value = round(self.rand_gen.random() * val_range + min_val, 12)
         self.draw_value = float(self.current_value)
-        self.history = OrderedDict([("draws", [self.draw_value]), ("accepts", [])])
+        self.history = OrderedDict([("draws", _RingBuffer(history_size)), ("accepts", _RingBuffer(history_size))])
+        self.history["draws"].append(self.draw_value)
 
     def draw_new_value(self, heat):
         #  NOTE: Might need to tune heat if the acceptance rate is to low or high.
-        draw_val = round(self.rand_gen.gauss(self.current_value, ((self.max - self.min) * heat)), 12)
-        valve = SafetyValve(global_reps=100)
-        while draw_val < self.min or draw_val > self.max:
-            if draw_val < self.min:
-                draw_val = self.min + abs(self.min - draw_val)
-
-            elif draw_val > self.max:
-                draw_val = self.max - abs(self.max - draw_val)
-
-            valve.step("Popped safety valve in Variable.draw_new_value() (draw val = %s)" % draw_val)
-
-        self.draw_value = round(draw_val, 12)
+        draw_val = self.rand_gen.normal(self.current_value, ((self.max - self.min) * heat))
+        self.draw_value = round(float(_reflect(draw_val, self.min, self.max)), 12)
         self.history["draws"].append(self.draw_value)
         return
 
@@ -59,6 +140,16 @@ class Variable:
         self.draw_value = float(self.current_value)
         return
 
+    def spill_history(self, file_root):
+        """
+        Write history out to disk as it rolls out of memory
+        :param file_root: Path prefix; each history list is written to <file_root>_<list name>.txt
+        :return: None
+        """
+        for key, history in self.history.items():
+            history.spill_file = "%s_%s.txt" % (file_root, key)
+        return
+
     def set_value(self, value):
         self.current_value = float(value)
         self.draw_value = float(value)
@@ -69,6 +160,23 @@ class Variable:
         self.history["accepts"].append(self.current_value)
         return
 
+    def _dump_obj(self):
+        """
+        Checkpoint the current state. Only the history accumulated since the last dump is included, along with where
+        it starts, so repeated dumps stay small.
+        """
+        history = OrderedDict([(key, values._dump_obj()) for key, values in self.history.items()])
+        return {"current": self.current_value, "draw": self.draw_value, "rand_state": self.rand_gen.bit_generator.state,
+                "history": history}
+
+    def _apply_dump(self, var_dict):
+        self.current_value = var_dict["current"]
+        self.draw_value = var_dict["draw"]
+        self.rand_gen.bit_generator.state = var_dict["rand_state"]
+        for key, dump in var_dict["history"].items():
+            self.history[key]._apply_dump(dump)
+        return
+
     def __str__(self):
         return """
 Name: {}
@@ -78,15 +186,16 @@ Current value: {}
 Draw value: {}
 History: {}
 """.format(self.name, self.min, self.max,
-           self.current_value, self.draw_value, [(key, val) for key, val in self.history.items()])
+           self.current_value, self.draw_value, [(key, list(val)) for key, val in self.history.items()])
 
 
 class _Walker:
     def __init__(self, variables, func, heat, params=None, quiet=False,
-                 r_seed=None, lava=False, ice=False, min_max=()):
+                 r_seed=None, lava=False, ice=False, min_max=(), memo_key=None):
         self.variables = variables
         self.function = func
         self.params = params
+        self.memo_key = memo_key  # Optional function that maps a proposal onto a canonical key for the score cache
         if lava and ice:  # These two are mutually exclusive
             raise AttributeError("The _Walker.lava and .ice parameters both set to True. This is not valid.")
         self.lava = lava  # This will cause the walker to draw brand new parameters every time
@@ -94,10 +203,12 @@ class _Walker:
         self.heat = heat
         self.current_score = None
         self.proposed_score = None
-        self.score_history = []
+        self.current_key = None  # Memo keys are only set if memo_key has been provided
+        self.proposed_key = None
+        self.score_history = _RingBuffer(1000)  # Don't keep the entire history when determining acceptance rates
+        self.score_stats = _RunningStats(1)  # Running mean/variance of everything in score_history
         self.rand_gen = random.Random(r_seed)
         self.name = "".join([self.rand_gen.choice(string.ascii_letters + string.digits) for _ in range(20)])
-        self.proposed_score_file = TempFile()
 
         # Sample `function` for starting min/max scores
         valve = SafetyValve(31)
@@ -106,8 +217,8 @@ class _Walker:
                 raise ValueError("min_max value passed into _Walker is not of type [num, different num]")
             if not quiet:
                 print("User-defined initial chain parameters: %s" % ", ".join([str(i) for i in min_max]))
-            self.score_history.append(float(min_max[0]))
-            self.score_history.append(float(min_max[1]))
+            self.record_score(float(min_max[0]))
+            self.record_score(float(min_max[1]))
         else:
             if not quiet:
                 print("Setting initial chain parameters:")
@@ -123,7 +234,7 @@ class _Walker:
                 # Always add a new seed for the target function
                 func_args.append(self.rand_gen.randint(1, 999999999999999))
                 score = self.function(func_args) if not self.params else self.function(func_args, self.params)
-                self.score_history.append(round(score, 12))
+                self.record_score(round(score, 12))
                 output += " Score = %s" % score
 
                 if not quiet:
@@ -132,10 +243,18 @@ class _Walker:
         for variable in self.variables:
             variable.draw_random()
 
+    def record_score(self, score):
+        evicted = self.score_history.append(score)
+        self.score_stats.push(np.array([score]))
+        if evicted is not None:
+            self.score_stats.pop(np.array([evicted]))
+        return
+
     def accept(self):
         for variable in self.variables:
             variable.accept_draw()
         self.current_score = self.proposed_score
+        self.current_key = self.proposed_key
         return
 
     # ToDo: def run_function() --> then replace all the other cases where self.func() is called elsewhere.
@@ -149,22 +268,30 @@ class _Walker:
         return
 
     def _dump_obj(self):
-        return {"vars": self.variables, "lava": self.lava, "ice": self.ice, "heat": self.heat,
-                "cur_score": self.current_score, "prop_score": self.proposed_score, "score_hist": self.score_history,
-                "name": self.name}
+        return {"vars": [variable._dump_obj() for variable in self.variables], "lava": self.lava, "ice": self.ice,
+                "heat": self.heat, "cur_score": self.current_score, "prop_score": self.proposed_score,
+                "score_hist": self.score_history._dump_obj(), "name": self.name, "rand_state": self.rand_gen.getstate(),
+                "cur_key": self.current_key, "prop_key": self.proposed_key}
 
     def _apply_dump(self, var_dict):
         if var_dict["lava"] and var_dict["ice"]:  # These two are mutually exclusive
             raise AttributeError("The _Walker.lava and .ice parameters both set to True. This is not valid.")
 
-        self.variables = var_dict["vars"]
+        for variable, var_dump in zip(self.variables, var_dict["vars"]):
+            variable._apply_dump(var_dump)
         self.lava = var_dict["lava"]
         self.ice = var_dict["ice"]
         self.set_heat(var_dict["heat"])
         self.current_score = var_dict["cur_score"]
         self.proposed_score = var_dict["prop_score"]
-        self.score_history = var_dict["score_hist"]
+        self.current_key = var_dict["cur_key"]
+        self.proposed_key = var_dict["prop_key"]
+        self.score_history._apply_dump(var_dict["score_hist"])
+        self.score_stats = _RunningStats(1)
+        for score in self.score_history:
+            self.score_stats.push(np.array([score]))
         self.name = var_dict["name"]
+        self.rand_gen.setstate(var_dict["rand_state"])
         return
 
     def __str__(self):
@@ -175,10 +302,44 @@ class _Walker:
         return output
 
 
+class _RunningStats(object):
+    """
+    Welford-style running mean and sum of squared deviations for a vector of scalars. Values can also be removed, so
+    the statistics can follow a sliding window without ever revisiting the full sample.
+    """
+    def __init__(self, width):
+        self.count = 0
+        self.mean = np.zeros(width)
+        self.m2 = np.zeros(width)
+
+    def push(self, values):
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+        return
+
+    def pop(self, values):
+        if self.count <= 1:
+            self.count = 0
+            self.mean[:] = 0.
+            self.m2[:] = 0.
+            return
+        self.count -= 1
+        delta = values - self.mean
+        self.mean -= delta / self.count
+        self.m2 -= delta * (values - self.mean)
+        return
+
+    def variance(self):
+        return self.m2 / (self.count - 1)
+
+
 class _Chain(object):
-    def __init__(self, walkers, outfile, cold_heat, hot_heat):
+    def __init__(self, walkers, outfile, cold_heat, hot_heat, capacity=1000, r_seed=None):
         self.walkers = walkers
         self.outfile = outfile
+        self.rand_gen = np.random.default_rng(r_seed)  # Draws the proposals for every walker in the chain
 
         with open(self.outfile, "w") as ofile:
             heading = "Gen\t"
@@ -191,6 +352,52 @@ class _Chain(object):
         self.hot_heat = hot_heat
         self.step_counter = 0
         self.best_score_ever_seen = 0.
+        self.new_results = ""  # Output rows written since the last checkpoint
+        self.best_sample = None  # [score, values] of the earliest, highest scoring row in the output file
+
+        # Keep the samples in memory as well, with running stats over everything after the first 10% (burn in)
+        num_vars = len(walkers[0].variables)
+        self.samples = np.zeros((max(int(capacity), 1), num_vars))
+        self.num_samples = 0
+        self.burn_in_indx = 0
+        self.sample_stats = _RunningStats(num_vars)
+
+    def draw_proposals(self):
+        """
+        Draw new values for every variable of every walker in the chain at once. Lava walkers get a uniform draw over
+        each variable's full range, everyone else gets a normal draw around their current values (scaled by heat).
+        :return: list of proposed values for each walker (in walker order)
+        """
+        variables = [walker.variables for walker in self.walkers]
+        mins = np.array([[var.min for var in walker_vars] for walker_vars in variables], dtype=float)
+        maxs = np.array([[var.max for var in walker_vars] for walker_vars in variables], dtype=float)
+        current = np.array([[var.current_value for var in walker_vars] for walker_vars in variables], dtype=float)
+        heats = np.array([[walker.heat] for walker in self.walkers])
+        lava = np.array([[walker.lava] for walker in self.walkers])
+
+        gauss = self.rand_gen.normal(current, (maxs - mins) * heats)
+        uniform = mins + self.rand_gen.random(current.shape) * (maxs - mins)
+        draws = np.round(np.where(lava, uniform, _reflect(gauss, mins, maxs)), 12).tolist()
+
+        for walker, walker_draws in zip(self.walkers, draws):
+            for variable, draw_value in zip(walker.variables, walker_draws):
+                variable.draw_value = draw_value
+                if walker.lava:
+                    variable.current_value = draw_value
+                else:
+                    variable.history["draws"].append(draw_value)
+        return draws
+
+    def score_std(self):
+        """
+        Standard deviation across the score histories of all walkers in the chain, pooled from each walker's running
+        stats (the same value a normal fit over every score would give)
+        """
+        stats = [walker.score_stats for walker in self.walkers]
+        count = sum([stat.count for stat in stats])
+        mean = sum([stat.count * stat.mean[0] for stat in stats]) / count
+        m2 = sum([stat.m2[0] + stat.count * (stat.mean[0] - mean) ** 2 for stat in stats])
+        return float(np.sqrt(max(m2, 0.) / count))
 
     def swap_hot_cold(self):
         # Swap any hot chain into the cold chain position if the hot chain score is better than the cold chain score
@@ -239,6 +446,21 @@ class _Chain(object):
         results = pd.read_csv(self.outfile)
         return results
 
+    def add_sample(self, values, score=None):
+        if score is not None and (self.best_sample is None or score > self.best_sample[0]):
+            self.best_sample = [score, list(values)]
+        if self.num_samples == len(self.samples):
+            self.samples = np.concatenate([self.samples, np.zeros(self.samples.shape)])
+        self.samples[self.num_samples] = values
+        self.num_samples += 1
+        self.sample_stats.push(self.samples[self.num_samples - 1])
+
+        # Slide the burn in forward, so it always covers the first 10% of samples
+        while self.burn_in_indx < round(self.num_samples * 0.1):
+            self.sample_stats.pop(self.samples[self.burn_in_indx])
+            self.burn_in_indx += 1
+        return
+
     def write_sample(self):
         output = "%s\t" % self.step_counter
         cold_walker = self.get_cold_walker()
@@ -247,25 +469,256 @@ class _Chain(object):
         output += "%s\n" % cold_walker.current_score
         with open(self.outfile, "a") as ofile:
             ofile.write(output)
+        self.new_results += output
+        self.add_sample([var.current_value for var in cold_walker.variables], cold_walker.current_score)
         return
 
     def _dump_obj(self):
+        """
+        Checkpoint the chain. Note that output rows are only handed over once; each dump carries the rows written
+        since the previous dump.
+        """
         walkers = [walker._dump_obj() for walker in self.walkers]
-        with open(self.outfile, "r") as ifile:
-            results = ifile.read()
+        results = self.new_results
+        self.new_results = ""
         return {"walkers": walkers, "cold_heat": self.cold_heat, "hot_heat": self.hot_heat,
-                "step_count": self.step_counter, "best_score": self.best_score_ever_seen, "results": results}
+                "step_count": self.step_counter, "best_score": self.best_score_ever_seen, "results": results,
+                "rand_state": self.rand_gen.bit_generator.state}
 
     def _apply_dump(self, var_dict):
+        """
+        Replay a checkpoint from _dump_obj() on top of the current state (dumps must be applied in order)
+        """
         for indx, walker in enumerate(self.walkers):
             walker._apply_dump(var_dict["walkers"][indx])
         self.cold_heat = var_dict["cold_heat"]
         self.hot_heat = var_dict["hot_heat"]
         self.step_counter = var_dict["step_count"]
         self.best_score_ever_seen = var_dict["best_score"]
-        with open(self.outfile, "w") as ofile:
+        self.rand_gen.bit_generator.state = var_dict["rand_state"]
+        with open(self.outfile, "a") as ofile:
             ofile.write(var_dict["results"])
 
+        for line in var_dict["results"].strip().split("\n"):
+            if line:
+                line = [float(value) for value in line.split("\t")[1:]]
+                self.add_sample(line[:-1], line[-1])
+        return
+
+
+class _ScoreCache(object):
+    """
+    Bounded, least-recently-used map of {memo key: score}. Lives in the parent process so it is shared by every walker
+    in every chain.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :param key: Hashable memo key
+        :return: The cached score, or None if the key has not been scored (or has been evicted)
+        """
+        if key not in self.scores:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.scores.move_to_end(key)
+        return self.scores[key]
+
+    def put(self, key, score):
+        if self.max_size <= 0:
+            return
+        self.scores[key] = score
+        self.scores.move_to_end(key)
+        while len(self.scores) > self.max_size:
+            self.scores.popitem(last=False)
+        return
+
+    def __len__(self):
+        return len(self.scores)
+
+
+class PartitionStability(object):
+    """
+    Convergence callback for objectives that are piecewise constant over some discrete structure, like the partitions
+    MCL produces from different parameter values. The memo keys from MCMCMC(memo_key=...) are used to identify each
+    structure, so one must be provided. Convergence is reported once neither the best key nor the set of keys the
+    cold walkers have landed on has changed for `steps` consecutive steps.
+    """
+    def __init__(self, steps=100):
+        self.steps = steps
+        self.best_key = None
+        self.cold_keys = set()
+        self.stable_steps = 0
+
+    def __call__(self, mc_obj):
+        cold_keys = set([chain.get_cold_walker().current_key for chain in mc_obj.chains])
+        if mc_obj.best_key is None or None in cold_keys:
+            self.stable_steps = 0
+            return False
+
+        if mc_obj.best_key != self.best_key or not cold_keys.issubset(self.cold_keys):
+            self.best_key = mc_obj.best_key
+            self.cold_keys.update(cold_keys)
+            self.stable_steps = 0
+        else:
+            self.stable_steps += 1
+        return self.stable_steps >= self.steps
+
+
+WALKER_STOP = "stop"  # Sent down walker pipes by _WalkerPool.shutdown(). Never a score, so it can't pass for a miss
+
+
+class _WalkerPool(object):
+    """
+    Long-lived processes that score walker proposals. One process is forked per walker when the pool starts, so the
+    objective function and its params are inherited once and stay warm for every step of the run. Each process is fed
+    (walker name, proposal) messages over its own pipe and sends the score straight back down the same pipe.
+    Note that the processes are not daemonic, because objective functions are allowed to spin off their own children.
+
+    If a key_func and cache are provided, each process first reduces its proposal to a memo key and sends that up to
+    the parent. The parent answers from the cache, or tells the process to go ahead and score the proposal. If another
+    walker is already scoring the same key, the process is held until that score comes back instead of repeating work.
+    Keys are also recorded as walker.proposed_key. A cache with max_size=0 never answers, so keys can be tracked without
+    skipping any calls to the objective.
+    """
+    def __init__(self, walkers, step_func, key_func=None, cache=None):
+        self.walkers = OrderedDict([(walker.name, walker) for walker in walkers])
+        self.step_func = step_func
+        self.key_func = key_func
+        self.cache = cache
+        self.connections = OrderedDict()
+        self.processes = OrderedDict()
+        self.pending = []
+        self.in_flight = OrderedDict()  # {memo key: [walker names waiting on it]}, first name is doing the scoring
+        self.walker_keys = OrderedDict()  # {walker name: memo key}
+
+    def _worker_loop(self, walker, conn):
+        # Drop the parent-side pipes inherited from processes forked earlier
+        for inherited_conn in self.connections.values():
+            inherited_conn.close()
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, KeyboardInterrupt):
+                break
+            if message == WALKER_STOP:
+                break
+            name, func_args = message
+            try:
+                if self.key_func:
+                    conn.send((name, "key", self.key_func(walker, [func_args])))
+                    score = conn.recv()
+                    if score == WALKER_STOP:  # Shut down while waiting on the key lookup
+                        break
+                    if score is None:  # Cache miss
+                        score = self.step_func(walker, [func_args])
+                else:
+                    score = self.step_func(walker, [func_args])
+                conn.send((name, "score", score))
+            except Exception:
+                conn.send((name, "error", traceback.format_exc()))
+        conn.close()
+        return
+
+    def start(self):
+        for name, walker in self.walkers.items():
+            parent_conn, child_conn = Pipe()
+            p = Process(target=self._worker_loop, args=(walker, child_conn))
+            p.start()
+            child_conn.close()
+            self.connections[name] = parent_conn
+            self.processes[name] = p
+        return
+
+    def submit(self, walker, func_args):
+        self.connections[walker.name].send((walker.name, func_args))
+        self.pending.append(walker.name)
+        return
+
+    def wait(self):
+        """
+        Sleep until every submitted proposal has been scored, collecting results in whatever order they finish
+        :return: OrderedDict of {walker name: score}
+        """
+        scores = OrderedDict()
+        while self.pending:
+            scores.update(self.collect())
+        return scores
+
+    def collect(self):
+        """
+        Sleep until at least one submitted proposal has been scored, and return everything that is ready
+        :return: OrderedDict of {walker name: score}
+        """
+        scores = OrderedDict()
+        while self.pending and not scores:
+            for conn in wait([self.connections[name] for name in self.pending]):
+                name, kind, value = conn.recv()
+                if kind == "error":
+                    raise RuntimeError("Walker %s failed while scoring a proposal:\n%s" % (name, value))
+                elif kind == "key":
+                    self.walkers[name].proposed_key = value
+                    self._lookup(name, value)
+                else:
+                    self.pending.remove(name)
+                    scores[name] = value
+                    if name in self.walker_keys:
+                        # Store the score and release any walkers that were held on the same key
+                        key = self.walker_keys.pop(name)
+                        self.cache.put(key, value)
+                        for waiting in self.in_flight.pop(key)[1:]:
+                            self.connections[waiting].send(value)
+        return scores
+
+    def _lookup(self, name, key):
+        """
+        Answer a walker process that has sent up the memo key for its proposal
+        :param name: Walker name
+        :param key: Memo key
+        :return: None
+        """
+        if self.cache.max_size <= 0:  # Tracking keys only
+            self.connections[name].send(None)
+            return
+
+        score = self.cache.get(key)
+        if score is not None:
+            self.connections[name].send(score)
+        elif key in self.in_flight:
+            self.in_flight[key].append(name)
+        else:
+            self.in_flight[key] = [name]
+            self.walker_keys[name] = key
+            self.connections[name].send(None)
+        return
+
+    def shutdown(self):
+        for name, conn in self.connections.items():
+            try:
+                conn.send(WALKER_STOP)
+            except (BrokenPipeError, OSError):
+                pass
+        for name, p in self.processes.items():
+            p.join(timeout=5)
+            if p.is_alive():  # Stuck part way through a proposal
+                p.terminate()
+                p.join()
+            self.connections[name].close()
+        self.connections = OrderedDict()
+        self.processes = OrderedDict()
+        self.pending = []
+        self.in_flight = OrderedDict()
+        self.walker_keys = OrderedDict()
+        return
+
+
+DUMP_VERSION = 2  # Bump whenever the checkpoint records written by MCMCMC._checkpoint() change shape
+
 
 class MCMCMC:
     """
@@ -273,7 +726,8 @@ class MCMCMC:
     """
     def __init__(self, variables, func, params=None, steps=0, sample_rate=1, num_walkers=3, num_chains=3, quiet=False,
                  include_lava=False, include_ice=False, outfile_root='./chain', burn_in=100, r_seed=None,
-                 convergence=1.05, cold_heat=0.3, hot_heat=0.75, min_max=()):
+                 convergence=1.05, cold_heat=0.3, hot_heat=0.75, min_max=(), checkpoint_steps=10, checkpoint_secs=0,
+                 memo_key=None, memo_size=1000, max_lag=0, convergence_callback=None, spill_history=False):
         self.global_variables = variables
         self.steps = steps
         self.sample_rate = sample_rate
@@ -289,26 +743,36 @@ class MCMCMC:
             walkers = []
             for j in range(num_walkers):
                 walker = _Walker(deepcopy(self.global_variables), func, self.hot_heat, params=params,
-                                 quiet=quiet, r_seed=self.rand_gen.randint(1, 999999999999999), min_max=min_max)
+                                 quiet=quiet, r_seed=self.rand_gen.randint(1, 999999999999999), min_max=min_max,
+                                 memo_key=memo_key)
                 for variable in walker.variables:
-                    variable.rand_gen.seed(self.rand_gen.randint(1, 999999999999999))
+                    variable.rand_gen = np.random.default_rng(self.rand_gen.randint(1, 999999999999999))
                 walkers.append(walker)
             # Set a cold walker
             walkers[0].set_heat(self.cold_heat)
 
             if include_lava:
                 walker = _Walker(deepcopy(self.global_variables), func, 1.0, params=params, lava=True,
-                                 quiet=quiet, r_seed=self.rand_gen.randint(1, 999999999999999), min_max=min_max)
+                                 quiet=quiet, r_seed=self.rand_gen.randint(1, 999999999999999), min_max=min_max,
+                                 memo_key=memo_key)
                 for variable in walker.variables:
-                    variable.rand_gen.seed(self.rand_gen.randint(1, 999999999999999))
+                    variable.rand_gen = np.random.default_rng(self.rand_gen.randint(1, 999999999999999))
                 walkers.append(walker)
             if include_ice:
                 walker = _Walker(deepcopy(self.global_variables), func, 0.05, params=params, ice=True,
-                                 quiet=quiet, r_seed=self.rand_gen.randint(1, 999999999999999), min_max=min_max)
+                                 quiet=quiet, r_seed=self.rand_gen.randint(1, 999999999999999), min_max=min_max,
+                                 memo_key=memo_key)
                 for variable in walker.variables:
-                    variable.rand_gen.seed(self.rand_gen.randint(1, 999999999999999))
+                    variable.rand_gen = np.random.default_rng(self.rand_gen.randint(1, 999999999999999))
                 walkers.append(walker)
-            chain = _Chain(walkers, "%s_%s.csv" % (self.outfile_root, i + 1), self.cold_heat, self.hot_heat)
+            chain = _Chain(walkers, "%s_%s.csv" % (self.outfile_root, i + 1), self.cold_heat, self.hot_heat,
+                           capacity=steps + 1 if steps else 1000, r_seed=self.rand_gen.randint(1, 999999999999999))
+            if spill_history:
+                # Histories only hold the most recent values in memory, so write older values out next to the chain
+                for j, walker in enumerate(walkers):
+                    walker.score_history.spill_file = "%s_%s_%s_score.txt" % (self.outfile_root, i + 1, j + 1)
+                    for variable in walker.variables:
+                        variable.spill_history("%s_%s_%s_%s" % (self.outfile_root, i + 1, j + 1, variable.name))
             self.chains.append(chain)
         self.best = OrderedDict([("score", None), ("variables", OrderedDict([(x.name, None) for x in variables]))])
         self.burn_in = burn_in
@@ -318,42 +782,106 @@ class MCMCMC:
             raise ValueError("Gelman-Rubin convergence ratio must be greater than 1")
         self.quiet = quiet
 
+        # Checkpoints are appended to self.dumpfile every `checkpoint_steps` steps and/or `checkpoint_secs` seconds
+        # (whichever comes first). Set both to 0 to turn checkpointing off.
+        self.checkpoint_steps = checkpoint_steps
+        self.checkpoint_secs = checkpoint_secs
+        self.counter = 0
+        self._log_started = False
+
+        # Optional memoization. memo_key(func_args[, params]) must return a hashable key that captures everything the
+        # score depends on (i.e., ignore the random seed appended to func_args), so that proposals sharing a key can
+        # reuse the same score. Up to `memo_size` scores are kept, shared across all walkers and chains (memo_size=0
+        # still tracks keys, but never reuses a score).
+        self.score_cache = _ScoreCache(memo_size) if memo_key else None
+        self.best_key = None
+
+        # Optional extra stopping rule, called as convergence_callback(self) each time the slowest chain completes a
+        # step. The run ends when either the callback or the Gelman-Rubin test reports convergence.
+        self.convergence_callback = convergence_callback
+
+        # How many steps any chain is allowed to run ahead of the slowest chain (0 keeps all chains in lock-step)
+        if max_lag < 0:
+            raise ValueError("max_lag must be zero or a positive integer")
+        self.max_lag = int(max_lag)
+
+    def _checkpoint(self, counter):
+        """
+        Append a single record to the checkpoint log. Records only carry what changed since the previous record (new
+        output rows and variable history), plus the walker states and random generator states needed to pick up
+        exactly where the run left off.
+        """
+        record = {"version": DUMP_VERSION, "counter": counter, "rand_state": self.rand_gen.getstate(),
+                  "best": self.best, "best_key": self.best_key, "chains": [chain._dump_obj() for chain in self.chains]}
+        with open(self.dumpfile, "ab") as ofile:
+            dill.dump(record, ofile, protocol=-1)
+        return
+
     def resume(self):
-        if os.path.isfile(self.dumpfile):
-            with open(self.dumpfile, "br") as ifile:
-                # dump_file output = [chain1, chain2, etc...]
-                dump_file = dill.load(ifile)
-            for indx, chain in enumerate(self.chains):
-                chain._apply_dump(dump_file[indx])
-            self.run()
-            return True
-        return False
+        """
+        Replay the checkpoint log in order, then continue the run from the last complete record. Dumpfiles written
+        by older versions (a single pickled list of chains, or records without the current DUMP_VERSION) can't be
+        replayed, so they are ignored with a warning and the run starts over.
+        :return: True if a run was resumed, False if there was nothing to resume from
+        """
+        if not os.path.isfile(self.dumpfile):
+            return False
+
+        num_records = 0
+        good_bytes = 0
+        with open(self.dumpfile, "br") as ifile:
+            while True:
+                try:
+                    record = dill.load(ifile)
+                except (EOFError, dill.UnpicklingError):
+                    break  # A crash mid-write can leave a partial record at the end of the log
+                if not isinstance(record, dict) or record.get("version") != DUMP_VERSION:
+                    warnings.warn("Checkpoint records in %s are from an older version of mcmcmc and can't be "
+                                  "resumed from, so %s" % (self.dumpfile, "the run is starting over" if not num_records
+                                                           else "only the first %s are used" % num_records),
+                                  RuntimeWarning)
+                    break
+                for indx, chain in enumerate(self.chains):
+                    chain._apply_dump(record["chains"][indx])
+                self.rand_gen.setstate(record["rand_state"])
+                self.best = record["best"]
+                self.best_key = record["best_key"]
+                self.counter = record["counter"]
+                good_bytes = ifile.tell()
+                num_records += 1
+
+        if not num_records:
+            return False
+
+        # Chop off anything after the last good record so new checkpoints can be appended cleanly
+        with open(self.dumpfile, "r+b") as ofile:
+            ofile.truncate(good_bytes)
+        self._log_started = True
+        self.run()
+        return True
 
     @staticmethod
     def mc_step_run(walker, args):
         func_args = args[0]
         score = walker.function(func_args) if not walker.params else walker.function(func_args, walker.params)
-        with open(walker.proposed_score_file.path, "w") as ofile:
-            ofile.write(str(score))
-        return
+        return score
+
+    @staticmethod
+    def mc_step_key(walker, args):
+        func_args = args[0]
+        key = walker.memo_key(func_args) if not walker.params else walker.memo_key(func_args, walker.params)
+        return key
 
     @staticmethod
     def step_parse(walker, std):
         """
         Implements Metropolis-Hastings. Increment a Walker by assessing a score proposal and either accepting or
         rejecting it.
-        :param walker: Walker object
+        :param walker: Walker object, with proposed_score already set from the walker pool
         :param std: Fit all walker score history (from a single chain) to a normal distribution and use its std dev.
         :return:
         """
-        with open(walker.proposed_score_file.path, "r") as ifile:
-            walker.proposed_score = float(ifile.read())
-
-        # Don't keep the entire history when determining min
-        if len(walker.score_history) >= 1000:
-            walker.score_history.pop(0)
-
-        walker.score_history.append(walker.proposed_score)
+        walker.record_score(walker.proposed_score)
 
         # If the score hasn't been set or the new score is better, the step is accepted
         if walker.current_score is None or walker.proposed_score >= walker.current_score or walker.lava:
@@ -368,63 +896,116 @@ class MCMCMC:
                 walker.accept()
         return
 
+    def _propose_step(self, chain, pool):
+        """
+        Draw new proposals for every walker in a chain and send them off to be scored
+        :param chain: _Chain object
+        :param pool: Started _WalkerPool
+        :return: None
+        """
+        for walker, func_args in zip(chain.walkers, chain.draw_proposals()):
+            # Always add a new seed for the target function
+            func_args.append(self.rand_gen.randint(1, 999999999999999))
+            pool.submit(walker, func_args)
+        return
+
+    def _finish_step(self, chain, scores, step):
+        """
+        Accept or reject every walker's scored proposal, then swap hot/cold walkers and record a sample
+        :param chain: _Chain object
+        :param scores: {walker name: score} for all walkers in the chain
+        :param step: The step number the chain has just completed
+        :return: None
+        """
+        # Get the normalized standard deviation among all historical walker scores for this chain
+        std = chain.score_std()
+        for walker in chain.walkers:
+            walker.proposed_score = float(scores[walker.name])
+            self.step_parse(walker, std)
+            if self.best["score"] is None or walker.current_score > self.best["score"]:
+                self.best["score"] = walker.current_score
+                self.best["variables"] = OrderedDict([(x.name, x.current_value) for x in walker.variables])
+                self.best_key = walker.current_key
+
+        chain.swap_hot_cold()
+        # Send output to files
+        if step % self.sample_rate == 0:
+            chain.step_counter += 1
+            chain.write_sample()
+        return
+
     def run(self):
         """
+        Each chain steps as soon as all of its own walkers have been scored, but is not allowed to get more than
+        `max_lag` steps ahead of the slowest chain. Convergence and checkpoints are assessed every time the slowest
+        chain completes a step. With max_lag=0 (default) every chain waits on every other chain, and runs are
+        reproducible from r_seed. With max_lag > 0 the chains no longer stay in lock-step, so the order that random
+        seeds are handed out (and therefore the exact result) depends on how long each proposal takes to score, and
+        a resumed run will redraw any proposals that were still being scored at the last checkpoint.
+
         NOTE: Gibbs sampling is a way of selecting variables one at a time instead of all at once. This is beneficial in
         high dimensional variable space because it will increase the probability of accepting a new sample. It isn't
         implemented here, but it might be worth keeping in mind.
         """
-        counter = 0
-        while not self._check_convergence() and (counter <= self.steps or self.steps == 0):
-            tmp_dump = self.dumpfile + ".temp"
-            with open(tmp_dump, "wb") as ofile:
-                dump_obj = [chain._dump_obj() for chain in self.chains]
-                dill.dump(dump_obj, ofile, protocol=-1)
-            shutil.move(tmp_dump, self.dumpfile)
-            counter += 1
-            child_list = OrderedDict()
-            for chain in self.chains:  # Note that this will spin off (c * w) new processes, where c=chains, w=walkers
-                for walker in chain.walkers:
-                    # Start new process
-                    func_args = []
-                    for variable in walker.variables:
-                        if walker.lava:
-                            variable.draw_random()
-                        else:
-                            variable.draw_new_value(walker.heat)
-                        func_args.append(variable.draw_value)
-
-                    # Always add a new seed for the target function
-                    func_args.append(self.rand_gen.randint(1, 999999999999999))
-                    p = Process(target=self.mc_step_run, args=(walker, [func_args]))
-                    p.start()
-                    child_list[walker.name] = p
-
-            # wait for remaining processes to complete
-            while len(child_list) > 0:
-                for _name, child in child_list.items():
-                    if child.is_alive():
-                        continue
-                    else:
-                        del child_list[_name]
-                        break
-
-            for chain in self.chains:
-                # Get the normalized standard deviation among all historical walker scores for this chain
-                history_series = pd.Series([score for walker in chain.walkers for score in walker.score_history])
-                mu, std = norm.fit(history_series)
-                for walker in chain.walkers:
-                    self.step_parse(walker, std)
-                    if self.best["score"] is None or walker.current_score > self.best["score"]:
-                        self.best["score"] = walker.current_score
-                        self.best["variables"] = OrderedDict([(x.name, x.current_value) for x in walker.variables])
-
-            for chain in self.chains:
-                chain.swap_hot_cold()
-                # Send output to files
-                if counter % self.sample_rate == 0:
-                    chain.step_counter += 1
-                    chain.write_sample()
+        checkpointing = bool(self.checkpoint_steps or self.checkpoint_secs)
+        if checkpointing and not self._log_started:
+            # Start a fresh checkpoint log (resume() sets _log_started so an existing log is appended to instead)
+            open(self.dumpfile, "wb").close()
+            self._log_started = True
+
+        counter = self.counter  # Steps completed by the slowest chain
+        chain_steps = [counter for _ in self.chains]  # Steps completed by each chain
+        walker_chains = {walker.name: indx for indx, chain in enumerate(self.chains) for walker in chain.walkers}
+        outstanding = OrderedDict()  # {chain index: {walker name: score}} for chains waiting on scores
+        last_checkpoint = None  # (counter, time) of the most recent checkpoint
+        assess = True
+        stopping = False
+        # Note that this will spin off (c * w) persistent processes, where c=chains, w=walkers
+        pool = _WalkerPool([walker for chain in self.chains for walker in chain.walkers], self.mc_step_run,
+                           key_func=self.mc_step_key if self.score_cache is not None else None,
+                           cache=self.score_cache)
+        pool.start()
+        try:
+            while True:
+                if assess and not stopping:
+                    assess = False
+                    counter = min(chain_steps)
+                    self.counter = counter
+                    if self._check_convergence() or (self.steps and counter > self.steps) or \
+                            (self.convergence_callback and self.convergence_callback(self)):
+                        stopping = True
+                    elif checkpointing and (last_checkpoint is None or
+                                            (self.checkpoint_steps and
+                                             counter - last_checkpoint[0] >= self.checkpoint_steps) or
+                                            (self.checkpoint_secs and
+                                             time() - last_checkpoint[1] >= self.checkpoint_secs)):
+                        self._checkpoint(counter)
+                        last_checkpoint = (counter, time())
+
+                if not stopping:
+                    for indx, chain in enumerate(self.chains):
+                        if indx not in outstanding and chain_steps[indx] - counter <= self.max_lag and \
+                                (not self.steps or chain_steps[indx] <= self.steps):
+                            self._propose_step(chain, pool)
+                            outstanding[indx] = OrderedDict()
+
+                if not outstanding:
+                    break
+
+                # In lock-step mode wait for everything, otherwise pick up scores as they come in
+                scores = pool.wait() if not self.max_lag else pool.collect()
+                for name, score in scores.items():
+                    outstanding[walker_chains[name]][name] = score
+
+                for indx, chain in enumerate(self.chains):
+                    if indx in outstanding and len(outstanding[indx]) == len(chain.walkers):
+                        chain_steps[indx] += 1
+                        self._finish_step(chain, outstanding.pop(indx), chain_steps[indx])
+                if min(chain_steps) > counter:
+                    assess = True
+            self.counter = min(chain_steps)
+        finally:
+            pool.shutdown()
         return
 
     def _check_convergence(self):
@@ -435,62 +1016,59 @@ class MCMCMC:
             3) Calculate between-chain variance for each scalar
             4) Compute 'potential scale reduction factor' (PSRF) for each scalar --> aiming for < 1.1 for everything
 
+        Each chain maintains running stats over its post burn-in samples (see _Chain.add_sample()), so this only
+        costs O(chains * variables) instead of re-reading every sample from disk.
+
         :return: True or False
         """
         if self.chains[0].step_counter < 100:
             return False
 
-        data = [pd.read_csv(chain.outfile, sep="\t") for chain in self.chains]
-        # 1) Strip out 10% burn in
-        start_indx = round(len(data[0]) * 0.1)
-        data = [x.iloc[start_indx:, :] for x in data]
+        stats = [chain.sample_stats for chain in self.chains]
+        num_vars = len(stats[0].mean)
 
         # 2) Calculate within-chain variance for each scalar
-        within_variance = OrderedDict()
-        for df in data:
-            scalars = df.drop(["Gen", "result"], axis=1)
-            for name, series in scalars.items():
-                mean = series.mean()
-                series_mean_sqr = (series - mean) ** 2
-                variance = series_mean_sqr.sum()/(len(series_mean_sqr) - 1)
-                within_variance.setdefault(name, 0.0000001)
-                within_variance[name] += variance / len(scalars.columns)
-
-        for name, variance in within_variance.items():
-            within_variance[name] /= len(data)
+        within_variance = 0.0000001 + sum([stat.variance() for stat in stats]) / num_vars
+        within_variance /= len(stats)
 
         # 3) Calculate between-chain variance for each scalar
-        between_variance = OrderedDict()
+        # Note that the sum of squares of chain_i around the mean of chain_j is M2_i + n_i * (mean_i - mean_j)^2
+        between_variance = np.zeros(num_vars)
         counter = 0
-        for i, chain_i in enumerate(data[:-1]):
-            scalars_i = chain_i.drop(["Gen", "result"], axis=1)
-            for j, chain_j in enumerate(data[i+1:]):
+        for i, stat_i in enumerate(stats[:-1]):
+            for stat_j in stats[i + 1:]:
                 counter += 2  # Between-variances will be added in both directions
-                scalars_j = chain_j.drop(["Gen", "result"], axis=1)
-                for name, series_i in scalars_i.items():
-                    mean_i = series_i.mean()
-                    mean_j = scalars_j[name].mean()
-
-                    series_mean_sqr_i = (series_i - mean_j) ** 2
-                    variance_i = series_mean_sqr_i.sum()/(len(series_mean_sqr_i) - 1)
-                    between_variance.setdefault(name, 0)
-                    between_variance[name] += variance_i / len(scalars_i.columns)
-
-                    series_mean_sqr_j = (scalars_j[name] - mean_i) ** 2
-                    variance_j = series_mean_sqr_j.sum()/(len(series_mean_sqr_j) - 1)
-                    between_variance[name] += variance_j / len(scalars_j.columns)
+                mean_sqr_diff = (stat_i.mean - stat_j.mean) ** 2
+                variance_i = (stat_i.m2 + stat_i.count * mean_sqr_diff) / (stat_i.count - 1)
+                variance_j = (stat_j.m2 + stat_j.count * mean_sqr_diff) / (stat_j.count - 1)
+                between_variance += (variance_i + variance_j) / num_vars
 
-        for name, variance in between_variance.items():
-            between_variance[name] /= counter
+        if not counter:
+            return True
+        between_variance /= counter
 
         # 4) Compute 'potential scale reduction factor' (PSRF) for each scalar
-        n = len(data[0].columns)
-        for name, b in between_variance.items():
-            w = within_variance[name]
-            psrf = (((n - 1) / n) + (b / (n * w))) ** (1/2)
-            if psrf >= self.convergence:
-                return False
-        return True  # If all PSRFs are below 1.1, time to call it quits
+        n = num_vars + 2  # Columns in the chain output files (Gen, variables, result)
+        psrf = (((n - 1) / n) + (between_variance / (n * within_variance))) ** (1/2)
+        return bool(np.all(psrf < self.convergence))  # If all PSRFs are below 1.1, time to call it quits
+
+    def best_sample(self):
+        """
+        The best sample recorded in the chain output files (cold walkers only), i.e., the highest 'result' in any
+        chain's csv. Ties go to the earliest row of the first chain to reach the score. This can be lower than
+        self.best, which also counts hot walkers.
+        :return: OrderedDict([("score", float), ("variables", OrderedDict([(name, value), ...]))]), or None before the
+        first sample is recorded
+        """
+        best = None
+        for chain in self.chains:
+            if chain.best_sample is not None and (best is None or chain.best_sample[0] > best[0]):
+                best = chain.best_sample
+        if best is None:
+            return None
+        return OrderedDict([("score", best[0]),
+                            ("variables", OrderedDict([(var.name, value) for var, value in
+                                                       zip(self.global_variables, best[1])]))])
 
     def reset_params(self, params):
         """
@@ -7,7 +7,10 @@ DESCRIPTION OF PROGRAM
 """
 
 import os
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from multiprocessing import Process
+from threading import Thread
 from time import time, sleep
 from buddysuite.buddy_resources import DynamicPrint, TempFile, CustomHelpFormatter
 
@@ -19,17 +22,163 @@ except ImportError:
 VERSION = helpers.VERSION
 VERSION.name = "monitor_dbs"
 
+# (name, help text, stats key) for everything exported in Prometheus text format. Keys holding a dict are exported
+# with one labelled sample per item.
+METRICS = [("rdmcl_masters", "Masters with a heartbeat", "masters"),
+           ("rdmcl_workers", "Workers with a heartbeat", "workers"),
+           ("rdmcl_heartbeat_age_seconds", "Mean time since the last heartbeat", "heartbeat_age"),
+           ("rdmcl_queue_jobs", "Jobs waiting in the queue", "queue"),
+           ("rdmcl_processing_jobs", "Jobs being worked on", "processing"),
+           ("rdmcl_complete_jobs", "Finished jobs not yet picked up by a master", "complete"),
+           ("rdmcl_proc_comp_jobs", "Finished jobs being read in by a master", "proc_comp"),
+           ("rdmcl_waiting_hashes", "Jobs that masters are waiting on", "waiting_hashes"),
+           ("rdmcl_waiting_masters", "Masters waiting on jobs", "waiting_masters"),
+           ("rdmcl_queue_wait_seconds", "Time that queued jobs have been waiting", "queue_wait"),
+           ("rdmcl_lock_wait_seconds", "Time spent waiting on writers to read each database", "lock_wait"),
+           ("rdmcl_worker_idle_percent", "Share of workers without a job", "idle_percent"),
+           ("rdmcl_worker_throughput", "Scoring rate of each worker (pairs * alignment columns / sec)", "throughput")]
+LABELS = {"heartbeat_age": "thread_type", "queue": "kind", "processing": "kind", "queue_wait": "stat",
+          "lock_wait": "db", "throughput": "worker_id"}
+
+
+def prometheus_metrics(stats):
+    """
+    :param stats: Output from Monitor.snapshot()
+    :return: Metrics in Prometheus text format (anything missing from stats is left out)
+    """
+    output = ""
+    for name, help_text, key in METRICS:
+        if key not in stats:
+            continue
+        output += "# HELP %s %s\n# TYPE %s gauge\n" % (name, help_text, name)
+        if isinstance(stats[key], dict):
+            for label, value in stats[key].items():
+                output += '%s{%s="%s"} %s\n' % (name, LABELS[key], label, value)
+        else:
+            output += "%s %s\n" % (name, stats[key])
+    return output
+
 
 class Monitor(object):
-    def __init__(self, hbdb_path, wdb_path):
+    def __init__(self, hbdb_path, wdb_path, exclusive=False, metrics_file=None, http_port=None):
+        """
+        :param hbdb_path: heartbeat_db.sqlite
+        :param wdb_path: work_db.sqlite
+        :param exclusive: Read with ExclusiveConnect instead of read-only snapshots (blocks workers and masters)
+        :param metrics_file: Keep this file updated with metrics in Prometheus text format
+        :param http_port: Also serve the metrics from http://127.0.0.1:<port>/metrics
+        """
         self.hbdb_path = hbdb_path
         self.wdb_path = wdb_path
+        self.exclusive = exclusive
+        self.metrics_file = metrics_file
+        self.http_port = http_port
+        self.metrics = ""
+
+    def snapshot(self):
+        """
+        Read the current state of the worker databases
+        :return: OrderedDict of stats ('queue_wait' and 'throughput' are only there if the work db has been migrated)
+        """
+        connect = helpers.ExclusiveConnect if self.exclusive else helpers.SnapshotConnect
+        split_time = time()
+        with connect(self.hbdb_path) as cursor:
+            hb_lock = cursor.lag
+            heartbeat = cursor.execute("SELECT * FROM heartbeat").fetchall()
+        with connect(self.wdb_path) as cursor:
+            wdb_lock = cursor.lag
+            # Work databases that no worker has migrated yet are missing the queue times and throughput table
+            queue_columns = [row[1] for row in cursor.execute("PRAGMA table_info(queue)").fetchall()]
+            tables = [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
+            has_queued = "queued" in queue_columns
+            queue = cursor.execute("SELECT hash, %s FROM queue" % ("queued" if has_queued else "NULL")).fetchall()
+            processing = cursor.execute("SELECT hash FROM processing").fetchall()
+            complete = cursor.execute("SELECT hash FROM complete").fetchall()
+            proc_comp = cursor.execute("SELECT hash FROM proc_comp").fetchall()
+            waiting = cursor.execute("SELECT * FROM waiting").fetchall()
+            throughput = None
+            if "throughput" in tables:
+                throughput = cursor.execute("SELECT worker_id, rate FROM throughput").fetchall()
+        now = time()
+
+        stats = OrderedDict()
+        stats["heartbeat_age"] = OrderedDict()
+        for thread_type in ["master", "worker"]:
+            pulses = [hb[2] for hb in heartbeat if hb[1] == thread_type]
+            stats["%ss" % thread_type] = len(pulses)
+            stats["heartbeat_age"][thread_type] = 0 if not pulses else round(now - (sum(pulses) / len(pulses)), 1)
+
+        subqueue_len = len([None for x in queue if "_" in x[0]])
+        stats["queue"] = OrderedDict([("job", len(queue) - subqueue_len), ("subjob", subqueue_len)])
+        subprocs = [x[0] for x in processing if "_" in x[0]]
+        stats["processing"] = OrderedDict([("job", len(processing) - len(subprocs)), ("subjob", len(subprocs))])
+        stats["complete"] = len(complete)
+        stats["proc_comp"] = len(proc_comp)
+        stats["waiting_hashes"] = len(set([x[0] for x in waiting]))
+        stats["waiting_masters"] = len(set([x[1] for x in waiting]))
+
+        if has_queued:
+            waits = [now - x[1] for x in queue if x[1]]  # Jobs queued by older masters don't have a time
+            stats["queue_wait"] = OrderedDict([("max", round(max(waits), 3) if waits else 0),
+                                               ("mean", round(sum(waits) / len(waits), 3) if waits else 0)])
+        stats["lock_wait"] = OrderedDict([("heartbeat", round(hb_lock, 4)), ("work", round(wdb_lock, 4))])
+
+        # Split jobs are being worked on by one worker per subjob (same as Worker.idle_workers())
+        split_hashes = set([x.split("_")[-1] for x in subprocs])
+        active = len(subprocs) + len([x for x in processing if "_" not in x[0] and x[0] not in split_hashes])
+        idle = max(stats["workers"] - active, 0)
+        stats["idle_percent"] = round(100 * idle / stats["workers"], 2) if stats["workers"] else 0
+        if throughput is not None:
+            stats["throughput"] = OrderedDict([(worker_id, round(rate, 2)) for worker_id, rate in throughput])
+        stats["connect_time"] = round(time() - split_time, 3)
+        return stats
+
+    def export(self, stats):
+        """
+        Update the metrics served over http, and the metrics file if there is one
+        """
+        self.metrics = prometheus_metrics(stats)
+        if self.metrics_file:
+            # Replace the file in one go, so nothing reading it ever sees half an update
+            with open("%s.tmp" % self.metrics_file, "w") as ofile:
+                ofile.write(self.metrics)
+            os.replace("%s.tmp" % self.metrics_file, self.metrics_file)
+        return
+
+    def serve_metrics(self, port):
+        """
+        Serve the latest metrics on localhost from a background thread
+        :param port: Port to listen on (0 picks a free one)
+        :return: HTTPServer
+        """
+        monitor = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ["/", "/metrics"]:
+                    self.send_error(404)
+                    return
+                body = monitor.metrics.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                return  # Don't scribble over the monitor display
+
+        server = HTTPServer(("127.0.0.1", port), MetricsHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
 
     def _run(self, check_file_path):
         printer = DynamicPrint()
+        if self.http_port is not None:
+            self.serve_metrics(self.http_port)
         output = [("#Master", 9), ("AveMhb", 9), ("#Worker", 9), ("AveWhb", 9), ("#queue", 9),
                   ("#subq", 8), ("#proc", 8), ("#subp", 8), ("#comp", 8), ("#ProcComp", 10), ("#HashWait", 10),
-                  ("#IdWait", 9), ("ConnectTime", 9)]
+                  ("#IdWait", 9), ("Idle%", 8), ("ConnectTime", 9)]
 
         output = [str(x[0]).ljust(x[1]) for x in output]
         printer.write("".join(output))
@@ -40,44 +189,18 @@ class Monitor(object):
             if ifile_content != "Running":
                 break
 
-            split_time = time()
             try:
-                with helpers.ExclusiveConnect(self.hbdb_path) as cursor:
-                    heartbeat = cursor.execute("SELECT * FROM heartbeat").fetchall()
-                with helpers.ExclusiveConnect(self.wdb_path) as cursor:
-                    queue = cursor.execute("SELECT hash FROM queue").fetchall()
-                    processing = cursor.execute("SELECT hash FROM processing").fetchall()
-                    complete = cursor.execute("SELECT hash FROM complete").fetchall()
-                    proc_comp = cursor.execute("SELECT hash FROM proc_comp").fetchall()
-                    waiting = cursor.execute("SELECT * FROM waiting").fetchall()
-                connect_time = round(time() - split_time, 3)
-                master_hb = [hb[2] for hb in heartbeat if hb[1] == "master"]
-                len_mas = len(master_hb)
-                master_hb = 0 if not master_hb else round(time() - (sum(master_hb) / len(master_hb)), 1)
-                worker_hb = [hb[2] for hb in heartbeat if hb[1] == "worker"]
-                len_wor = len(worker_hb)
-                worker_hb = 0 if not worker_hb else round(time() - (sum(worker_hb) / len(worker_hb)), 1)
-
-                hash_wait = {}
-                master_wait = {}
-                for seq_hash, master_id in waiting:
-                    hash_wait.setdefault(seq_hash, 0)
-                    hash_wait[seq_hash] += 1
-                    master_wait.setdefault(master_id, 0)
-                    master_wait[master_id] += 1
-
-                subqueue_len = len([None for x in queue if "_" in x[0]])
-                queue_len = len(queue) - subqueue_len
-
-                subproc_len = len([None for x in processing if "_" in x[0]])
-                proc_len = len(processing) - subproc_len
-
-                output = [(len_mas, 9), (master_hb, 9), (len_wor, 9), (worker_hb, 9), (queue_len, 9),
-                          (subqueue_len, 8), (proc_len, 8), (subproc_len, 8), (len(complete), 8), (len(proc_comp), 10),
-                          (len(hash_wait), 10), (len(master_wait), 9), (connect_time, 9)]
+                stats = self.snapshot()
+                output = [(stats["masters"], 9), (stats["heartbeat_age"]["master"], 9), (stats["workers"], 9),
+                          (stats["heartbeat_age"]["worker"], 9), (stats["queue"]["job"], 9),
+                          (stats["queue"]["subjob"], 8), (stats["processing"]["job"], 8),
+                          (stats["processing"]["subjob"], 8), (stats["complete"], 8), (stats["proc_comp"], 10),
+                          (stats["waiting_hashes"], 10), (stats["waiting_masters"], 9), (stats["idle_percent"], 8),
+                          (stats["connect_time"], 9)]
                 output = [str(x[0]).ljust(x[1]) for x in output]
 
                 printer.write("".join(output))
+                self.export(stats)
             except helpers.sqlite3.OperationalError:
                 printer.write("Worker databases not detected")
             sleep(0.5)
@@ -116,6 +239,12 @@ def main():
 
     parser_flags.add_argument("-wdb", "--workdb", action="store", metavar="", default=os.getcwd(),
                               help="Specify the worker directory")
+    parser_flags.add_argument("-x", "--exclusive", action="store_true",
+                              help="Lock the databases while reading them (the default is read-only snapshots)")
+    parser_flags.add_argument("-m", "--metrics", action="store", metavar="",
+                              help="Write metrics to this file in Prometheus text format")
+    parser_flags.add_argument("-p", "--port", action="store", type=int, metavar="",
+                              help="Serve metrics at http://127.0.0.1:<port>/metrics")
 
     # Misc
     misc = parser.add_argument_group(title="\033[1mMisc options\033[m")
@@ -127,7 +256,8 @@ def main():
     workdb = os.path.join(in_args.workdb, "work_db.sqlite")
     heartbeatdb = os.path.join(in_args.workdb, "heartbeat_db.sqlite")
 
-    monitor = Monitor(heartbeatdb, workdb)
+    monitor = Monitor(heartbeatdb, workdb, exclusive=in_args.exclusive, metrics_file=in_args.metrics,
+                      http_port=in_args.port)
     monitor.start()
 
 
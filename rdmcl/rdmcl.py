@@ -33,16 +33,23 @@ import logging
 import time
 import argparse
 import sqlite3
-from io import StringIO
+from io import StringIO, BytesIO
 from subprocess import Popen, PIPE
-from multiprocessing import Lock, Process
+from multiprocessing import Lock, Process, Value, Array
+from threading import Thread, BoundedSemaphore, RLock, local
 from random import choice, Random, randint, random
 from math import ceil, log2
 from collections import OrderedDict
 from copy import deepcopy, copy
+from functools import partial
 # from hashlib import md5
 
 
+# Keep NumPy/BLAS single threaded unless told otherwise, so CPU use is controlled by CPU_BUDGET (see helpers.CpuBudget)
+for _var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+             "NUMEXPR_NUM_THREADS"]:
+    os.environ.setdefault(_var, "1")
+
 # 3rd party
 import pandas as pd
 import numpy as np
@@ -55,10 +62,12 @@ from Bio.SubsMat import SeqMat, MatrixInfo
 try:
     import mcmcmc
     import helpers
+    import job_server
     from install import setup
 except ImportError:
     from . import mcmcmc
     from . import helpers
+    from . import job_server
     from .install import setup
 
 from buddysuite import SeqBuddy as Sb
@@ -72,9 +81,10 @@ VERSION.name = "rdmcl"
 ALIGNMETHOD = "clustalo"
 ALIGNPARAMS = ""
 LOCK = Lock()
-MULTICORE_LOCK = Lock()
-PROGRESS_LOCK = Lock()
 CPUS = br.usable_cpu_count()
+CPU_BUDGET = helpers.CpuBudget(CPUS)  # Every parallel stage draws from this. Reset in full_run() to match -cpu
+# Keeps concurrent walkers from building the same all-by-all graph. Reset in full_run() to lock in the output directory
+ALL_BY_ALL_FLIGHTS = helpers.SingleFlight()
 TIMER = helpers.Timer()
 MIN_SIZE_TO_WORKER = 15  # (MIN_SIZE_TO_WORKER**2 - MIN_SIZE_TO_WORKER) / 2  =  105
 GAP_OPEN = -5
@@ -85,10 +95,17 @@ GELMAN_RUBIN = 1.1
 WORKER_OUT = ""
 WORKER_DB = ""
 HEARTBEAT_DB = ""
+JOB_SERVER = ""  # Address of a job_server, used instead of WORKER_DB/HEARTBEAT_DB when -wdb is tcp:// or unix://
 MAX_WORKER_WAIT = 240
 MASTER_ID = None
+MASTER_HEARTBEAT = None  # Shared by every WorkerJob in this run, see master_heartbeat()
 MASTER_PULSE = 60
+# Seconds between work_db checks while waiting on a job, if no completion marker shows up. This is also the worst case
+# for how long an NFS attribute cache can hide a marker from the master, see helpers.wait_for_change().
+WORKER_POLL_FALLBACK = 10
 PSIPREDDIR = ""
+MCL_STASH = local()  # Most recent MCL result in this thread, shared by mcmcmc_mcl_key() and mcmcmc_mcl()
+SIBLING_SLOTS = BoundedSemaphore(0)  # Extra threads available to run_sibling_tasks(), set in full_run()
 TRIMAL = ["gappyout", 0.5, 0.75, 0.9, 0.95, "clean"]
 
 if os.path.isfile(os.path.join(SCRIPT_PATH, "hmmer", "hmm_fwd_back")):
@@ -234,6 +251,12 @@ class Cluster(object):
         self.seq_ids = set(seq_ids)
         return
 
+    def depth(self):
+        """
+        :return: How many levels of recursion down from the master cluster this cluster is
+        """
+        return 0 if not self.parent else self.parent.depth() + 1
+
     def name(self):
         """
         Get cluster name, or raise error if not yet set
@@ -691,6 +714,9 @@ psipass2 {0}{3}data{3}weights_p2.dat 1 1.0 1.0 {1}{3}{2}.ss2 {1}{3}{2}.ss > {1}{
     return result
 
 
+PSIPRED_COLUMNS = ["indx", "coil_prob", "helix_prob", "sheet_prob"]  # Everything compare_psi_pred() reads
+
+
 def read_ss2_file(path):
     ss_file = pd.read_csv(path, comment="#", header=None, delim_whitespace=True)
     ss_file.columns = ["indx", "aa", "ss", "coil_prob", "helix_prob", "sheet_prob"]
@@ -698,27 +724,80 @@ def read_ss2_file(path):
 
 
 def compare_psi_pred(psi1_df, psi2_df):
+    return compare_psi_pred_arrays(psi1_df[PSIPRED_COLUMNS].to_numpy(dtype=float),
+                                   psi2_df[PSIPRED_COLUMNS].to_numpy(dtype=float))
+
+
+def compare_psi_pred_arrays(psi1, psi2):
+    """
+    Same comparison as compare_psi_pred(), over arrays holding the PSIPRED_COLUMNS of each dataframe
+    :param psi1: numpy array, one [indx, coil_prob, helix_prob, sheet_prob] row per residue
+    :param psi2: numpy array, one [indx, coil_prob, helix_prob, sheet_prob] row per residue
+    :return: float
+    """
+    rows2 = {}
+    for row2 in psi2:
+        rows2.setdefault(row2[0], row2)
     num_extra_gaps = 0
     ss_score = 0
-    for row1 in psi1_df.itertuples():
-        row2 = psi2_df.loc[psi2_df["indx"] == row1.indx]
-        if not row2.empty:
+    for indx, coil_prob, helix_prob, sheet_prob in psi1:
+        row2 = rows2.get(indx)
+        if row2 is not None:
             row_score = 0
-            row_score += 1 - abs(float(row1.coil_prob) - float(row2.coil_prob))
-            row_score += 1 - abs(float(row1.helix_prob) - float(row2.helix_prob))
-            row_score += 1 - abs(float(row1.sheet_prob) - float(row2.sheet_prob))
+            row_score += 1 - abs(float(coil_prob) - float(row2[1]))
+            row_score += 1 - abs(float(helix_prob) - float(row2[2]))
+            row_score += 1 - abs(float(sheet_prob) - float(row2[3]))
             ss_score += row_score / 3
         else:
             num_extra_gaps += 1
-    align_len = len(psi2_df) + num_extra_gaps  # Note that any gaps in psi1 are automatically accounted for by len(psi2)
+    align_len = len(psi2) + num_extra_gaps  # Note that any gaps in psi1 are automatically accounted for by len(psi2)
     ss_score /= align_len
     return ss_score
 # ################ END PSI-PRED FUNCTIONS ################ #
 
 
+def run_sibling_tasks(tasks):
+    """
+    Run independent tasks (i.e., recursion into sibling sub clusters), handing some of them off to new threads while
+    SIBLING_SLOTS has room. Everything else runs in the calling thread, so nested calls never wait on each other for
+    a slot.
+    :param tasks: List of functions that take no arguments
+    :return: List of task return values, in the same order as tasks
+    """
+    results = [None for _ in tasks]
+    errors = [None for _ in tasks]
+
+    def run_task(indx):
+        try:
+            results[indx] = tasks[indx]()
+        except Exception as err:
+            errors[indx] = err
+        finally:
+            SIBLING_SLOTS.release()
+
+    threads = []
+    try:
+        for indx, task in enumerate(tasks):
+            # The last task always runs here, because this thread would otherwise just sit and wait
+            if indx < len(tasks) - 1 and SIBLING_SLOTS.acquire(blocking=False):
+                thread = Thread(target=run_task, args=(indx,))
+                thread.start()
+                threads.append(thread)
+            else:
+                results[indx] = task()
+    finally:
+        for thread in threads:
+            thread.join()
+
+    for err in errors:
+        if err is not None:
+            raise err
+    return results
+
+
 def orthogroup_caller(master_cluster, cluster_list, seqbuddy, sql_broker, progress, outdir, psi_pred_ss2,
                       steps=1000, chains=3, walkers=2, quiet=True, taxa_sep="-", r_seed=None, convergence=None,
-                      resume=False):
+                      resume=False, stable_steps=0):
     """
     Run MCMCMC on MCL to find the best orthogroups
     :param master_cluster: The group to be subdivided
@@ -737,6 +816,7 @@ def orthogroup_caller(master_cluster, cluster_list, seqbuddy, sql_broker, progre
     :param r_seed: Set the random generator seed value
     :param convergence: Set minimum Gelman-Rubin PSRF value for convergence
     :param resume: Try to pick up from a previous run
+    :param stable_steps: Also stop MCMCMC once the best partition has held for this many steps (0 = Gelman-Rubin only)
     :return: list of sequence_ids objects
     """
     def save_cluster(end_message=None):
@@ -763,7 +843,6 @@ def orthogroup_caller(master_cluster, cluster_list, seqbuddy, sql_broker, progre
     master_cluster.set_name()
     mcmcmc_path = os.path.join(outdir, "mcmcmc", master_cluster.name())
     os.makedirs(mcmcmc_path, exist_ok=True)
-    open(os.path.join(mcmcmc_path, "max.txt"), "w").close()
     convergence = GELMAN_RUBIN if convergence is None else float(convergence)
 
     # If there are no paralogs in the cluster, then it is already at its highest score and MCL is unnecessary
@@ -802,16 +881,19 @@ def orthogroup_caller(master_cluster, cluster_list, seqbuddy, sql_broker, progre
     if best_possible_score == worst_possible_score:
         return cluster_list
 
-    mcmcmc_params = [mcmcmc_path, seqbuddy, master_cluster,
-                     taxa_sep, sql_broker, psi_pred_ss2, progress, chains * (walkers + 2)]
+    seq_index = helpers.SeqIndex(seqbuddy)
+    mcmcmc_params = [seq_index, master_cluster, taxa_sep, sql_broker, psi_pred_ss2, progress]
+    # Each walker reports the partition it scored as its memo key (see mcmcmc_mcl_key()), so repeated partitions
+    # are only scored once. Keys hold every sequence id, so only keep a modest number of scores cached.
+    stability = dict(convergence_callback=mcmcmc.PartitionStability(stable_steps)) if stable_steps else {}
     mcmcmc_factory = mcmcmc.MCMCMC([inflation_var, gq_var], mcmcmc_mcl, steps=steps, sample_rate=1, quiet=quiet,
                                    num_walkers=walkers, num_chains=chains, convergence=convergence,
                                    outfile_root=os.path.join(mcmcmc_path, "mcmcmc_out"), params=mcmcmc_params,
                                    include_lava=True, include_ice=True, r_seed=rand_gen.randint(1, 999999999999999),
-                                   min_max=(worst_possible_score, best_possible_score))
+                                   min_max=(worst_possible_score, best_possible_score), memo_key=mcmcmc_mcl_key,
+                                   memo_size=100, **stability)
 
-    mcmcmc_factory.reset_params([mcmcmc_path, seqbuddy, master_cluster,
-                                 taxa_sep, sql_broker, psi_pred_ss2, progress, chains * (walkers + 2)])
+    mcmcmc_factory.reset_params([seq_index, master_cluster, taxa_sep, sql_broker, psi_pred_ss2, progress])
 
     if resume:
         if not mcmcmc_factory.resume():
@@ -820,23 +902,16 @@ def orthogroup_caller(master_cluster, cluster_list, seqbuddy, sql_broker, progre
     else:
         mcmcmc_factory.run()
 
-    best_score = pd.DataFrame()
-    for indx in range(len(mcmcmc_factory.chains)):
-        mcmcmc_output = pd.read_csv(os.path.join(mcmcmc_path, "mcmcmc_out_%s.csv" % (indx+1)), "\t", index_col=False)
-        result = mcmcmc_output.loc[mcmcmc_output["result"] == mcmcmc_output["result"].max()]
-        best_score = result if best_score.empty or result["result"].iloc[0] > best_score["result"].iloc[0] \
-            else best_score
-
-    if round(best_score["result"].iloc[0], 8) <= round(master_cluster.score(), 8):
+    # Best sample recorded by a cold walker (the highest 'result' in the chain output files)
+    best = mcmcmc_factory.best_sample()
+    best_score = best["score"]
+    if round(best_score, 8) <= round(master_cluster.score(), 8):
         save_cluster("New best score of %s is ≤ master cluster at %s"
-                     % (round(best_score["result"].iloc[0], 8), round(master_cluster.score(), 8)))
+                     % (round(best_score, 8), round(master_cluster.score(), 8)))
         return cluster_list
 
-    mcl_obj = helpers.MarkovClustering(master_cluster.sim_scores, inflation=best_score["I"].iloc[0],
-                                       edge_sim_threshold=best_score["gq"].iloc[0])
-    mcl_obj.run()
-    progress.update('mcl_runs', 1)
-    mcl_clusters = mcl_obj.clusters
+    # Sub clusters are kept in the order MCL returns them, because that sets their names and recursion seeds
+    mcl_clusters = mcl_partition(master_cluster, best["variables"]["I"], best["variables"]["gq"], progress)
 
     # Write out the actual best clusters
     best_clusters = ['\t'.join(cluster) for cluster in mcl_clusters]
@@ -860,12 +935,11 @@ def orthogroup_caller(master_cluster, cluster_list, seqbuddy, sql_broker, progre
         if sub_cluster.seq_id_hash == master_cluster.seq_id_hash:  # This shouldn't ever happen
             raise ArithmeticError("The sub_cluster and master_cluster are the same, but are returning different "
                                   "scores\nsub-cluster score: %s, master score: %s\n%s"
-                                  % (best_score["result"].iloc[0], master_cluster.score(),
+                                  % (best_score, master_cluster.score(),
                                      sub_cluster.seq_id_hash))
         sub_cluster.set_name()
         if len(sub_cluster) in [1, 2]:
-            _, align = retrieve_all_by_all_scores(Sb.pull_recs(Sb.make_copy(seqbuddy),
-                                                               "^%s$" % ("$|^".join(sub_cluster.seq_ids))),
+            _, align = retrieve_all_by_all_scores(seq_index.subset(sub_cluster.seq_ids),
                                                   psi_pred_ss2, sql_broker, quiet=True)
             align = Alb.generate_hmm(align, HMMBUILD)
             with open(os.path.join(outdir, "hmm", sub_cluster.name()), "w") as ofile:
@@ -874,15 +948,19 @@ def orthogroup_caller(master_cluster, cluster_list, seqbuddy, sql_broker, progre
             continue
         recursion_clusters.append(sub_cluster)
 
-    for sub_cluster in recursion_clusters:
-        seqbuddy_copy = Sb.make_copy(seqbuddy)
-        seqbuddy_copy = Sb.pull_recs(seqbuddy_copy, ["^%s$" % rec_id for rec_id in sub_cluster.seq_ids])
+    def recurse(_sub_cluster, _r_seed):
+        # Each sibling collects its own list of clusters, and they are merged below in the same order that a
+        # sequential run would have appended them
+        return orthogroup_caller(_sub_cluster, [], seqbuddy=seq_index.subset(_sub_cluster.seq_ids),
+                                 sql_broker=sql_broker, progress=progress, outdir=outdir, steps=steps, quiet=quiet,
+                                 chains=chains, walkers=walkers, taxa_sep=taxa_sep, convergence=convergence,
+                                 resume=resume, r_seed=_r_seed, psi_pred_ss2=psi_pred_ss2, stable_steps=stable_steps)
 
-        # Recursion... Reassign cluster_list, as all clusters are returned at the end of a call to orthogroup_caller
-        cluster_list = orthogroup_caller(sub_cluster, cluster_list, seqbuddy=seqbuddy_copy, sql_broker=sql_broker,
-                                         progress=progress, outdir=outdir, steps=steps, quiet=quiet, chains=chains,
-                                         walkers=walkers, taxa_sep=taxa_sep, convergence=convergence, resume=resume,
-                                         r_seed=rand_gen.randint(1, 999999999999999), psi_pred_ss2=psi_pred_ss2)
+    # Recursion... Sub clusters are already named and seeds are drawn up front, so siblings can run concurrently
+    tasks = [partial(recurse, sub_cluster, rand_gen.randint(1, 999999999999999))
+             for sub_cluster in recursion_clusters]
+    for sub_cluster_list in run_sibling_tasks(tasks):
+        cluster_list += sub_cluster_list
 
     save_cluster("Sub clusters returned")
     return cluster_list
@@ -890,25 +968,45 @@ def orthogroup_caller(master_cluster, cluster_list, seqbuddy, sql_broker, progre
 
 # #########  Miscellaneous  ########## #
 class Progress(object):
-    def __init__(self, outdir, base_cluster):
+    keys = ["mcl_runs", "placed", "total"]
+
+    def __init__(self, outdir, base_cluster, flush_secs=5):
+        """
+        Counters live in shared memory so forked walkers can bump them cheaply. The '.progress' file is only rewritten
+        every flush_secs, for anything watching the run from outside.
+        :param outdir: Where to write the .progress file
+        :param base_cluster: The master cluster (sets the total number of sequences)
+        :param flush_secs: Minimum time between .progress file writes
+        """
         self.outdir = outdir
-        with open(os.path.join(self.outdir, ".progress"), "w") as progress_file:
-            _progress = {"mcl_runs": 0, "placed": 0, "total": len(base_cluster)}
-            json.dump(_progress, progress_file)
+        self.flush_secs = flush_secs
+        self.counts = Array("q", [0, 0, len(base_cluster)])
+        self.last_flush = Value("d", 0)
+        self.flush()
 
     def update(self, key, value):
-        with PROGRESS_LOCK:
-            with open(os.path.join(self.outdir, ".progress"), "r") as ifile:
-                _progress = json.load(ifile)
-                _progress[key] += value
-            with open(os.path.join(self.outdir, ".progress"), "w") as _ofile:
-                json.dump(_progress, _ofile)
+        with self.counts.get_lock():
+            self.counts[self.keys.index(key)] += value
+        if time.time() - self.last_flush.value >= self.flush_secs:
+            self.flush()
         return
 
     def read(self):
-        with PROGRESS_LOCK:
-            with open(os.path.join(self.outdir, ".progress"), "r") as ifile:
-                return json.load(ifile)
+        with self.counts.get_lock():
+            return OrderedDict(zip(self.keys, self.counts[:]))
+
+    def flush(self):
+        """
+        Write the current counts to .progress. The file is swapped in whole, so readers never see a partial write.
+        :return: None
+        """
+        with self.last_flush.get_lock():
+            self.last_flush.value = time.time()
+            tmp_path = os.path.join(self.outdir, ".progress.%s" % os.getpid())
+            with open(tmp_path, "w") as _ofile:
+                json.dump(self.read(), _ofile)
+            os.replace(tmp_path, os.path.join(self.outdir, ".progress"))
+        return
 
     def __str__(self):
         _progress = self.read()
@@ -952,6 +1050,7 @@ class HeartBeat(object):
                                    'thread_type TEXT, pulse INTEGER)')
                 except sqlite3.OperationalError:
                     pass
+            helpers.enable_wal(self.hbdb_path)
 
     def _run(self, check_file_path):
         if self.dummy:
@@ -1008,6 +1107,92 @@ class HeartBeat(object):
         return
 
 
+class MasterHeartBeat(HeartBeat):
+    def __init__(self, hbdb_path, pulse_rate):
+        """
+        A single master heartbeat that covers every job this master has out with the workers. Workers tie 'waiting'
+        entries to a master_id, so one row in the heartbeat table (and one transaction per pulse) keeps all of them
+        alive, instead of a separate daemon and row for every WorkerJob.
+        :param hbdb_path: Heartbeat database
+        :param pulse_rate: Seconds between pulses
+        """
+        HeartBeat.__init__(self, hbdb_path, pulse_rate, thread_type="master")
+        self.jobs = set()
+        self.owner_pid = None
+        self.keep_alive = False  # Set when the heartbeat is started for the whole run, rather than by attach()
+        self._lock = RLock()
+
+    @property
+    def location(self):
+        return self.hbdb_path
+
+    def _owned(self):
+        return self.running_process is not None and self.owner_pid == os.getpid()
+
+    def start(self):
+        with self._lock:
+            if self._owned():  # Already pulsing for outstanding jobs, so just keep it going
+                self.keep_alive = True
+                return
+            self.running_process = None  # Anything inherited from a parent process is not ours to stop
+            HeartBeat.start(self)
+            self.owner_pid = os.getpid()
+            self.keep_alive = True
+        return
+
+    def end(self):
+        with self._lock:
+            if self.running_process and not self._owned():
+                self.running_process = None
+                self.id = None
+            HeartBeat.end(self)
+            self.keep_alive = False
+            self.jobs = set()
+        return
+
+    def attach(self, job_id):
+        """
+        Register an outstanding job, starting the heartbeat if nothing is keeping this master alive yet. Forked
+        processes reuse a run-wide heartbeat started by their parent.
+        :param job_id: WorkerJob.job_id
+        :return: The master id that the job should be queued under
+        """
+        with self._lock:
+            if not (self.keep_alive and self.running_process) and not self._owned():
+                self.running_process = None
+                self.jobs = set()
+                HeartBeat.start(self)
+                self.owner_pid = os.getpid()
+            self.jobs.add(job_id)
+            return self.id
+
+    def detach(self, job_id):
+        """
+        Drop a job that has been dealt with. If the heartbeat was only started for outstanding jobs, it is stopped
+        once the last of them is done.
+        :param job_id: WorkerJob.job_id
+        :return: None
+        """
+        with self._lock:
+            self.jobs.discard(job_id)
+            if not self.jobs and not self.keep_alive and self._owned():
+                HeartBeat.end(self)
+        return
+
+
+def master_heartbeat():
+    """
+    :return: The MasterHeartBeat for the current HEARTBEAT_DB, or a ServerHeartBeat for JOB_SERVER (created on first use)
+    """
+    global MASTER_HEARTBEAT
+    location = JOB_SERVER if JOB_SERVER else HEARTBEAT_DB
+    with LOCK:
+        if MASTER_HEARTBEAT is None or MASTER_HEARTBEAT.location != location:
+            MASTER_HEARTBEAT = job_server.ServerHeartBeat(JOB_SERVER, MASTER_PULSE) if JOB_SERVER \
+                else MasterHeartBeat(HEARTBEAT_DB, MASTER_PULSE)
+    return MASTER_HEARTBEAT
+
+
 # ################ SCORING FUNCTIONS ################ #
 def mc_score_sequences(seq_pairs, args):
     # ##################################################################### #
@@ -1035,20 +1220,31 @@ def mc_score_sequences(seq_pairs, args):
 
 
 def compare_pairwise_alignment(alb_obj, gap_open, gap_extend):
+    seq1, seq2 = alb_obj.records()
+    return compare_aligned_seqs(str(seq1.seq), str(seq2.seq), gap_open, gap_extend)
+
+
+def compare_aligned_seqs(seq1, seq2, gap_open, gap_extend):
+    """
+    Substitution matrix score for two rows of an alignment. Columns that are gaps in both rows are skipped, the same as
+    when the pair is pulled out of the alignment with Alb.pull_records() (which cleans out all-gap columns).
+    :param seq1: Aligned sequence string
+    :param seq2: Aligned sequence string (same length as seq1)
+    :param gap_open: Gap open penalty
+    :param gap_extend: Gap extend penalty
+    :return: float
+    """
+    columns = [(aa1, aa2) for aa1, aa2 in zip(seq1, seq2) if aa1 != "-" or aa2 != "-"]
     observed_score = 0
-    observed_len = alb_obj.lengths()[0]
+    observed_len = len(columns)
     seq1_best = 0
     seq1_len = 0
     seq2_best = 0
     seq2_len = 0
-    seq1, seq2 = alb_obj.records()
     prev_aa1 = "-"
     prev_aa2 = "-"
 
-    for aa_pos in range(observed_len):
-        aa1 = seq1.seq[aa_pos]
-        aa2 = seq2.seq[aa_pos]
-
+    for aa1, aa2 in columns:
         if aa1 != "-":
             seq1_best += BLOSUM62[aa1, aa1]
             seq1_len += 1
@@ -1080,17 +1276,18 @@ def compare_pairwise_alignment(alb_obj, gap_open, gap_extend):
 
 
 def mc_create_all_by_all_scores(seqbuddy, args):
-    psi_pred_ss2, sql_broker = args
-    retrieve_all_by_all_scores(seqbuddy, psi_pred_ss2, sql_broker, quiet=True)
+    psi_pred_ss2, sql_broker, depth = args
+    retrieve_all_by_all_scores(seqbuddy, psi_pred_ss2, sql_broker, quiet=True, depth=depth)
     return
 
 
-def retrieve_all_by_all_scores(seqbuddy, psi_pred_ss2, sql_broker, quiet=False):
+def retrieve_all_by_all_scores(seqbuddy, psi_pred_ss2, sql_broker, quiet=False, depth=0):
     """
     :param seqbuddy: SeqBuddy object
     :param psi_pred_ss2: OrderedDict of {seqID: ss2 dataframe path}
     :param sql_broker: Active broker object to search/update SQL database
     :param quiet: Supress multicore output
+    :param depth: Recursion depth of the cluster being scored (used to prioritize worker jobs)
     :return: sim_scores, Alb.AlignBuddy
     """
     seq_ids = sorted([rec.id for rec in seqbuddy.records])
@@ -1102,24 +1299,38 @@ def retrieve_all_by_all_scores(seqbuddy, psi_pred_ss2, sql_broker, quiet=False):
         cluster2database(Cluster(seq_ids, sim_scores), sql_broker, alignment)
         return sim_scores, alignment
 
+    def from_database():
+        query = sql_broker.query("SELECT graph, alignment FROM data_table WHERE hash=?", (seq_id_hash,))
+        if query and len(query[0]) == 2:
+            _sim_scores, _alignment = query[0]
+            _sim_scores = pd.read_csv(StringIO(_sim_scores), index_col=False, header=None)
+            _sim_scores.columns = ["seq1", "seq2", "subsmat", "psi", "raw_score", "score"]
+            return _sim_scores, Alb.AlignBuddy(_alignment, in_format="fasta")
+        return None
+
     # Grab from the database first, if the data exists there already
-    query = sql_broker.query("SELECT graph, alignment FROM data_table WHERE hash=?", (seq_id_hash,))
-    if query and len(query[0]) == 2:
-        sim_scores, alignment = query[0]
-        sim_scores = pd.read_csv(StringIO(sim_scores), index_col=False, header=None)
-        sim_scores.columns = ["seq1", "seq2", "subsmat", "psi", "raw_score", "score"]
-        return sim_scores, Alb.AlignBuddy(alignment, in_format="fasta")
+    result = from_database()
+    if result:
+        return result
 
     # Try to feed the job to independent workers
-    if WORKER_DB and os.path.isfile(WORKER_DB) and len(seq_ids) > MIN_SIZE_TO_WORKER:
-        workerjob = WorkerJob(seqbuddy, sql_broker)
+    if OFFLOAD_POLICY.offload(seqbuddy):
+        job_class = ServerWorkerJob if JOB_SERVER else WorkerJob
+        workerjob = job_class(seqbuddy, sql_broker, depth=depth)
         worker_result = workerjob.run()
         if worker_result:
+            if workerjob.service_secs:  # Not known if another master already had the results in the database
+                OFFLOAD_POLICY.record_worker(seqbuddy, workerjob.service_secs)
             return worker_result
 
-    # If the job is small or couldn't be pushed off on a worker, do it directly
-    all_by_all_obj = AllByAllScores(seqbuddy, psi_pred_ss2, sql_broker, quiet=quiet)
-    return all_by_all_obj.create()
+    # If the job is small or couldn't be pushed off on a worker, do it directly. Only the first caller for a given
+    # cluster does the work, and anyone else asking at the same time waits and then reads its result from the database.
+    with ALL_BY_ALL_FLIGHTS.claim(seq_id_hash) as waited:
+        result = from_database() if waited else None
+        if result:
+            return result
+        all_by_all_obj = AllByAllScores(seqbuddy, psi_pred_ss2, sql_broker, quiet=quiet)
+        return all_by_all_obj.create()
 
 
 class AllByAllScores(object):
@@ -1140,7 +1351,8 @@ class AllByAllScores(object):
         for rec in self.seqbuddy.records:
             psi_pred_ss2_dfs[rec.id] = read_ss2_file(self.psi_pred_ss2[rec.id])
 
-        alignment = Alb.generate_msa(Sb.make_copy(self.seqbuddy), ALIGNMETHOD, ALIGNPARAMS, quiet=True)
+        with CPU_BUDGET.hold("alignment"):
+            alignment = Alb.generate_msa(Sb.make_copy(self.seqbuddy), ALIGNMETHOD, ALIGNPARAMS, quiet=True)
 
         # Need to specify what columns the PsiPred files map to now that there are gaps.
         psi_pred_ss2_dfs = update_psipred(alignment, psi_pred_ss2_dfs, "msa")
@@ -1152,13 +1364,15 @@ class AllByAllScores(object):
         # Re-update PsiPred files now that some columns, possibly including non-gap characters, are removed
         psi_pred_ss2_dfs = update_psipred(alignment, psi_pred_ss2_dfs, "trimal")
 
-        all_by_all_len, all_by_all = prepare_all_by_all(self.seqbuddy, psi_pred_ss2_dfs, CPUS)
         all_by_all_outfile = br.TempFile()
         all_by_all_outfile.write("seq1,seq2,subsmat,psi")
         score_sequences_params = [alignment, GAP_OPEN, GAP_EXTEND, all_by_all_outfile.path]
-        with MULTICORE_LOCK:
+        with CPU_BUDGET.hold("all_by_all", CPUS) as cpus:
+            start_time = time.time()
+            all_by_all_len, all_by_all = prepare_all_by_all(self.seqbuddy, psi_pred_ss2_dfs, cpus)
             br.run_multicore_function(all_by_all, mc_score_sequences, score_sequences_params,
-                                      quiet=self.quiet, max_processes=CPUS)
+                                      quiet=self.quiet, max_processes=cpus)
+            OFFLOAD_POLICY.record_local(self.seqbuddy, time.time() - start_time, cpus)
         sim_scores = pd.read_csv(all_by_all_outfile.get_handle("r"), index_col=False)
         sim_scores = set_final_sim_scores(sim_scores)
         cluster2database(Cluster(self.seq_ids, sim_scores), self.sql_broker, alignment)
@@ -1245,8 +1459,178 @@ def set_final_sim_scores(sim_scores):
     return sim_scores
 
 
+def workers_configured():
+    """
+    :return: True if there is a worker directory or job server to send all-by-all jobs to
+    """
+    return bool(JOB_SERVER) or bool(WORKER_DB and os.path.isfile(WORKER_DB))
+
+
+class OffloadPolicy(object):
+    """
+    Decides whether an all-by-all job is sent off to the worker cluster or run locally. This base class is the
+    original fixed rule (anything with more than MIN_SIZE_TO_WORKER sequences goes to the workers). To try a different
+    rule, subclass it and set OFFLOAD_POLICY to an instance of the new class.
+    """
+    def offload(self, seqbuddy):
+        """
+        :param seqbuddy: The sequences that need an all-by-all graph
+        :return: True if the job should be queued for the workers
+        """
+        if not workers_configured():
+            return False
+        return len(seqbuddy) > MIN_SIZE_TO_WORKER
+
+    def record_local(self, seqbuddy, seconds, cpus):
+        """
+        Called after an all-by-all is scored locally
+        :param seqbuddy: The sequences that were scored
+        :param seconds: How long the scoring took
+        :param cpus: How many processes were used
+        :return: None
+        """
+        return
+
+    def record_worker(self, seqbuddy, seconds):
+        """
+        Called after a job comes back from the workers
+        :param seqbuddy: The sequences that were scored
+        :param seconds: Service time reported by the workers, from claiming the job to handing back the results (time
+        spent in the queue is not included)
+        :return: None
+        """
+        return
+
+
+class CostModelOffloadPolicy(OffloadPolicy):
+    def __init__(self, score_rate=2e5, msa_rate=5e5, worker_job_secs=60, worker_overhead=10, worker_cpus=None,
+                 smoothing=0.2, status_ttl=5):
+        """
+        Estimate how long an all-by-all will take here and on the workers, and send it wherever it should finish first.
+        Job cost is (sequence pairs x average length) for scoring, plus (sequences x average length x log2 sequences)
+        for the MSA. Rates are refined from every job that completes, and shared by all (forked) processes.
+        The fixed rule is kept as a floor: jobs with MIN_SIZE_TO_WORKER or fewer sequences always stay local, without
+        touching the worker databases. Above that, a job only goes out if the workers are expected to be strictly
+        faster, so anything the cost model calls a tie is run locally (the fixed rule sent all of them out).
+        :param score_rate: Starting guess at how many pair-residues a single core can score per second
+        :param msa_rate: Starting guess at how many MSA cost units are processed per second
+        :param worker_job_secs: Starting guess at how long a worker spends on one job, from claiming it to handing back
+        the results (the service time, used to estimate queue wait)
+        :param worker_overhead: Fixed cost, in seconds, of sending a job out and picking up the results
+        :param worker_cpus: How many cores each worker uses for scoring (defaults to CPUS)
+        :param smoothing: Weight given to each new observation when updating rates (exponential moving average)
+        :param status_ttl: Seconds that a read of the worker queue is reused for before the databases are read again
+        """
+        self.score_rate = Value("d", score_rate)
+        self.msa_rate = msa_rate
+        self.worker_job_secs = Value("d", worker_job_secs)
+        self.worker_overhead = worker_overhead
+        self.worker_cpus = worker_cpus
+        self.smoothing = smoothing
+        self.status_ttl = status_ttl
+        self._status = None  # (time read, workers, jobs ahead)
+        self._last_decision = None
+
+    @staticmethod
+    def job_cost(seqbuddy):
+        """
+        :param seqbuddy: The sequences that need an all-by-all graph
+        :return: (scoring cost, MSA cost)
+        """
+        num_seqs = len(seqbuddy.records)
+        ave_len = sum([len(rec.seq) for rec in seqbuddy.records]) / max(num_seqs, 1)
+        pairs = (num_seqs ** 2 - num_seqs) / 2
+        return pairs * ave_len, num_seqs * ave_len * log2(num_seqs + 1)
+
+    def local_secs(self, seqbuddy):
+        score_cost, msa_cost = self.job_cost(seqbuddy)
+        cpus = max(CPU_BUDGET.available(), 1)
+        return msa_cost / self.msa_rate + score_cost / (self.score_rate.value * cpus)
+
+    def worker_secs(self, seqbuddy, workers, jobs_ahead):
+        score_cost, msa_cost = self.job_cost(seqbuddy)
+        worker_cpus = self.worker_cpus if self.worker_cpus else CPUS
+        queue_wait = jobs_ahead / workers * self.worker_job_secs.value
+        return queue_wait + self.worker_overhead + msa_cost / self.msa_rate + \
+            score_cost / (self.score_rate.value * worker_cpus)
+
+    @staticmethod
+    def read_queue_status():
+        """
+        Read the heartbeat and work databases (or ask the job server). The databases are read from a snapshot, so
+        this never takes a lock that workers or other masters have to wait on.
+        :return: (number of live workers, number of jobs queued or being processed)
+        """
+        if JOB_SERVER:
+            status = job_server.JobClient(JOB_SERVER).status()
+            return status["workers"], status["queue"] + status["processing"]
+        with helpers.SnapshotConnect(HEARTBEAT_DB) as cursor:
+            workers = cursor.execute("SELECT COUNT(*) FROM heartbeat WHERE thread_type='worker' AND pulse>?",
+                                     (time.time() - MAX_WORKER_WAIT - cursor.lag,)).fetchone()[0]
+        with helpers.SnapshotConnect(WORKER_DB) as cursor:
+            jobs_ahead = cursor.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+            jobs_ahead += cursor.execute("SELECT COUNT(*) FROM processing").fetchone()[0]
+        return workers, jobs_ahead
+
+    def queue_status(self):
+        """
+        read_queue_status(), reused for status_ttl seconds (every cluster of every MCMCMC step asks)
+        :return: (number of live workers, number of jobs queued or being processed)
+        """
+        status = self._status
+        if status is None or time.time() - status[0] > self.status_ttl:
+            status = (time.time(),) + tuple(self.read_queue_status())
+            self._status = status
+        return status[1], status[2]
+
+    def offload(self, seqbuddy):
+        if not workers_configured() or len(seqbuddy) <= MIN_SIZE_TO_WORKER:
+            return False
+        try:
+            workers, jobs_ahead = self.queue_status()
+        except (sqlite3.Error, OSError, EOFError, job_server.JobServerError) as err:
+            # Databases not set up yet, locked for too long, or the job server can't be reached. Just run it here.
+            self._log_decision(False, "could not read worker databases (%s), running locally" % err)
+            return False
+        local_secs = self.local_secs(seqbuddy)
+        worker_secs = self.worker_secs(seqbuddy, workers, jobs_ahead) if workers else None
+        decision = worker_secs is not None and worker_secs < local_secs
+        self._log_decision(decision, "%s sequences -> %s (local ~%ss, workers ~%s, %s workers, %s jobs ahead)"
+                           % (len(seqbuddy), "worker" if decision else "local", round(local_secs, 1),
+                              "%ss" % round(worker_secs, 1) if worker_secs is not None else "n/a", workers,
+                              jobs_ahead))
+        return decision
+
+    def _log_decision(self, decision, msg):
+        # Only log when jobs start going somewhere else, otherwise this is one line per cluster per MCMCMC step
+        if decision != self._last_decision:
+            self._last_decision = decision
+            logging.info("Offload policy: %s" % msg)
+        return
+
+    def _update(self, shared_val, observation):
+        with shared_val.get_lock():
+            shared_val.value = (1 - self.smoothing) * shared_val.value + self.smoothing * observation
+        return
+
+    def record_local(self, seqbuddy, seconds, cpus):
+        score_cost, msa_cost = self.job_cost(seqbuddy)
+        if seconds > 0 and score_cost:
+            self._update(self.score_rate, score_cost / (seconds * max(cpus, 1)))
+        return
+
+    def record_worker(self, seqbuddy, seconds):
+        # Service time only, because worker_secs() models the queue wait separately from the number of jobs ahead
+        if seconds > 0:
+            self._update(self.worker_job_secs, seconds)
+        return
+
+
+OFFLOAD_POLICY = CostModelOffloadPolicy()  # Swap in any OffloadPolicy subclass to change where all-by-alls are run
+
+
 class WorkerJob(object):
-    def __init__(self, seqbuddy, sql_broker):
+    def __init__(self, seqbuddy, sql_broker, depth=0):
         self.seqbuddy = seqbuddy
         self.seq_ids = sorted([rec.id for rec in self.seqbuddy.records])
         self.seq_id_hash = helpers.md5_hash(", ".join(self.seq_ids))
@@ -1254,11 +1638,14 @@ class WorkerJob(object):
         job_id = "".join([str(x) for x in [self.seq_id_hash, GAP_OPEN, GAP_EXTEND, ALIGNMETHOD, ALIGNPARAMS, TRIMAL]])
         self.job_id = helpers.md5_hash(job_id)
         self.sql_broker = sql_broker
-        self.heartbeat = HeartBeat(HEARTBEAT_DB, MASTER_PULSE)
+        self.heartbeat = master_heartbeat()
         self.running = False
+        self.cost = helpers.job_cost(len(self.seq_ids))
+        self.priority = helpers.job_priority(self.cost, depth, TIMER.start)
+        self.service_secs = None  # Claim to completion on the worker, once the job comes back
 
     def run(self):
-        self.heartbeat.start()
+        self.heartbeat.attach(self.job_id)
         with helpers.ExclusiveConnect(HEARTBEAT_DB) as cursor:
             workers = cursor.execute("SELECT * FROM heartbeat "
                                      "WHERE thread_type='worker' "
@@ -1266,6 +1653,8 @@ class WorkerJob(object):
         result = False
         if workers:
             self.running = True
+            marker = os.path.join(WORKER_OUT, "%s.done" % self.job_id)
+            marker_state = helpers.file_state(marker)
             self.queue_job()
             while self.running:
                 db_result = self.pull_from_db()
@@ -1283,12 +1672,12 @@ class WorkerJob(object):
                     if not self.check_if_active():
                         break
 
-                with helpers.ExclusiveConnect(HEARTBEAT_DB) as cursor:
-                    active_threads = cursor.execute("SELECT COUNT(*) FROM heartbeat "
-                                                    "WHERE thread_type='master'").fetchone()[0]
-                pause_time = active_threads * 0.5
-                time.sleep(pause_time)
-        self.heartbeat.end()
+                # Workers drop a marker file when the job is complete, and it is removed again once a master has
+                # added the results to the database, so either change wakes this loop up right away. Checking the
+                # databases on a timer is the fallback, and is what puts a ceiling on the wait when WORKER_OUT is on
+                # NFS and the marker is hidden by the attribute cache.
+                marker_state = helpers.wait_for_change(marker, marker_state, WORKER_POLL_FALLBACK)
+        self.heartbeat.detach(self.job_id)
         return result
 
     def queue_job(self):
@@ -1302,17 +1691,17 @@ class WorkerJob(object):
                 if not os.path.isfile("%s/%s.seqs" % (WORKER_OUT, self.job_id)):
                     self.seqbuddy.write("%s/%s.seqs" % (WORKER_OUT, self.job_id), out_format="fasta")
                 cursor.execute("INSERT INTO queue "
-                               "(hash, psi_pred_dir, align_m, align_p, trimal, gap_open, gap_extend) "
-                               "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               "(hash, psi_pred_dir, align_m, align_p, trimal, gap_open, gap_extend, cost, priority, "
+                               "queued) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                                (self.job_id, PSIPREDDIR, ALIGNMETHOD, ALIGNPARAMS, " ".join([str(x) for x in TRIMAL]),
-                                GAP_OPEN, GAP_EXTEND,))
+                                GAP_OPEN, GAP_EXTEND, self.cost, self.priority, time.time(),))
 
             if not cursor.execute("SELECT * FROM waiting WHERE hash=? AND master_id=?",
                                   (self.job_id, self.heartbeat.id,)).fetchone():
                 cursor.execute("INSERT INTO waiting (hash, master_id) VALUES (?, ?)", (self.job_id, self.heartbeat.id,))
         return
 
-    def pull_from_db(self):
+    def read_from_db(self):
         # Remember that job_id and seq_id_hash are different! job_id includes details about alignment
         query = self.sql_broker.query("SELECT graph, alignment FROM data_table WHERE hash=?", (self.seq_id_hash,))
         if not query or len(query[0]) != 2:
@@ -1320,16 +1709,23 @@ class WorkerJob(object):
         sim_scores, alignment = query[0]
         sim_scores = pd.read_csv(StringIO(sim_scores), index_col=False, header=None)
         sim_scores.columns = ["seq1", "seq2", "subsmat", "psi", "raw_score", "score"]
+        return sim_scores, Alb.AlignBuddy(alignment, in_format="fasta")
+
+    def pull_from_db(self):
+        result = self.read_from_db()
+        if not result:
+            return False
         with helpers.ExclusiveConnect(WORKER_DB) as cursor:
             cursor.execute("DELETE FROM waiting WHERE hash=? AND master_id=?", (self.job_id,
                                                                                 self.heartbeat.id,))
-        self.heartbeat.end()
-        return sim_scores, Alb.AlignBuddy(alignment, in_format="fasta")
+        return result
 
     def check_finished(self):
         with helpers.ExclusiveConnect(WORKER_DB) as cursor:
-            if not cursor.execute("SELECT * FROM complete WHERE hash=?", (self.job_id,)).fetchone():
+            complete = cursor.execute("SELECT secs FROM complete WHERE hash=?", (self.job_id,)).fetchone()
+            if not complete:
                 return False
+            self.service_secs = complete[0]
 
             cursor.execute("DELETE FROM complete WHERE hash=?", (self.job_id,))
             cursor.execute("INSERT INTO proc_comp (hash, master_id) VALUES (?, ?)",
@@ -1340,12 +1736,15 @@ class WorkerJob(object):
     def process_finished(self):
         location = os.path.join(WORKER_OUT, self.job_id)
         alignment = Alb.AlignBuddy("%s.aln" % location, in_format="fasta")
-        sim_scores = pd.read_csv("%s.graph" % location, index_col=False, header=None)
-        sim_scores.columns = ["seq1", "seq2", "subsmat", "psi", "raw_score", "score"]
+        sim_scores = helpers.read_graph("%s.graph" % location)
         cluster2database(Cluster(self.seq_ids, sim_scores), self.sql_broker, alignment)
 
         for del_file in [".aln", ".graph", ".seqs"]:
             os.remove(os.path.join(WORKER_OUT, "%s%s" % (self.job_id, del_file)))
+        try:  # Removing the marker lets any other masters waiting on this job know the results are in the database
+            os.remove(os.path.join(WORKER_OUT, "%s.done" % self.job_id))
+        except FileNotFoundError:
+            pass
         with helpers.ExclusiveConnect(WORKER_DB) as cursor:
             cursor.execute("DELETE FROM proc_comp WHERE hash=?", (self.job_id,))
         return sim_scores, alignment
@@ -1364,7 +1763,7 @@ class WorkerJob(object):
             if not worker_heartbeat_check:
                 # No workers are still around. Time to clean up and move on serially
                 cursor.execute("DELETE FROM queue WHERE hash=?", (self.job_id,))
-                cursor.execute("DELETE FROM waiting WHERE master_id=?", (self.heartbeat.id,))
+                cursor.execute("DELETE FROM waiting WHERE hash=? AND master_id=?", (self.job_id, self.heartbeat.id,))
                 try:
                     os.remove(os.path.join(WORKER_OUT, "%s.seqs" % self.job_id))
                 except FileNotFoundError:
@@ -1410,10 +1809,99 @@ class WorkerJob(object):
                 self.queue_job()
         return True
 
+
+class ServerWorkerJob(WorkerJob):
+    """
+    WorkerJob for a job_server backend. Sequences and psipred files go out with the job, and the alignment and graph
+    come back in the reply, so nothing is shared through the filesystem.
+    """
+    def job_params(self):
+        psipred = OrderedDict()
+        for rec in self.seqbuddy.records:
+            with open(os.path.join(PSIPREDDIR, "%s.ss2" % rec.id), "r") as ifile:
+                psipred[rec.id] = ifile.read()
+        return {"psipred": psipred, "align_m": ALIGNMETHOD, "align_p": ALIGNPARAMS,
+                "trimal": " ".join([str(x) for x in TRIMAL]), "gap_open": GAP_OPEN, "gap_extend": GAP_EXTEND}
+
+    def run(self):
+        client = job_server.JobClient(JOB_SERVER)
+        result = False
+        try:
+            master_id = self.heartbeat.attach(self.job_id)
+            if client.status()["workers"]:
+                seqbuddy = Sb.make_copy(self.seqbuddy)
+                seqbuddy.out_format = "fasta"
+                seqs, params = str(seqbuddy), self.job_params()
+                client.submit(self.job_id, master_id, seqs, params, priority=self.priority)
+                while True:
+                    reply = client.result(self.job_id, master_id, timeout=WORKER_POLL_FALLBACK)
+                    if reply["status"] == "complete":
+                        result = self.process_finished(reply)
+                        break
+                    elif reply["status"] == "missing":
+                        # Another master may have finished it off, otherwise queue it back up
+                        result = self.read_from_db()
+                        if result:
+                            break
+                        client.submit(self.job_id, master_id, seqs, params, priority=self.priority)
+                    elif not reply["workers"]:
+                        # No workers are still around. Time to move on serially
+                        client.cancel(self.job_id, master_id)
+                        break
+        except (OSError, EOFError, job_server.JobServerError) as err:
+            logging.warning("Job server at %s failed (%s), running job locally" % (JOB_SERVER, err))
+        self.heartbeat.detach(self.job_id)
+        return result
+
+    def process_finished(self, reply):
+        self.service_secs = reply.get("secs")
+        alignment = Alb.AlignBuddy(reply["alignment"], in_format="fasta")
+        sim_scores = helpers.read_graph(BytesIO(reply["graph"]))
+        cluster2database(Cluster(self.seq_ids, sim_scores), self.sql_broker, alignment)
+        return sim_scores, alignment
+
 # ################ END SCORING FUNCTIONS ################ #
 
 
 # #########  MCL stuff  ########## #
+def mcl_partition(parent_cluster, inflation, gq, progress):
+    """
+    Run MCL on a cluster's graph, reusing the result if this thread has only just run MCL with the same values. Sibling
+    clusters can be recursed into from separate threads (-sib), so each thread keeps its own stash.
+    :param parent_cluster: Cluster object to be broken up
+    :param inflation: MCL inflation value
+    :param gq: Minimum edge similarity score
+    :param progress: Progress class
+    :return: list of clusters (lists of sequence ids)
+    """
+    stash_key = (parent_cluster.seq_id_hash, inflation, gq)
+    stash = getattr(MCL_STASH, "result", None)
+    if stash and stash[0] == stash_key:
+        return stash[1]
+    mcl_obj = helpers.MarkovClustering(parent_cluster.sim_scores, inflation=inflation, edge_sim_threshold=gq)
+    with CPU_BUDGET.hold("mcl"):
+        mcl_obj.run()
+    progress.update('mcl_runs', 1)
+    MCL_STASH.result = (stash_key, mcl_obj.clusters)
+    return mcl_obj.clusters
+
+
+def mcmcmc_mcl_key(args, params):
+    """
+    Memo key function passed to mcmcmc.MCMCMC, identifying the partition MCL produces for a set of sample values.
+    Clusters are put in a canonical order, so the same partition always gets the same key. Keys are passed between
+    walkers, cached, and written to every checkpoint record, so only a digest of the partition is returned.
+    :param args: Sample values to run MCL with and a random seed [inflation, gq, r_seed]
+    :param params: List of parameters (see mcmcmc_mcl() for unpacking assignment)
+    :return: md5 hash of the partition (one line of tab separated sequence ids per cluster, largest clusters first)
+    """
+    inflation, gq, r_seed = args
+    parent_cluster, progress = params[1], params[5]
+    clusters = mcl_partition(parent_cluster, inflation, gq, progress)
+    clusters = sorted([sorted(cluster) for cluster in clusters], key=lambda x: (-len(x), x))
+    return helpers.md5_hash("\n".join(["\t".join(cluster) for cluster in clusters]))
+
+
 def mcmcmc_mcl(args, params):
     """
     Function passed to mcmcmcm.MCMCMC that will execute MCL and return the final cluster scores
@@ -1422,34 +1910,32 @@ def mcmcmc_mcl(args, params):
     :return:
     """
     inflation, gq, r_seed = args
-    exter_tmp_dir, seqbuddy, parent_cluster, taxa_sep, \
-        sql_broker, psi_pred_ss2, progress, expect_num_results = params
+    seq_index, parent_cluster, taxa_sep, sql_broker, psi_pred_ss2, progress = params
     rand_gen = Random(r_seed)
-    mcl_obj = helpers.MarkovClustering(parent_cluster.sim_scores, inflation=inflation, edge_sim_threshold=gq)
-    mcl_obj.run()
-    progress.update('mcl_runs', 1)
-    clusters = mcl_obj.clusters
+    depth = parent_cluster.depth() + 1
+    clusters = mcl_partition(parent_cluster, inflation, gq, progress)
     # Order the clusters so the big jobs are queued up front.
     clusters = sorted(clusters, key=lambda x: len(x), reverse=True)
     score = 0
 
     child_list = OrderedDict()
     for indx, cluster_ids in enumerate(clusters):
-        sb_copy = Sb.make_copy(seqbuddy)
-        sb_copy = Sb.pull_recs(sb_copy, "|".join(["^%s$" % rec_id for rec_id in cluster_ids]))
+        sb_copy = seq_index.subset(cluster_ids)
         # Queue jobs if appropriate
-        if WORKER_DB and os.path.isfile(WORKER_DB) and len(cluster_ids) >= MIN_SIZE_TO_WORKER:
-            p = Process(target=mc_create_all_by_all_scores, args=(sb_copy, [psi_pred_ss2, sql_broker]))
+        if OFFLOAD_POLICY.offload(sb_copy):
+            p = Process(target=mc_create_all_by_all_scores, args=(sb_copy, [psi_pred_ss2, sql_broker, depth]))
             p.start()
             seq_ids = sorted([rec.id for rec in sb_copy.records])
             seq_id_hash = helpers.md5_hash(", ".join(seq_ids))
             child_list[seq_id_hash] = [p, indx, cluster_ids]
         else:
-            sim_scores, alb_obj = retrieve_all_by_all_scores(sb_copy, psi_pred_ss2, sql_broker, quiet=True)
-            cluster = Cluster(cluster_ids, sim_scores, parent=parent_cluster, taxa_sep=taxa_sep,
-                              r_seed=rand_gen.randint(1, 999999999999999))
+            sim_scores, alb_obj = retrieve_all_by_all_scores(sb_copy, psi_pred_ss2, sql_broker, quiet=True,
+                                                             depth=depth)
+            with CPU_BUDGET.hold("mcmcmc"):
+                cluster = Cluster(cluster_ids, sim_scores, parent=parent_cluster, taxa_sep=taxa_sep,
+                                  r_seed=rand_gen.randint(1, 999999999999999))
+                score += cluster.score()
             clusters[indx] = cluster
-            score += cluster.score()
 
     # wait for remaining processes to complete
     while len(child_list) > 0:
@@ -1468,54 +1954,16 @@ def mcmcmc_mcl(args, params):
                         sim_scores = pd.read_csv(StringIO(sim_scores), index_col=False, header=None)
                         sim_scores.columns = ["seq1", "seq2", "subsmat", "psi", "raw_score", "score"]
 
-                    cluster = Cluster(cluster_ids, sim_scores, parent=parent_cluster, taxa_sep=taxa_sep,
-                                      r_seed=rand_gen.randint(1, 999999999999999))
+                    with CPU_BUDGET.hold("mcmcmc"):
+                        cluster = Cluster(cluster_ids, sim_scores, parent=parent_cluster, taxa_sep=taxa_sep,
+                                          r_seed=rand_gen.randint(1, 999999999999999))
+                        score += cluster.score()
                     clusters[indx] = cluster
-                    score += cluster.score()
                     del child_list[_name]
                     break
+        else:
+            time.sleep(0.1)  # Nothing has finished yet, so don't spin on is_alive()
 
-    with LOCK:
-        with open(os.path.join(exter_tmp_dir, "max.txt"), "r") as ifile:
-            results = ifile.readlines()
-            results = [result.strip() for result in results]
-            results.append(",".join([cluster.seq_id_hash for cluster in clusters]))
-            results = sorted(results)
-
-        with open(os.path.join(exter_tmp_dir, "max.txt"), "w") as ofile:
-            ofile.write("\n".join(results))
-
-    if len(results) == expect_num_results:
-        best_score = None
-        best_clusters = []  # Hopefully just find a single best set of cluster, but could be more
-        for clusters in results:
-            score_sum = 0
-            cluster_ids = []
-            for cluster in clusters.split(","):
-                sql_query = sql_broker.query("SELECT seq_ids, graph FROM data_table WHERE hash=?", (cluster,))
-                seq_ids = sql_query[0][0].split(", ")
-                cluster_ids.append(sql_query[0][0])
-                if len(seq_ids) == 1:
-                    sim_scores = pd.DataFrame(columns=["seq1", "seq2", "subsmat", "psi", "raw_score", "score"])
-                else:
-                    sim_scores = pd.read_csv(StringIO(sql_query[0][1]), index_col=False, header=None)
-
-                cluster = Cluster(seq_ids, sim_scores, parent=parent_cluster, taxa_sep=taxa_sep,
-                                  r_seed=rand_gen.randint(1, 999999999999))
-                score_sum += cluster.score()
-            if score_sum == best_score:
-                best_clusters.append(cluster_ids)
-            elif best_score is None or score_sum > best_score:
-                best_clusters = [cluster_ids]
-                best_score = score_sum
-
-        best_clusters = [cluster.replace(', ', '\t') for cluster in best_clusters[0]]
-        with LOCK:
-            with open(os.path.join(exter_tmp_dir, "best_group"), "w") as ofile:
-                ofile.write('\n'.join(best_clusters))
-            open(os.path.join(exter_tmp_dir, "max.txt"), "w").close()
-    elif len(results) > expect_num_results:  # This should never be able to happen
-        raise ValueError("More results written to max.txt than expect_num_results")
     return score
 
 
@@ -2009,7 +2457,9 @@ class Seqs2Clusters(object):
 
             args = [rsquare_vals_df, global_null_file.path, cluster_nulls_file.path,
                     out_of_cluster_file.path, temp_log_output.path]
-            br.run_multicore_function(self.clusters, self._mc_build_cluster_nulls, args, max_processes=CPUS, quiet=True)
+            with CPU_BUDGET.hold("placement", CPUS) as cpus:
+                br.run_multicore_function(self.clusters, self._mc_build_cluster_nulls, args, max_processes=cpus,
+                                          quiet=True)
 
             global_null_df = pd.read_csv(global_null_file.path)
             try:
@@ -2052,7 +2502,8 @@ class Seqs2Clusters(object):
 
             args = [rsquare_vals_df, seq2group_dists_file.path, orig_clusters_file.path, temp_log_output.path]
             seq_ids = self.clusters[0].get_base_cluster().seq_ids
-            br.run_multicore_function(seq_ids, self._mc_build_seq2group, args, quiet=True, max_processes=CPUS)
+            with CPU_BUDGET.hold("placement", CPUS) as cpus:
+                br.run_multicore_function(seq_ids, self._mc_build_seq2group, args, quiet=True, max_processes=cpus)
 
             seq2group_dists = json.loads(seq2group_dists_file.read().strip(",") + "}")
             orig_clusters = json.loads(orig_clusters_file.read().strip(",") + "}")
@@ -2273,6 +2724,12 @@ def argparse_init():
                               help="Specify how many Metropolis-Hastings walkers are in each chain (default=3)")
     parser_flags.add_argument("-cnv", "--converge", type=float, metavar="",
                               help="Set minimum Gelman-Rubin PSRF value for convergence (default=%s)" % GELMAN_RUBIN)
+    parser_flags.add_argument("-stb", "--stable_steps", type=int, default=0, metavar="",
+                              help="Also end MCMCMC once the best partition has been stable for this many steps "
+                                   "(default=off)")
+    parser_flags.add_argument("-sib", "--sibling_threads", type=int, default=0, metavar="",
+                              help="Recurse into this many sibling sub clusters at the same time, on top of the "
+                                   "main thread (default=0)")
     parser_flags.add_argument("-cpu", "--max_cpus", type=int, action="store", default=CPUS, metavar="",
                               help="Specify the maximum number of cores RD-MCL can use (default=%s)" % CPUS)
     parser_flags.add_argument("-lwt", "--lock_wait_time", type=int, default=1200, metavar="",
@@ -2285,7 +2742,8 @@ def argparse_init():
     parser_flags.add_argument("-ep", "--ext_penalty", type=float, default=GAP_EXTEND, metavar="",
                               help="Penalty to extend a gap in pairwise alignment scoring (default=%s)" % GAP_EXTEND)
     parser_flags.add_argument("-wdb", "--workdb", action="store", default="", metavar="",
-                              help="Specify the directory that independent workers will be monitoring")
+                              help="Specify the directory that independent workers will be monitoring, or the "
+                                   "address of a job_server (tcp://host:port or unix:///path)")
     parser_flags.add_argument("-algn_m", "--align_method", action="store", default="clustalo", metavar="",
                               help="Specify which alignment algorithm to use (supply full path if not in $PATH)")
     parser_flags.add_argument("-algn_p", "--align_params", action="store", default="", metavar="",
@@ -2440,14 +2898,27 @@ Please do so now:
     global WORKER_OUT
     global WORKER_DB
     global HEARTBEAT_DB
+    global JOB_SERVER
 
-    if in_args.workdb:
+    if in_args.workdb and job_server.is_server_address(in_args.workdb):
+        try:
+            job_server.get_authkey(job_server.parse_address(in_args.workdb)[1])
+        except job_server.JobServerError as err:
+            logging.error(str(err))
+            sys.exit()
+        JOB_SERVER = in_args.workdb
+        heartbeat = master_heartbeat()
+        heartbeat.start()
+    elif in_args.workdb:
         in_args.workdb = os.path.abspath(in_args.workdb)
         WORKER_OUT = os.path.join(in_args.workdb, ".worker_output")
         WORKER_DB = os.path.join(in_args.workdb, "work_db.sqlite")
+        if os.path.isfile(WORKER_DB):
+            # Jobs are queued with columns that databases set up by older workers don't have yet
+            helpers.prepare_work_db(WORKER_DB)
 
         HEARTBEAT_DB = os.path.join(in_args.workdb, "heartbeat_db.sqlite")
-        heartbeat = HeartBeat(HEARTBEAT_DB, MASTER_PULSE)
+        heartbeat = master_heartbeat()
         heartbeat.start()
     else:
         heartbeat = HeartBeat("", "", dummy=True)
@@ -2517,8 +2988,10 @@ Continue? y/[n] """ % len(sequences)
                       "###########################################################\n\n")
 
     # Set CPU limits
-    global CPUS
+    global CPUS, CPU_BUDGET, ALL_BY_ALL_FLIGHTS
     CPUS = in_args.max_cpus
+    CPU_BUDGET = helpers.CpuBudget(CPUS)
+    ALL_BY_ALL_FLIGHTS = helpers.SingleFlight(os.path.join(in_args.outdir, ".locks"))
 
     # PSIPRED
     logging.warning("\n** PSI-Pred **")
@@ -2545,7 +3018,8 @@ Continue? y/[n] """ % len(sequences)
 
     if records_missing_ss_files:
         logging.warning("Executing PSI-Pred on %s sequences" % len(records_missing_ss_files))
-        br.run_multicore_function(records_missing_ss_files, mc_psi_pred, [in_args.psipred_dir], max_processes=CPUS)
+        with CPU_BUDGET.hold("psipred", CPUS) as cpus:
+            br.run_multicore_function(records_missing_ss_files, mc_psi_pred, [in_args.psipred_dir], max_processes=cpus)
         logging.info("\t-- finished in %s --" % TIMER.split())
         logging.info("\tfiles saved to {0}{1}".format(in_args.psipred_dir, os.sep))
     else:
@@ -2609,6 +3083,9 @@ Continue? y/[n] """ % len(sequences)
         GELMAN_RUBIN = in_args.converge if in_args.converge else GELMAN_RUBIN
         logging.warning("Gelman-Rubin convergence breakpoint: %s" % GELMAN_RUBIN)
 
+    if in_args.stable_steps > 0:
+        logging.warning("Partition stability breakpoint: %s steps" % in_args.stable_steps)
+
     if in_args.chains >= 2:
         logging.warning("Number of MCMC chains: %s" % in_args.chains)
     else:
@@ -2626,6 +3103,13 @@ Continue? y/[n] """ % len(sequences)
                         "Switching to 2" % in_args.walkers)
         in_args.walkers = 2
 
+    # Sibling sub clusters are only optimized concurrently if asked for. Each extra thread forks its own walker pool
+    # from a multi-threaded process, so this is off by default.
+    global SIBLING_SLOTS
+    if in_args.sibling_threads > 0:
+        logging.warning("Extra threads for sibling sub clusters: %s" % in_args.sibling_threads)
+    SIBLING_SLOTS = BoundedSemaphore(max(0, in_args.sibling_threads))
+
     final_clusters = []
     progress_tracker = Progress(in_args.outdir, group_0_cluster)
 
@@ -2636,9 +3120,11 @@ Continue? y/[n] """ % len(sequences)
                                        progress=progress_tracker, outdir=in_args.outdir, steps=in_args.mcmc_steps,
                                        quiet=True, taxa_sep=in_args.taxa_sep, r_seed=in_args.r_seed,
                                        psi_pred_ss2=psi_pred_files, chains=MCMC_CHAINS, walkers=in_args.walkers,
-                                       convergence=GELMAN_RUBIN, resume=in_args.resume)
+                                       convergence=GELMAN_RUBIN, resume=in_args.resume,
+                                       stable_steps=in_args.stable_steps)
     final_clusters = [cluster for cluster in final_clusters if cluster.subgroup_counter == 0]
     run_time.end()
+    progress_tracker.flush()
 
     progress_dict = progress_tracker.read()
     logging.warning("Total MCL runs: %s" % progress_dict["mcl_runs"])
@@ -2746,7 +3232,8 @@ Continue? y/[n] """ % len(sequences)
             output += "\t".join(sorted(max_clust.seq_ids)) + '\n'
         del final_clusters[ind]
 
-    logging.warning("\nTotal execution time: %s" % TIMER.total_elapsed())
+    logging.warning("\nCPU budget utilization:\n\t%s" % "\n\t".join(CPU_BUDGET.report()))
+    logging.warning("Total execution time: %s" % TIMER.total_elapsed())
     with open(os.path.join(in_args.outdir, "final_clusters.txt"), "w") as outfile:
         outfile.write(output)
         logging.warning("Final score: %s" % round(final_score, 4))
@@ -2757,6 +3244,7 @@ Continue? y/[n] """ % len(sequences)
 
     heartbeat.end()
     broker.close()
+    ALL_BY_ALL_FLIGHTS.cleanup()
 
 
 def main():
@@ -11,8 +11,9 @@ import numpy as np
 import time
 from multiprocessing.queues import SimpleQueue
 from multiprocessing import Pipe, Process
+from threading import Thread, Timer
 from Bio.SubsMat import SeqMat, MatrixInfo
-from io import StringIO
+from io import StringIO, BytesIO
 
 pd.set_option('expand_frame_repr', False)
 
@@ -67,6 +68,33 @@ def test_exclusiveconnect(monkeypatch):
     with open(log_file, "r") as ifile:
         assert "Testing logging" in ifile.read()
 
+    # Connections can be made from outside of the main thread, where a watchdog takes the place of the alarm
+    def insert():
+        with helpers.ExclusiveConnect(os.path.join(tmpdir.path, "db.sqlite")) as _cursor:
+            _cursor.execute("INSERT INTO foo (id, some_data, numbers) VALUES (3, 'hallo', 100)")
+
+    thread = Thread(target=insert)
+    thread.start()
+    thread.join()
+    connect = sqlite3.connect(os.path.join(tmpdir.path, "db.sqlite"))
+    assert connect.execute("SELECT some_data FROM foo WHERE id=3").fetchone() == ("hallo",)
+
+    errors = []
+
+    def hold_lock():
+        try:
+            with helpers.ExclusiveConnect(os.path.join(tmpdir.path, "db.sqlite"), max_lock=1) as _cursor:
+                _cursor.execute("INSERT INTO foo (id, some_data, numbers) VALUES (4, 'hej', 125)")
+                time.sleep(1.5)
+        except EnvironmentError as _err:
+            errors.append(str(_err))
+
+    thread = Thread(target=hold_lock)
+    thread.start()
+    thread.join()
+    assert errors == ["ExclusiveConnect Lock held for over 1 seconds"]
+    assert not connect.execute("SELECT some_data FROM foo WHERE id=4").fetchone()  # Rolled back
+
     # Locked database with sleep
     class SQLiteError(object):
         def __init__(self):
@@ -88,6 +116,172 @@ def test_exclusiveconnect(monkeypatch):
     assert "Not expected" in str(err)
 
 
+def test_immediateconnect():
+    tmpdir = br.TempDir()
+    db_path = os.path.join(tmpdir.path, "db.sqlite")
+    connect = sqlite3.connect(db_path)
+    cursor = connect.cursor()
+    cursor.execute("CREATE TABLE foo (id INT PRIMARY KEY, some_data TEXT)")
+    connect.commit()
+
+    immediate = helpers.ImmediateConnect(db_path)
+    with immediate as imm_cursor:
+        imm_cursor.execute("INSERT INTO foo (id, some_data) VALUES (0, 'hello')")
+        # Readers aren't blocked while the write lock is held
+        assert not cursor.execute("SELECT * FROM foo").fetchall()
+    assert cursor.execute("SELECT * FROM foo").fetchall() == [(0, "hello")]
+    assert immediate.lock_wait >= 0
+
+    # Roll back on errors
+    with pytest.raises(ValueError):
+        with helpers.ImmediateConnect(db_path) as imm_cursor:
+            imm_cursor.execute("INSERT INTO foo (id, some_data) VALUES (1, 'bonjour')")
+            raise ValueError("Oops")
+    assert cursor.execute("SELECT * FROM foo").fetchall() == [(0, "hello")]
+
+    # Other writers time out
+    cursor.execute("BEGIN IMMEDIATE")
+    immediate = helpers.ImmediateConnect(db_path, timeout=0.1)
+    with pytest.raises(sqlite3.OperationalError) as err:
+        with immediate:
+            pass
+    assert "database is locked" in str(err)
+    assert immediate.lock_wait >= 0.1
+    connect.rollback()
+    connect.close()
+
+
+def test_snapshotconnect():
+    tmpdir = br.TempDir()
+    db_path = os.path.join(tmpdir.path, "db.sqlite")
+    connect = sqlite3.connect(db_path, isolation_level=None)
+    connect.execute("CREATE TABLE foo (id INT PRIMARY KEY, some_data TEXT)")
+    connect.execute("INSERT INTO foo (id, some_data) VALUES (0, 'hello')")
+
+    # A writer part way through a transaction doesn't get in the way, and its changes aren't seen yet
+    connect.execute("BEGIN IMMEDIATE")
+    connect.execute("INSERT INTO foo (id, some_data) VALUES (1, 'bonjour')")
+    snapshot = helpers.SnapshotConnect(db_path, timeout=0.1)
+    with snapshot as snap_cursor:
+        assert snap_cursor.execute("SELECT * FROM foo").fetchall() == [(0, "hello")]
+        # Read only
+        with pytest.raises(sqlite3.OperationalError) as err:
+            snap_cursor.execute("INSERT INTO foo (id, some_data) VALUES (2, 'hola')")
+        assert "readonly" in str(err)
+    assert snapshot.lock_wait >= 0
+    connect.execute("COMMIT")
+    connect.close()
+
+    # Missing databases aren't created
+    with pytest.raises(sqlite3.OperationalError):
+        with helpers.SnapshotConnect(os.path.join(tmpdir.path, "missing.sqlite")):
+            pass
+    assert os.listdir(tmpdir.path) == ["db.sqlite"]
+
+
+def test_snapshotconnect_lag():
+    tmpdir = br.TempDir()
+    db_path = os.path.join(tmpdir.path, "db.sqlite")
+    connect = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    connect.execute("CREATE TABLE foo (id INT PRIMARY KEY, some_data TEXT)")
+
+    # With a rollback journal, a writer committing holds everyone off, and the time spent waiting is the lag
+    connect.execute("BEGIN EXCLUSIVE")
+    release = Timer(0.3, connect.execute, args=("COMMIT",))
+    release.start()
+    with helpers.SnapshotConnect(db_path, timeout=5) as snap_cursor:
+        assert snap_cursor.lag >= 0.2
+    release.join()
+
+    # In WAL mode the snapshot goes ahead without waiting
+    assert helpers.enable_wal(db_path)
+    connect.execute("BEGIN EXCLUSIVE")
+    connect.execute("INSERT INTO foo (id, some_data) VALUES (0, 'hello')")
+    with helpers.SnapshotConnect(db_path, timeout=5) as snap_cursor:
+        assert snap_cursor.lag < 0.2
+        assert snap_cursor.execute("SELECT * FROM foo").fetchall() == []
+    connect.execute("COMMIT")
+    connect.close()
+
+
+def test_enable_wal(monkeypatch):
+    tmpdir = br.TempDir()
+    db_path = os.path.join(tmpdir.path, "db.sqlite")
+    mounts = tmpdir.subfile("mounts")
+    with open(mounts, "w") as ofile:
+        ofile.write("/dev/sda1 / ext4 rw 0 0\nserver:/export %s nfs4 rw 0 0\n" % tmpdir.path)
+
+    real_open = open
+    monkeypatch.setattr(helpers, "open", lambda path, *args: real_open(mounts if path == "/proc/mounts" else path,
+                                                                        *args), raising=False)
+    assert helpers.network_file_system(db_path) == "nfs4"
+    assert helpers.network_file_system("/usr") is None
+    assert not helpers.enable_wal(db_path)
+    assert not os.path.isfile(db_path)
+
+    monkeypatch.undo()
+    monkeypatch.setattr(helpers, "network_file_system", lambda *_: None)
+    assert helpers.enable_wal(db_path)
+    connection = sqlite3.connect(db_path)
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    connection.close()
+
+    # Work databases are switched over when they're prepared
+    wdb_path = os.path.join(tmpdir.path, "work_db.sqlite")
+    helpers.prepare_work_db(wdb_path)
+    connection = sqlite3.connect(wdb_path)
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    connection.close()
+
+
+def test_job_priority(monkeypatch):
+    assert helpers.job_cost(1) == 0
+    assert helpers.job_cost(10) == 45
+
+    assert helpers.job_priority(0) == 0
+    assert helpers.job_priority(3) == 2
+    assert helpers.job_priority(3, depth=2) == 3
+    monkeypatch.setattr(helpers, "time", lambda *_: 7200)
+    assert helpers.job_priority(3, depth=2, master_start=3600) == 4
+
+    # Doubling in size is worth the same as QUEUE_AGING seconds in the queue
+    assert helpers.queue_rank(3, 1000 - helpers.QUEUE_AGING) == helpers.queue_rank(4, 1000)
+    assert helpers.queue_rank(helpers.job_priority(helpers.job_cost(20)), 1000) > \
+        helpers.queue_rank(helpers.job_priority(helpers.job_cost(10)), 1000)
+
+
+def test_prepare_work_db():
+    tmpdir = br.TempDir()
+    wdb_path = os.path.join(tmpdir.path, "work_db.sqlite")
+
+    # A queue set up before jobs had a cost, priority, or queue time
+    connection = sqlite3.connect(wdb_path)
+    connection.execute("CREATE TABLE queue (hash TEXT PRIMARY KEY, psi_pred_dir TEXT, align_m TEXT, align_p TEXT, "
+                       "trimal TEXT, gap_open FLOAT, gap_extend FLOAT)")
+    connection.execute("INSERT INTO queue (hash) VALUES ('foo')")
+    connection.commit()
+    connection.close()
+
+    helpers.prepare_work_db(wdb_path)
+    helpers.prepare_work_db(wdb_path)  # Nothing left to do the second time around
+    connection = sqlite3.connect(wdb_path)
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(queue)").fetchall()]
+    assert columns[-3:] == ["cost", "priority", "queued"]
+    assert connection.execute("SELECT hash, cost, priority, queued FROM queue").fetchall() == [("foo", 0, 0, 0)]
+    tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
+    assert sorted(tables) == ["complete", "proc_comp", "processing", "queue", "throughput", "waiting"]
+
+    # Claims walk the rank index instead of sorting the queue
+    plan = connection.execute("EXPLAIN QUERY PLAN SELECT rowid FROM queue ORDER BY %s DESC, rowid LIMIT 1"
+                              % helpers.QUEUE_RANK_SQL).fetchall()
+    assert "USING INDEX queue_rank" in plan[-1][-1]
+    assert "TEMP B-TREE" not in str(plan)
+
+    # What a new master queues now goes in without a worker ever having touched the database
+    connection.execute("INSERT INTO queue (hash, cost, priority, queued) VALUES ('bar', 45, 5.5, 1000)")
+    connection.close()
+
+
 def test_sqlitebroker_init():
     tmpdir = br.TempDir()
     broker = helpers.SQLiteBroker(os.path.join(tmpdir.path, "db.sqlite"))
@@ -294,6 +488,136 @@ def test_timer(monkeypatch):
     assert timer.total_elapsed(prefix="start_", postfix="_end") == 'start_3 sec_end'
 
 
+def test_cpu_budget():
+    budget = helpers.CpuBudget(4)
+    assert budget.cpus == 4
+    assert budget.held() == 0
+
+    assert budget.available() == 4
+    with budget.hold("all_by_all", 3) as cpus:
+        assert cpus == 3
+        assert budget.held() == 3
+        assert budget.available() == 1
+        # Nested stages reuse the parent's token, and only pick up whatever is spare
+        with budget.hold("mcl", 4) as nested_cpus:
+            assert nested_cpus == 2
+            assert budget.held() == 4
+            with budget.hold("mcmcmc") as nested_cpus2:
+                assert nested_cpus2 == 1
+                assert not budget.tokens.acquire(block=False)
+        assert budget.held() == 3
+    assert budget.held() == 0
+
+    # Never ask for more than the budget
+    with budget.hold("psipred", 100) as cpus:
+        assert cpus == 4
+
+    # Other processes share the same tokens
+    def hold_all(_budget, _pipe):
+        with _budget.hold("placement", 4) as _cpus:
+            _pipe.send(_cpus)
+            _pipe.recv()
+
+    parent_pipe, child_pipe = Pipe()
+    proc = Process(target=hold_all, args=(budget, child_pipe))
+    proc.start()
+    assert parent_pipe.recv() == 4
+    assert not budget.tokens.acquire(block=False)
+    parent_pipe.send("done")
+    proc.join()
+    with budget.hold("placement", 4) as cpus:
+        assert cpus == 4
+
+    with pytest.raises(ValueError) as err:
+        with budget.hold("foo"):
+            pass
+    assert "Unknown CpuBudget stage 'foo'" in str(err)
+
+    report = budget.report()
+    assert len(report) == 5
+    assert report[0].startswith("mcl: ")
+    assert "of 4 cores (1 calls, peak 2 cores)" in report[0]
+    assert "placement: " in report[4] and "(2 calls, peak 4 cores)" in report[4]
+
+
+def test_single_flight(monkeypatch):
+    tmp_dir = br.TempDir()
+    lock_dir = os.path.join(tmp_dir.path, "locks")
+    flights = helpers.SingleFlight(lock_dir)
+    assert not os.path.isdir(lock_dir)  # Nothing is created until it's needed
+
+    # Nobody else holds the key
+    with flights.claim("foo") as waited:
+        assert waited is False
+        assert os.path.isfile(os.path.join(lock_dir, "foo.lock"))
+    assert os.listdir(lock_dir) == []  # Holders clean up after themselves
+    with flights.claim("foo") as waited:
+        assert waited is False
+
+    # Another process holds the key, so wait for it (and then lock the file that replaces the one it removed)
+    def hold_key(_flights, _pipe):
+        with _flights.claim("foo"):
+            _pipe.send("claimed")
+            time.sleep(0.3)
+
+    parent_pipe, child_pipe = Pipe()
+    proc = Process(target=hold_key, args=(flights, child_pipe))
+    proc.start()
+    assert parent_pipe.recv() == "claimed"
+    with flights.claim("bar") as waited:
+        assert waited is False
+    with flights.claim("foo") as waited:
+        assert waited is True
+        assert os.listdir(lock_dir) == ["foo.lock"]
+    proc.join()
+    assert os.listdir(lock_dir) == []
+
+    # The lock directory is removed at the end of the run, but only by the process that made the guard
+    proc = Process(target=flights.cleanup)
+    proc.start()
+    proc.join()
+    assert os.path.isdir(lock_dir)
+    flights.cleanup()
+    assert not os.path.isdir(lock_dir)
+    flights.cleanup()  # Nothing left to remove
+
+    # Forked children share the default directory with the process that made the guard, and it goes when that exits
+    exit_funcs = []
+    monkeypatch.setattr(helpers.atexit, "register", exit_funcs.append)
+    flights = helpers.SingleFlight()
+    assert flights.lock_dir.endswith("rdmcl_locks_%s" % os.getpid())
+    assert exit_funcs == [flights.cleanup]
+
+
+def test_seq_index(hf):
+    seqbuddy = helpers.Sb.SeqBuddy(hf.get_data("cteno_panxs"))
+    seq_index = helpers.SeqIndex(seqbuddy)
+    assert len(seq_index) == len(seqbuddy.records)
+
+    # Records keep their original order and are shared, not copied
+    subset = seq_index.subset(["Vpa-PanxαB", "BOL-PanxαA", "Bab-PanxαB", "Foo-bar"])
+    assert [rec.id for rec in subset.records] == [rec.id for rec in seqbuddy.records
+                                                  if rec.id in ["Vpa-PanxαB", "BOL-PanxαA", "Bab-PanxαB"]]
+    assert subset.records[0] is seqbuddy.records[seq_index.positions[subset.records[0].id][0]]
+    assert subset.in_format == seqbuddy.in_format
+    assert subset.out_format == seqbuddy.out_format
+    assert subset.alpha == seqbuddy.alpha
+    assert len(seqbuddy.records) == len(seq_index)
+
+    # Same result as a regex pull
+    ids = ["Mle-Panxα10A", "Tin-PanxαC", "Edu-PanxαA"]
+    pulled = helpers.Sb.pull_recs(helpers.Sb.make_copy(seqbuddy), "^%s$" % "$|^".join(ids))
+    assert str(seq_index.subset(ids)) == str(pulled)
+    assert str(seq_index.subset([])) == "Error: No sequences in object.\n"
+
+    # Repeated ids are all returned
+    seqbuddy = helpers.Sb.rename(seqbuddy, "^.*?\\-")
+    seq_index = helpers.SeqIndex(seqbuddy)
+    pulled = helpers.Sb.pull_recs(helpers.Sb.make_copy(seqbuddy), "^PanxαB$")
+    assert len(pulled.records) > 1
+    assert str(seq_index.subset(["PanxαB"])) == str(pulled)
+
+
 def test_mean(hf):
     data = hf.get_data("cteno_sim_scores")
     assert helpers.mean(data.score) == 0.40629959990800002
@@ -308,6 +632,45 @@ def test_md5_hash():
     assert helpers.md5_hash("Hello") == "8b1a9953c4611296a827abf8c47804d7"
 
 
+def test_wait_for_change():
+    tmp_dir = br.TempDir()
+    marker = os.path.join(tmp_dir.path, "job.done")
+    assert helpers.file_state(marker) is None
+
+    # Nothing happens, so wait out the timeout
+    start_time = time.time()
+    assert helpers.wait_for_change(marker, None, 0.3, interval=0.05) is None
+    assert time.time() - start_time >= 0.3
+
+    # Marker shows up
+    Thread(target=lambda: (time.sleep(0.2), open(marker, "w").close())).start()
+    start_time = time.time()
+    state = helpers.wait_for_change(marker, None, 30, interval=0.05)
+    assert state == helpers.file_state(marker)
+    assert time.time() - start_time < 10
+
+    # Marker is removed
+    Thread(target=lambda: (time.sleep(0.2), os.remove(marker))).start()
+    assert helpers.wait_for_change(marker, state, 30, interval=0.05) is None
+
+
+def test_write_read_graph():
+    tmp_dir = br.TempDir()
+    sim_scores = pd.DataFrame([["Bab", "Cfu", 0.25, 0.123456789012345], ["Bab", "Oma", 1., 0.],
+                               ["Cfu", "Oma", 0.5, 0.75]], columns=["seq1", "seq2", "subsmat", "psi"])
+    graph_path = os.path.join(tmp_dir.path, "foo.graph")
+    helpers.write_graph(sim_scores, graph_path)
+    assert os.listdir(tmp_dir.path) == ["foo.graph"]
+    assert helpers.read_graph(graph_path).equals(sim_scores)  # No precision is lost
+
+    # File objects work too, and so do empty graphs
+    graph = BytesIO()
+    helpers.write_graph(sim_scores.iloc[0:0], graph)
+    graph = helpers.read_graph(BytesIO(graph.getvalue()))
+    assert graph.empty
+    assert list(graph.columns) == ["seq1", "seq2", "subsmat", "psi"]
+
+
 def test_make_full_mat():
     blosum62 = helpers.make_full_mat(SeqMat(MatrixInfo.blosum62))
     assert blosum62["A", "B"] == -2
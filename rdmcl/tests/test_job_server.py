@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import os
+import json
+import time
+import socket
+from threading import Thread
+from multiprocessing.connection import AuthenticationError
+from buddysuite import buddy_resources as br
+from .. import job_server
+
+
+def start_server(tmp_dir, **kwargs):
+    server = job_server.JobServer("unix://%s" % os.path.join(tmp_dir.path, "jobs.sock"), **kwargs)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    while not os.path.exists(server.listen_address):
+        time.sleep(0.01)
+    return server, thread
+
+
+def test_addresses():
+    assert job_server.is_server_address("tcp://localhost:5000")
+    assert job_server.is_server_address("unix:///tmp/rdmcl.sock")
+    assert not job_server.is_server_address("/some/work/dir")
+    assert not job_server.is_server_address("")
+
+    assert job_server.parse_address("tcp://localhost:5000") == (("localhost", 5000), "AF_INET")
+    assert job_server.parse_address("unix:///tmp/rdmcl.sock") == ("/tmp/rdmcl.sock", "AF_UNIX")
+    with pytest.raises(ValueError) as err:
+        job_server.parse_address("/some/work/dir")
+    assert "tcp://host:port or unix:///path" in str(err)
+
+
+def test_authkey(monkeypatch):
+    monkeypatch.delenv("RDMCL_JOB_KEY", raising=False)
+    assert job_server.get_authkey("AF_UNIX") == b"rdmcl"
+    with pytest.raises(job_server.JobServerError) as err:
+        job_server.get_authkey("AF_INET")
+    assert "Set RDMCL_JOB_KEY" in str(err)
+    with pytest.raises(job_server.JobServerError):
+        job_server.JobServer("tcp://localhost:5000")
+    with pytest.raises(job_server.JobServerError) as err:
+        job_server.JobServer("tcp://localhost:5000", authkey=b"rdmcl")
+    assert "Refusing to listen on TCP with the default key" in str(err)
+
+    monkeypatch.setenv("RDMCL_JOB_KEY", "s3cret")
+    assert job_server.get_authkey("AF_INET") == b"s3cret"
+    assert job_server.get_authkey("AF_UNIX") == b"s3cret"
+    assert job_server.JobServer("tcp://localhost:5000").authkey == b"s3cret"
+    assert job_server.JobClient("tcp://localhost:5000").authkey == b"s3cret"
+
+
+def test_job_lifecycle():
+    tmp_dir = br.TempDir()
+    server, thread = start_server(tmp_dir)
+    client = job_server.JobClient(server.address)
+
+    master_id = client.register("master")
+    worker_id = client.register("worker")
+    assert (master_id, worker_id) == (1, 2)
+    assert client.status() == {"masters": 1, "workers": 1, "queue": 0, "processing": 0, "complete": 0, "waiting": 0}
+
+    # Nothing to claim
+    assert client.claim(worker_id, timeout=0.1) is None
+
+    assert client.submit("job1", master_id, ">A\nMK\n>B\nMR\n", {"gap_open": -5}) == "queued"
+    assert client.submit("job1", master_id, ">A\nMK\n>B\nMR\n", {"gap_open": -5}) == "queued"  # No duplicates
+    assert client.status()["queue"] == 1
+    assert client.result("job1", master_id)["status"] == "pending"
+    assert client.result("job1", master_id)["workers"] == 1
+
+    job = client.claim(worker_id)
+    assert time.time() - 10 < job.pop("queued") <= job.pop("claimed") <= time.time()
+    assert job == {"job_id": "job1", "seqs": ">A\nMK\n>B\nMR\n", "params": {"gap_open": -5}, "priority": 0}
+    assert client.status()["processing"] == 1
+
+    # Masters waiting on a result are woken up as soon as it comes in
+    Thread(target=lambda: (time.sleep(0.2), client.complete("job1", worker_id, ">A\nMK\n>B\nMR\n", "A,B,1"))).start()
+    start_time = time.time()
+    result = client.result("job1", master_id, timeout=30)
+    assert time.time() - start_time < 10
+    assert 0.2 <= result.pop("secs") < 10  # Service time, from the claim to the result coming in
+    assert result == {"status": "complete", "alignment": ">A\nMK\n>B\nMR\n", "graph": "A,B,1"}
+
+    # The result is dropped once the last master has picked it up
+    assert client.result("job1", master_id) == {"status": "missing"}
+    assert client.status() == {"masters": 1, "workers": 1, "queue": 0, "processing": 0, "complete": 0, "waiting": 0}
+
+    # Workers waiting on a claim are woken up by new jobs
+    Thread(target=lambda: (time.sleep(0.2), client.submit("job2", master_id, "", {}))).start()
+    assert client.claim(worker_id, timeout=30)["job_id"] == "job2"
+
+    # Nobody is waiting on a cancelled job, so its results go nowhere
+    client.cancel("job2", master_id)
+    assert not client.complete("job2", worker_id, "", "")
+    assert client.status()["complete"] == 0
+
+    # Highest priority first, first in first out among equals
+    for job_id, priority in [("small1", 1), ("big", 5), ("small2", 1)]:
+        client.submit(job_id, master_id, "", {}, priority=priority)
+    assert [client.claim(worker_id)["job_id"] for _ in range(3)] == ["big", "small1", "small2"]
+
+    with pytest.raises(job_server.JobServerError) as err:
+        client.call("nonsense")
+    assert "Unknown command 'nonsense'" in str(err)
+    with pytest.raises(job_server.JobServerError) as err:
+        client.call("status", foo="bar")
+    assert "TypeError" in str(err)
+
+    server.shutdown()
+    thread.join()
+    assert not os.path.exists(server.listen_address)
+
+
+def test_dead_threads():
+    tmp_dir = br.TempDir()
+    server, thread = start_server(tmp_dir, dead_thread_wait=0.5)
+    client = job_server.JobClient(server.address)
+    master_id = client.register("master")
+    worker_id = client.register("worker")
+
+    client.submit("job1", master_id, "", {})
+    assert client.claim(worker_id)["job_id"] == "job1"
+
+    # A worker that ends (or stops pulsing) puts its job back on the queue
+    client.end(worker_id)
+    assert client.status()["workers"] == 0
+    assert client.status()["queue"] == 1
+
+    # If the worker finishes the job after all, it comes off of the queue instead of being handed out again
+    assert client.complete("job1", worker_id, "aln1", b"graph1")
+    assert client.status()["queue"] == 0
+    assert client.status()["complete"] == 1
+
+    # Jobs are dropped when their masters stop pulsing
+    time.sleep(0.6)
+    assert client.status() == {"masters": 0, "workers": 0, "queue": 0, "processing": 0, "complete": 0, "waiting": 0}
+
+    server.shutdown()
+    thread.join()
+
+
+def test_authentication(monkeypatch):
+    monkeypatch.setattr(job_server, "AUTH_TIMEOUT", 0.5)
+    tmp_dir = br.TempDir()
+    server, thread = start_server(tmp_dir)
+
+    # A client that connects and never answers the challenge doesn't hold anyone else up
+    stalled = socket.socket(socket.AF_UNIX)
+    stalled.connect(server.listen_address)
+    client = job_server.JobClient(server.address)
+    assert client.register("master") == 1
+
+    # and it gets hung up on once AUTH_TIMEOUT is up
+    stalled.settimeout(5)
+    start_time = time.time()
+    while stalled.recv(1024):  # The challenge, then nothing
+        pass
+    assert time.time() - start_time < 5
+    stalled.close()
+
+    # Wrong keys are turned away
+    with pytest.raises(AuthenticationError):
+        job_server.JobClient(server.address, authkey=b"wrong").status()
+    assert client.status()["masters"] == 1
+
+    server.shutdown()
+    thread.join()
+
+
+def test_journal(monkeypatch):
+    tmp_dir = br.TempDir()
+    journal = os.path.join(tmp_dir.path, "journal")
+    server, thread = start_server(tmp_dir, journal=journal)
+    client = job_server.JobClient(server.address)
+    master_id = client.register("master")
+    worker_id = client.register("worker")
+    client.submit("job1", master_id, "seqs1", {})
+    client.submit("job2", master_id, "seqs2", {})
+    client.submit("job3", master_id, "seqs3", {})
+    client.claim(worker_id)
+    client.claim(worker_id)
+    client.complete("job1", worker_id, "aln1", b"graph1")
+    client.cancel("job3", master_id)
+    server.shutdown()
+    thread.join()
+    with open(journal, "a") as ofile:
+        ofile.write('{"op": "queue", "jo')  # Crashed half way through a write
+
+    # Finished jobs are kept, jobs that were being processed go back on the queue, and cancelled jobs are gone
+    server = job_server.JobServer(server.address, journal=journal)
+    assert list(server.results) == ["job1"]
+    assert server.results["job1"] == {"alignment": "aln1", "graph": b"graph1"}
+    assert list(server.queue) == ["job2"]
+    assert server.waiting == {"job1": {master_id}, "job2": {master_id}}
+    assert server.thread_counter == 2
+
+    # The journal is compacted on start up, and results are kept outside of it
+    with open(journal, "r") as ifile:
+        entries = [json.loads(line) for line in ifile]
+    assert [entry["op"] for entry in entries] == ["register", "queue", "complete", "wait", "wait"]
+    assert entries[2] == {"op": "complete", "job_id": "job1"}
+    assert os.listdir(server.results_dir) == [os.path.basename(server._result_path("job1"))]
+
+    # Result files are removed as soon as the last master has picked them up
+    with server.lock:
+        assert server.cmd_result("job1", master_id)["graph"] == b"graph1"
+    assert os.listdir(server.results_dir) == []
+
+    # A result file that went missing means the job has to be run again
+    with server.lock:
+        server.cmd_complete("job2", worker_id, "aln2", b"graph2")
+    os.remove(server._result_path("job2"))
+    server = job_server.JobServer(server.address, journal=journal)
+    assert not server.results
+    assert list(server.queue) == ["job2"]
+
+    # The journal is compacted once it gets long
+    monkeypatch.setattr(job_server, "COMPACT_EVERY", 5)
+    with server.lock:
+        for _ in range(4):
+            server.cmd_submit("job2", master_id + 1, "seqs2", {})
+            server.cmd_cancel("job2", master_id + 1)
+    assert server.journal_lines < 5
+    with open(journal, "r") as ifile:
+        assert len(ifile.readlines()) < 11  # 3 lines of state and 8 changes if it had never been compacted
+
+
+def test_server_heartbeat():
+    tmp_dir = br.TempDir()
+    server, thread = start_server(tmp_dir)
+    client = job_server.JobClient(server.address)
+
+    heartbeat = job_server.ServerHeartBeat(server.address, 0.05)
+    assert heartbeat.location == server.address
+    master_id = heartbeat.attach("job1")
+    assert master_id == 1
+    assert heartbeat.attach("job2") == master_id
+    time.sleep(0.2)
+    assert server.threads[master_id][1] > time.time() - 0.2
+
+    # Pulses stop after the last job is done
+    heartbeat.detach("job1")
+    assert heartbeat._thread.is_alive()
+    heartbeat.detach("job2")
+    time.sleep(0.2)
+    assert not heartbeat._thread.is_alive()
+
+    # A run-wide heartbeat keeps going, and is cleared off the server when it ends
+    heartbeat.start()
+    heartbeat.attach("job1")
+    heartbeat.detach("job1")
+    time.sleep(0.2)
+    assert heartbeat._thread.is_alive()
+    heartbeat.end()
+    assert heartbeat.id is None
+    assert client.status()["masters"] == 0
+
+    # Forked processes lean on a run-wide heartbeat instead of starting their own pulse threads
+    heartbeat.start()
+    master_id = heartbeat.id
+    parent_thread = heartbeat._thread
+    heartbeat.owner_pid = -1  # Pretend this is a forked child
+    assert heartbeat.attach("job1") == master_id
+    assert heartbeat._thread is parent_thread
+    heartbeat.detach("job1")
+    heartbeat.end()
+    assert master_id in server.threads  # Only the owner clears it off the server
+
+    # ... but register and pulse for themselves when the parent was only pulsing for its own jobs
+    heartbeat = job_server.ServerHeartBeat(server.address, 0.05)
+    parent_id = heartbeat.attach("job1")
+    heartbeat.owner_pid = -1
+    child_id = heartbeat.attach("job2")
+    assert child_id != parent_id
+    assert heartbeat.jobs == {"job2"}
+    heartbeat.end()
+    assert child_id not in server.threads
+
+    server.shutdown()
+    thread.join()
@@ -7,6 +7,8 @@ import dill
 import random
 import pandas as pd
 from collections import OrderedDict
+from copy import deepcopy
+from time import sleep
 from types import SimpleNamespace
 from buddysuite import buddy_resources as br
 from multiprocessing import Lock
@@ -14,46 +16,122 @@ from multiprocessing import Lock
 from .. import mcmcmc
 
 
+def history(var):
+    return [(key, list(values)) for key, values in var.history.items()]
+
+
+def test_reflect():
+    assert mcmcmc._reflect(2.5, 2, 5) == 2.5
+    assert mcmcmc._reflect(1.5, 2, 5) == 2.5
+    assert mcmcmc._reflect(5.5, 2, 5) == 4.5
+    # Bounce off both walls
+    assert mcmcmc._reflect(9.5, 2, 5) == 3.5
+    assert mcmcmc._reflect(-4.5, 2, 5) == 2.5
+    assert list(mcmcmc._reflect(mcmcmc.np.array([[1.5, 5.5], [3., 12.]]), 2, 5).flatten()) == [2.5, 4.5, 3., 4.]
+    # Zero width range
+    assert mcmcmc._reflect(7, 2, 2) == 2
+
+
+def test_ring_buffer():
+    buffer = mcmcmc._RingBuffer(3)
+    assert len(buffer) == 0
+    assert buffer.append(1.) is None
+    assert buffer.append(2.) is None
+    assert buffer.append(3.) is None
+    assert list(buffer) == [1., 2., 3.]
+
+    # Oldest values are pushed out once the buffer is full
+    assert buffer.append(4.) == 1.
+    assert buffer.append(5.) == 2.
+    assert list(buffer) == [3., 4., 5.]
+    assert buffer[-1] == 5.
+    assert len(buffer) == 3
+    assert buffer.total == 5
+    assert str(buffer) == "[3.0, 4.0, 5.0]"
+
+    buffer.truncate(4)
+    assert list(buffer) == [3., 4.]
+    assert buffer.total == 4
+    buffer.truncate(10)
+    assert list(buffer) == [3., 4.]
+
+
+def test_ring_buffer_spill():
+    tmp_file = br.TempFile()
+    buffer = mcmcmc._RingBuffer(2, spill_file=tmp_file.path)
+    for value in range(5):
+        buffer.append(value)
+    assert tmp_file.read() == "0.0\n1.0\n2.0\n3.0\n"
+    assert list(buffer) == [3., 4.]
+
+
+def test_ring_buffer_dump():
+    buffer = mcmcmc._RingBuffer(3)
+    buffer.append(1.)
+    assert buffer._dump_obj() == (0, [1.])
+    buffer.append(2.)
+    buffer.append(3.)
+    assert buffer._dump_obj() == (1, [2., 3.])
+    assert buffer._dump_obj() == (3, [])
+
+    # If more values come in than the buffer holds, only the ones still held are dumped
+    for value in range(4, 9):
+        buffer.append(value)
+    assert buffer._dump_obj() == (5, [6., 7., 8.])
+
+    new_buffer = mcmcmc._RingBuffer(3)
+    new_buffer.append(100.)  # Replaying dumps overwrites anything at or past the dump's start position
+    for dump in [(0, [1.]), (1, [2., 3.]), (3, []), (5, [6., 7., 8.])]:
+        new_buffer._apply_dump(dump)
+    assert list(new_buffer) == [6., 7., 8.]
+    assert new_buffer.total == 6
+    assert new_buffer.logged == 6
+
+
 def test_variable_init():
     var = mcmcmc.Variable("foo", min_val=2, max_val=5, r_seed=1)
     assert var.name == "foo"
     assert var.min == 2
     assert var.max == 5
-    assert round(var.rand_gen.random(), 12) == 0.847433736937
-    assert var.current_value == 2.403092732337
-    assert var.draw_value == 2.403092732337
-    assert var.history == OrderedDict([('draws', [2.403092732337]), ('accepts', [])])
+    assert round(var.rand_gen.random(), 12) == 0.950463696326
+    assert var.current_value == 3.535464874101
+    assert var.draw_value == 3.535464874101
+    assert history(var) == [('draws', [3.535464874101]), ('accepts', [])]
+    assert var.history["draws"].capacity == 1000
+
+    var = mcmcmc.Variable("foo", min_val=2, max_val=5, r_seed=1, history_size=10)
+    assert var.history["draws"].capacity == 10
+    assert var.history["accepts"].capacity == 10
 
 
 def test_variable_draw_new_value():
     var = mcmcmc.Variable("foo", min_val=2, max_val=5, r_seed=1)
     var.draw_new_value(heat=0.1)
-    assert var.draw_value == 2.695965617119
-    assert var.history == OrderedDict([('draws', [2.403092732337, 2.695965617119]), ('accepts', [])])
+    assert var.draw_value == 3.781950317151
+    assert history(var) == [('draws', [3.535464874101, 3.781950317151]), ('accepts', [])]
 
     var.current_value = 1.9
     var.draw_new_value(heat=0.1)
-    assert var.draw_value == 2.517084979257
-    assert var.history == OrderedDict([('draws', [2.403092732337, 2.695965617119, 2.517084979257]), ('accepts', [])])
+    assert var.draw_value == 2.000868877145
+    assert history(var) == [('draws', [3.535464874101, 3.781950317151, 2.000868877145]), ('accepts', [])]
 
     var.current_value = 5.1
     var.draw_new_value(heat=0.1)
-    assert var.draw_value == 4.911174134664
-    assert var.history == OrderedDict([('draws', [2.403092732337, 2.695965617119, 2.517084979257, 4.911174134664]),
-                                       ('accepts', [])])
+    assert var.draw_value == 4.709052830519
+    assert history(var) == [('draws', [3.535464874101, 3.781950317151, 2.000868877145, 4.709052830519]),
+                            ('accepts', [])]
 
+    # Values way outside of the range are still reflected back in
     var.current_value = 100000
-    with pytest.raises(RuntimeError) as err:
-        var.draw_new_value(0.1)
-
-    assert "Popped safety valve in Variable.draw_new_value() (draw val = 99700.3507217117)" in str(err)
+    var.draw_new_value(0.1)
+    assert var.draw_value == 4.271606759998
 
 
 def test_variable_draw_random():
     var = mcmcmc.Variable("foo", min_val=2, max_val=5, r_seed=1)
     var.draw_random()
-    assert var.current_value == 4.542301210812
-    assert var.draw_value == 4.542301210812
+    assert var.current_value == 4.851391088978
+    assert var.draw_value == 4.851391088978
 
 
 def test_variable_set_value():
@@ -68,7 +146,59 @@ def test_variable_accept_draw():
     var.draw_value = 1234
     var.accept_draw()
     assert var.current_value == 1234
-    assert var.history == OrderedDict([('draws', [2.403092732337]), ('accepts', [1234])])
+    assert history(var) == [('draws', [3.535464874101]), ('accepts', [1234])]
+
+
+def test_variable_spill_history():
+    tmp_dir = br.TempDir()
+    var = mcmcmc.Variable("foo", min_val=2, max_val=5, r_seed=1, history_size=2)
+    var.spill_history(os.path.join(tmp_dir.path, "foo"))
+    assert var.history["draws"].spill_file == os.path.join(tmp_dir.path, "foo_draws.txt")
+    assert var.history["accepts"].spill_file == os.path.join(tmp_dir.path, "foo_accepts.txt")
+    var.draw_new_value(heat=0.1)
+    with open(os.path.join(tmp_dir.path, "foo_draws.txt"), "r") as ifile:
+        assert ifile.read() == "3.535464874101\n3.781950317151\n"
+
+
+def test_variable_dump_obj():
+    var = mcmcmc.Variable("foo", min_val=2, max_val=5, r_seed=1)
+    dump = var._dump_obj()
+    assert dump["current"] == 3.535464874101
+    assert dump["draw"] == 3.535464874101
+    assert dump["rand_state"] == var.rand_gen.bit_generator.state
+    assert dump["history"] == OrderedDict([('draws', (0, [3.535464874101])), ('accepts', (0, []))])
+
+    # Only new history is included in the next dump
+    var.draw_new_value(heat=0.1)
+    var.accept_draw()
+    dump = var._dump_obj()
+    assert dump["current"] == 3.781950317151
+    assert dump["history"] == OrderedDict([('draws', (1, [3.781950317151])), ('accepts', (0, [3.781950317151]))])
+
+    dump = var._dump_obj()
+    assert dump["history"] == OrderedDict([('draws', (2, [])), ('accepts', (1, []))])
+
+
+def test_variable_apply_dump():
+    var = mcmcmc.Variable("foo", min_val=2, max_val=5, r_seed=1)
+    dumps = [var._dump_obj()]
+    for _ in range(3):
+        var.draw_new_value(heat=0.1)
+        var.accept_draw()
+        dumps.append(var._dump_obj())
+    next_draw = deepcopy(var)
+    next_draw.draw_new_value(heat=0.1)
+
+    new_var = mcmcmc.Variable("foo", min_val=2, max_val=5, r_seed=12345)
+    for dump in dumps:
+        new_var._apply_dump(dump)
+    assert new_var.current_value == var.current_value
+    assert new_var.draw_value == var.draw_value
+    assert history(new_var) == history(var)
+
+    # Random generator picks up in the same place
+    new_var.draw_new_value(heat=0.1)
+    assert new_var.draw_value == next_draw.draw_value
 
 
 def test_variable_str():
@@ -77,9 +207,9 @@ def test_variable_str():
 Name: foo
 Min: 2
 Max: 5
-Current value: 2.403092732337
-Draw value: 2.403092732337
-History: [('draws', [2.403092732337]), ('accepts', [])]
+Current value: 3.535464874101
+Draw value: 3.535464874101
+History: [('draws', [3.535464874101]), ('accepts', [])]
 """
 
 
@@ -94,12 +224,15 @@ def test_walker_init(capsys):
     assert walker.variables == [foo_var, bar_var]
     assert walker.function() == 4
     assert walker.params == ["foo", "bar"]
+    assert walker.memo_key is None
     assert walker.lava is True
     assert walker.ice is False
     assert walker.heat == 0.1
     assert walker.current_score is None
     assert walker.proposed_score is None
-    assert walker.score_history == [1, 5]
+    assert list(walker.score_history) == [1, 5]
+    assert walker.score_stats.count == 2
+    assert walker.score_stats.mean[0] == 3
     assert round(walker.rand_gen.random(), 12) == 0.83576510392
     assert walker.name == "iK2ZWeqhFWCEPyYngFb5"
 
@@ -117,7 +250,7 @@ def test_walker_init(capsys):
     # Find starting params
     walker = mcmcmc._Walker(variables=[foo_var, bar_var], func=lambda *_: rand_gen.random(), heat=0.1,
                             params=["foo", "bar"], quiet=False, r_seed=1)
-    assert walker.score_history == [0.134364244112, 0.847433736937]
+    assert list(walker.score_history) == [0.134364244112, 0.847433736937]
     out, err = capsys.readouterr()
     assert out == """\
 Setting initial chain parameters:
@@ -176,42 +309,76 @@ def test_walker_set_heat():
     assert "heat values must be positive, between 0.000001 and 1.0." in str(err)
 
 
+def test_walker_record_score():
+    foo_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.1, name="foo", current_value=0.15)
+    walker = mcmcmc._Walker(variables=[foo_var], func=lambda *_: 1, heat=0.1, min_max=(1, 5), r_seed=1, quiet=True)
+    walker.score_history = mcmcmc._RingBuffer(3)
+    walker.score_stats = mcmcmc._RunningStats(1)
+    for score in [1., 2., 3.]:
+        walker.record_score(score)
+    assert walker.score_stats.count == 3
+    assert walker.score_stats.mean[0] == 2.
+
+    # Stats only cover the scores still in the history
+    walker.record_score(7.)
+    assert list(walker.score_history) == [2., 3., 7.]
+    assert walker.score_stats.count == 3
+    assert walker.score_stats.mean[0] == 4.
+    assert round(walker.score_stats.variance()[0], 12) == 7.
+
+
 def test_walker_dump_obj():
     foo_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.1, name="foo", current_value=0.15)
     bar_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.5, name="bar", current_value=0.51)
 
     walker = mcmcmc._Walker(variables=[foo_var, bar_var], func=lambda *_: 1, heat=0.1, min_max=(1, 5),
                             r_seed=1, quiet=True)
+    foo_var._dump_obj = lambda: "foo dump"
+    bar_var._dump_obj = lambda: "bar dump"
     dump = walker._dump_obj()
-    assert dump["vars"][0].name == "foo"
+    assert dump["vars"] == ["foo dump", "bar dump"]
     assert dump["lava"] is False
     assert dump["ice"] is False
     assert dump["heat"] == 0.1
     assert dump["cur_score"] is None
     assert dump["prop_score"] is None
-    assert dump["score_hist"] == [1.0, 5.0]
+    assert dump["score_hist"] == (0, [1.0, 5.0])
+    assert walker._dump_obj()["score_hist"] == (2, [])
     assert dump["name"] == "iK2ZWeqhFWCEPyYngFb5"
+    assert dump["rand_state"] == walker.rand_gen.getstate()
+    assert dump["cur_key"] is None
+    assert dump["prop_key"] is None
 
 
-def test_walker_apply_dump(monkeypatch):
-    foo_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.1, name="foo", current_value=0.15)
-    bar_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.5, name="bar", current_value=0.51)
+def test_walker_apply_dump(monkeypatch, capsys):
+    foo_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.1, name="foo", current_value=0.15,
+                              _apply_dump=lambda var_dict: print("foo applied %s" % var_dict))
+    bar_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.5, name="bar", current_value=0.51,
+                              _apply_dump=lambda var_dict: print("bar applied %s" % var_dict))
 
     walker = mcmcmc._Walker(variables=[foo_var, bar_var], func=lambda *_: 1, heat=0.1, min_max=(1, 5),
                             r_seed=1, quiet=True)
 
-    new_vars = {"vars": [foo_var, bar_var], "lava": True, "ice": False, "heat": 0.75, "cur_score": 2.5,
-                "prop_score": 3.1, "score_hist": [1.12, 3.42], "name": "SomEOtheRnAme"}
+    new_vars = {"vars": ["foo dump", "bar dump"], "lava": True, "ice": False, "heat": 0.75, "cur_score": 2.5,
+                "prop_score": 3.1, "score_hist": (0, [1.12, 3.42]), "name": "SomEOtheRnAme",
+                "rand_state": random.Random(5).getstate(), "cur_key": "key1", "prop_key": "key2"}
 
     monkeypatch.setattr(mcmcmc._Walker, "set_heat", lambda self, heat: setattr(self, "heat", heat))
     walker._apply_dump(new_vars)
     assert walker.variables == [foo_var, bar_var]
+    out, err = capsys.readouterr()
+    assert out == "foo applied foo dump\nbar applied bar dump\n"
+    assert walker.rand_gen.random() == random.Random(5).random()
+    assert walker.current_key == "key1"
+    assert walker.proposed_key == "key2"
     assert walker.lava is True
     assert walker.ice is False
     assert walker.heat == 0.75
     assert walker.current_score == 2.5
     assert walker.proposed_score == 3.1
-    assert walker.score_history == [1.12, 3.42]
+    assert list(walker.score_history) == [1.12, 3.42]
+    assert walker.score_stats.count == 2
+    assert round(walker.score_stats.mean[0], 12) == 2.27
     assert walker.name == "SomEOtheRnAme"
 
     new_vars["ice"] = True
@@ -235,6 +402,68 @@ Walker iK2ZWeqhFWCEPyYngFb5
 \tScore:\tNone"""
 
 
+def test_running_stats():
+    values = [[1., 10.], [2., 20.], [4., 25.], [8., 40.], [16., 42.]]
+    stats = mcmcmc._RunningStats(2)
+    for row in values:
+        stats.push(mcmcmc.np.array(row))
+    assert stats.count == 5
+    assert mcmcmc.np.allclose(stats.mean, mcmcmc.np.mean(values, axis=0))
+    assert mcmcmc.np.allclose(stats.variance(), mcmcmc.np.var(values, axis=0, ddof=1))
+
+    # Sliding the window forward
+    stats.pop(mcmcmc.np.array(values[0]))
+    stats.pop(mcmcmc.np.array(values[1]))
+    assert stats.count == 3
+    assert mcmcmc.np.allclose(stats.mean, mcmcmc.np.mean(values[2:], axis=0))
+    assert mcmcmc.np.allclose(stats.variance(), mcmcmc.np.var(values[2:], axis=0, ddof=1))
+
+    # Empty out completely
+    for row in values[2:]:
+        stats.pop(mcmcmc.np.array(row))
+    assert stats.count == 0
+    assert not stats.mean.any()
+    assert not stats.m2.any()
+
+
+def test_chain_add_sample():
+    foo_var = SimpleNamespace(name="foo")
+    bar_var = SimpleNamespace(name="bar")
+    walker = SimpleNamespace(variables=[foo_var, bar_var])
+    tmp_file = br.TempFile()
+    chain = mcmcmc._Chain(walkers=[walker], outfile=tmp_file.path, cold_heat=0.01, hot_heat=0.2, capacity=4)
+
+    rand_gen = random.Random(1)
+    values = [[rand_gen.random(), rand_gen.random() * 10] for _ in range(25)]
+    for row in values[:4]:
+        chain.add_sample(row)
+    assert chain.num_samples == 4
+    assert chain.samples.shape == (4, 2)
+    assert chain.burn_in_indx == 0
+
+    # Grows past initial capacity
+    chain.add_sample(values[4])
+    assert chain.samples.shape == (8, 2)
+    assert chain.burn_in_indx == 0
+
+    for row in values[5:]:
+        chain.add_sample(row)
+    assert chain.num_samples == 25
+    assert chain.samples.shape == (32, 2)
+    assert chain.burn_in_indx == 2  # round(2.5) == 2
+    assert chain.sample_stats.count == 23
+    assert mcmcmc.np.allclose(chain.sample_stats.mean, mcmcmc.np.mean(values[2:], axis=0))
+    assert mcmcmc.np.allclose(chain.sample_stats.variance(), mcmcmc.np.var(values[2:], axis=0, ddof=1))
+    assert chain.best_sample is None
+
+    # The earliest of the highest scoring samples is kept
+    chain.add_sample([1, 2], 5)
+    chain.add_sample([3, 4], 7)
+    chain.add_sample([5, 6], 7)
+    chain.add_sample([7, 8], 6)
+    assert chain.best_sample == [7, [3, 4]]
+
+
 def test_chain_init():
     foo_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.1, name="foo", current_value=0.15)
     bar_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.5, name="bar", current_value=0.51)
@@ -253,6 +482,69 @@ def test_chain_init():
     assert tmp_file.read() == """\
 Gen\tfoo\tbar\tresult
 """
+    assert chain.samples.shape == (1000, 2)
+    assert chain.num_samples == 0
+    assert chain.new_results == ""
+    assert chain.burn_in_indx == 0
+    assert chain.sample_stats.count == 0
+
+    chain = mcmcmc._Chain(walkers=[walker1, walker2], outfile=tmp_file.path, cold_heat=0.01, hot_heat=0.2,
+                          capacity=50, r_seed=1)
+    assert chain.samples.shape == (50, 2)
+    assert round(chain.rand_gen.random(), 10) == 0.5118216247
+
+
+def test_chain_draw_proposals():
+    def walker(heat, lava=False):
+        variables = [mcmcmc.Variable("foo", 0, 10, r_seed=1), mcmcmc.Variable("bar", 100, 200, r_seed=2)]
+        return SimpleNamespace(variables=variables, heat=heat, lava=lava)
+
+    walker1 = walker(0.01)
+    walker2 = walker(0.2)
+    walker3 = walker(1.0, lava=True)
+    tmp_file = br.TempFile()
+    chain = mcmcmc._Chain(walkers=[walker1, walker2, walker3], outfile=tmp_file.path, cold_heat=0.01, hot_heat=0.2,
+                          r_seed=3)
+    start_values = [[var.current_value for var in w.variables] for w in chain.walkers]
+    proposals = chain.draw_proposals()
+    assert len(proposals) == 3
+    for w, draws in zip(chain.walkers, proposals):
+        assert draws == [var.draw_value for var in w.variables]
+        assert 0 <= draws[0] <= 10
+        assert 100 <= draws[1] <= 200
+
+    # Normal walkers keep their current values and log their draws
+    for w, start in zip([walker1, walker2], start_values):
+        assert [var.current_value for var in w.variables] == start
+        assert [list(var.history["draws"])[-1] for var in w.variables] == [var.draw_value for var in w.variables]
+    # The cold walker doesn't stray far
+    assert abs(walker1.variables[0].draw_value - start_values[0][0]) < 0.5
+    assert abs(walker1.variables[1].draw_value - start_values[0][1]) < 5
+
+    # Lava walkers jump straight to their draws
+    assert [var.current_value for var in walker3.variables] == proposals[2]
+    assert [len(var.history["draws"]) for var in walker3.variables] == [1, 1]
+
+    # Reproducible from the chain seed
+    walker1, walker2, walker3 = walker(0.01), walker(0.2), walker(1.0, lava=True)
+    chain2 = mcmcmc._Chain(walkers=[walker1, walker2, walker3], outfile=tmp_file.path, cold_heat=0.01, hot_heat=0.2,
+                           r_seed=3)
+    assert chain2.draw_proposals() == proposals
+
+
+def test_chain_score_std():
+    walkers = []
+    scores = []
+    rand_gen = random.Random(1)
+    for _ in range(3):
+        walker = SimpleNamespace(score_history=mcmcmc._RingBuffer(20), score_stats=mcmcmc._RunningStats(1))
+        for _ in range(rand_gen.randint(5, 40)):
+            score = rand_gen.gauss(10, 4)
+            mcmcmc._Walker.record_score(walker, score)
+        scores += list(walker.score_history)
+        walkers.append(walker)
+    chain = SimpleNamespace(walkers=walkers)
+    assert round(mcmcmc._Chain.score_std(chain), 10) == round(float(mcmcmc.np.std(scores)), 10)
 
 
 def test_chain_swap_hot_cold(monkeypatch, capsys):
@@ -383,7 +675,7 @@ BOL-PanxαB,Bfo-PanxαE,0.274041115357""")
 2  BOL-PanxαB  Bfo-PanxαE  0.274041115357""", print(chain.get_results(chain))
 
 
-def test_chain_write_sample():
+def test_chain_write_sample(capsys):
     foo_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.1, name="foo", current_value=0.15)
     bar_var = SimpleNamespace(draw_random=lambda: True, draw_value=0.5, name="bar", current_value=0.51)
     walker1 = SimpleNamespace(variables=[foo_var, bar_var], lava=False, ice=False, current_score=35,
@@ -391,20 +683,22 @@ def test_chain_write_sample():
 
     tmp_file = br.TempFile()
     chain = SimpleNamespace(step_counter=2, get_cold_walker=lambda *_: walker1, outfile=tmp_file.path,
-                            write_sample=mcmcmc._Chain.write_sample)
+                            write_sample=mcmcmc._Chain.write_sample, new_results="",
+                            add_sample=lambda values, score: print("add_sample(%s, %s)" % (values, score)))
 
     chain.write_sample(chain)
     assert tmp_file.read() == "2\t0.15\t0.51\t35\n", print(tmp_file.read())
+    out, err = capsys.readouterr()
+    assert out == "add_sample([0.15, 0.51], 35)\n"
+    assert chain.new_results == "2\t0.15\t0.51\t35\n"
 
 
 def test_chain_dump_obj():
     walker1 = SimpleNamespace(_dump_obj=lambda *_: "walker1")
     walker2 = SimpleNamespace(_dump_obj=lambda *_: "walker2")
-    tmp_file = br.TempFile()
-    tmp_file.write("outfile results")
-
-    chain = SimpleNamespace(walkers=[walker1, walker2], outfile=tmp_file.path, cold_heat=0.1, hot_heat=0.2,
-                            step_counter=20, best_score_ever_seen=100, _dump_obj=mcmcmc._Chain._dump_obj)
+    chain = SimpleNamespace(walkers=[walker1, walker2], new_results="1\t0.5\t2.5\t10\n", cold_heat=0.1,
+                            hot_heat=0.2, step_counter=20, best_score_ever_seen=100, _dump_obj=mcmcmc._Chain._dump_obj,
+                            rand_gen=mcmcmc.np.random.default_rng(1))
 
     dump = chain._dump_obj(chain)
     assert dump["walkers"] == ["walker1", "walker2"]
@@ -412,7 +706,12 @@ def test_chain_dump_obj():
     assert dump["hot_heat"] == 0.2
     assert dump["step_count"] == 20
     assert dump["best_score"] == 100
-    assert dump["results"] == "outfile results"
+    assert dump["results"] == "1\t0.5\t2.5\t10\n"
+    assert dump["rand_state"] == chain.rand_gen.bit_generator.state
+
+    # Rows are only handed over once
+    assert chain.new_results == ""
+    assert chain._dump_obj(chain)["results"] == ""
 
 
 def test_chain_apply_dump(capsys):
@@ -420,20 +719,185 @@ def test_chain_apply_dump(capsys):
     walker2 = SimpleNamespace(_apply_dump=lambda *_: print("Applying dump to walker2"))
 
     tmp_file = br.TempFile()
+    tmp_file.write("Gen\tfoo\tbar\tresult\n")
     chain = SimpleNamespace(walkers=[walker1, walker2], outfile=tmp_file.path, cold_heat=None, hot_heat=None,
-                            step_counter=None, best_score_ever_seen=None, _apply_dump=mcmcmc._Chain._apply_dump)
+                            step_counter=None, best_score_ever_seen=None, _apply_dump=mcmcmc._Chain._apply_dump,
+                            add_sample=lambda values, score: print("add_sample(%s, %s)" % (values, score)),
+                            rand_gen=mcmcmc.np.random.default_rng(1))
 
-    var_dict = {"walkers": [None, None], "cold_heat": 0.1, "hot_heat": 0.2,
-                "step_count": 20, "best_score": 100, "results": "Some results"}
+    var_dict = {"walkers": [None, None], "cold_heat": 0.1, "hot_heat": 0.2, "step_count": 20, "best_score": 100,
+                "results": "1\t0.5\t2.5\t10\n", "rand_state": mcmcmc.np.random.default_rng(5).bit_generator.state}
     chain._apply_dump(chain, var_dict)
     assert chain.walkers == [walker1, walker2]
     out, err = capsys.readouterr()
-    assert out == "Applying dump to walker1\nApplying dump to walker2\n"
+    assert out == "Applying dump to walker1\nApplying dump to walker2\nadd_sample([0.5, 2.5], 10.0)\n"
     assert chain.cold_heat == 0.1
     assert chain.hot_heat == 0.2
     assert chain.step_counter == 20
     assert chain.best_score_ever_seen == 100
-    assert tmp_file.read() == "Some results"
+    assert chain.rand_gen.random() == mcmcmc.np.random.default_rng(5).random()
+    assert tmp_file.read() == "Gen\tfoo\tbar\tresult\n1\t0.5\t2.5\t10\n"
+
+    # Dumps are applied in order, so later rows are appended
+    var_dict["step_count"] = 22
+    var_dict["results"] = "2\t0.6\t2.6\t11\n3\t0.7\t2.7\t12\n"
+    chain._apply_dump(chain, var_dict)
+    out, err = capsys.readouterr()
+    assert "add_sample([0.6, 2.6], 11.0)\nadd_sample([0.7, 2.7], 12.0)\n" in out
+    assert chain.step_counter == 22
+    assert tmp_file.read() == "Gen\tfoo\tbar\tresult\n1\t0.5\t2.5\t10\n2\t0.6\t2.6\t11\n3\t0.7\t2.7\t12\n"
+
+
+def test_walker_pool():
+    def step_func(walker, args):
+        return walker.offset + sum(args[0])
+
+    walker1 = SimpleNamespace(name="walker1", offset=0)
+    walker2 = SimpleNamespace(name="walker2", offset=100)
+
+    pool = mcmcmc._WalkerPool([walker1, walker2], step_func)
+    assert list(pool.walkers.keys()) == ["walker1", "walker2"]
+    pool.start()
+    assert len(pool.processes) == 2
+    processes = list(pool.processes.values())
+
+    # The same processes are reused across steps
+    for step in range(3):
+        pool.submit(walker1, [1, step])
+        pool.submit(walker2, [10, step])
+        assert pool.pending == ["walker1", "walker2"]
+        scores = pool.wait()
+        assert not pool.pending
+        assert scores == {"walker1": 1 + step, "walker2": 110 + step}
+        assert list(pool.processes.values()) == processes
+        assert all([p.is_alive() for p in processes])
+
+    pool.shutdown()
+    assert not pool.processes
+    assert not any([p.is_alive() for p in processes])
+
+
+def test_walker_pool_collect():
+    def step_func(walker, args):
+        sleep(args[0][0])
+        return walker.name
+
+    walker1 = SimpleNamespace(name="walker1")
+    walker2 = SimpleNamespace(name="walker2")
+    pool = mcmcmc._WalkerPool([walker1, walker2], step_func)
+    pool.start()
+
+    # Return as soon as the first score is in, and leave the other one pending
+    pool.submit(walker1, [1.0])
+    pool.submit(walker2, [0.0])
+    assert pool.collect() == {"walker2": "walker2"}
+    assert pool.pending == ["walker1"]
+    assert pool.collect() == {"walker1": "walker1"}
+    assert pool.collect() == {}
+    pool.shutdown()
+
+
+def test_walker_pool_error():
+    def step_func(walker, args):
+        raise ValueError("Bad proposal %s" % args[0])
+
+    walker = SimpleNamespace(name="walker1")
+    pool = mcmcmc._WalkerPool([walker], step_func)
+    pool.start()
+    pool.submit(walker, [0.5])
+    with pytest.raises(RuntimeError) as err:
+        pool.wait()
+    assert "Walker walker1 failed while scoring a proposal" in str(err)
+    assert "ValueError: Bad proposal [0.5]" in str(err)
+    pool.shutdown()
+
+
+def test_score_cache():
+    cache = mcmcmc._ScoreCache(max_size=2)
+    assert cache.get("a") is None
+    cache.put("a", 1.5)
+    cache.put("b", 2.5)
+    assert cache.get("a") == 1.5
+    assert len(cache) == 2
+
+    # "b" is now the least recently used, so it is evicted first
+    cache.put("c", 3.5)
+    assert list(cache.scores.keys()) == ["a", "c"]
+    assert cache.get("b") is None
+    assert cache.hits == 1
+    assert cache.misses == 2
+
+    cache = mcmcmc._ScoreCache(max_size=0)
+    cache.put("a", 1.5)
+    assert len(cache) == 0
+
+
+def test_walker_pool_memoization():
+    def step_func(walker, args):
+        # The seed is the last proposal value, so a cached score can be told apart from a freshly calculated one
+        return args[0][0] + args[0][-1]
+
+    def key_func(walker, args):
+        return round(args[0][0])
+
+    walker1 = SimpleNamespace(name="walker1")
+    walker2 = SimpleNamespace(name="walker2")
+    cache = mcmcmc._ScoreCache()
+    pool = mcmcmc._WalkerPool([walker1, walker2], step_func, key_func=key_func, cache=cache)
+    pool.start()
+
+    # Different keys are both scored and stored
+    pool.submit(walker1, [1.1, 1000])
+    pool.submit(walker2, [2.1, 2000])
+    assert pool.wait() == {"walker1": 1001.1, "walker2": 2002.1}
+    assert cache.scores == {1: 1001.1, 2: 2002.1}
+
+    # Proposals sharing a key pull their scores from the cache
+    pool.submit(walker1, [2.2, 3000])
+    pool.submit(walker2, [0.9, 4000])
+    assert pool.wait() == {"walker1": 2002.1, "walker2": 1001.1}
+
+    # Only one walker scores a new key, and the other is handed the same result
+    pool.submit(walker1, [3.1, 5000])
+    pool.submit(walker2, [2.9, 6000])
+    scores = pool.wait()
+    assert scores["walker1"] == scores["walker2"]
+    assert scores["walker1"] in [5003.1, 6002.9]
+    assert cache.scores[3] == scores["walker1"]
+    assert not pool.in_flight
+    assert not pool.walker_keys
+    assert walker1.proposed_key == 3
+    assert walker2.proposed_key == 3
+    pool.shutdown()
+
+    # With a zero sized cache, keys are still recorded but every proposal is scored
+    cache = mcmcmc._ScoreCache(max_size=0)
+    pool = mcmcmc._WalkerPool([walker1, walker2], step_func, key_func=key_func, cache=cache)
+    pool.start()
+    pool.submit(walker1, [1.1, 1000])
+    pool.submit(walker2, [0.9, 2000])
+    assert pool.wait() == {"walker1": 1001.1, "walker2": 2000.9}
+    assert walker1.proposed_key == 1
+    assert walker2.proposed_key == 1
+    assert not pool.in_flight
+    pool.shutdown()
+
+
+def test_walker_pool_shutdown_during_lookup():
+    def step_func(walker, args):
+        return args[0][0]
+
+    walker = SimpleNamespace(name="walker1")
+    pool = mcmcmc._WalkerPool([walker], step_func, key_func=lambda *_: "key", cache=mcmcmc._ScoreCache())
+    pool.start()
+    processes = list(pool.processes.values())
+
+    # The process has sent up its key and is waiting on the answer when the pool is shut down (e.g., after an error)
+    pool.submit(walker, [1.0])
+    assert pool.connections["walker1"].poll(10)
+    pool.shutdown()
+    assert not any([p.is_alive() for p in processes])
+    assert processes[0].exitcode == 0  # Stopped on its own, instead of scoring the proposal as a cache miss
 
 
 def test_mcmcmc_init(monkeypatch, capsys):
@@ -463,12 +927,21 @@ def test_mcmcmc_init(monkeypatch, capsys):
     assert mc_obj.burn_in == 100
     assert mc_obj.convergence == 1.05
     assert mc_obj.quiet is False
+    assert mc_obj.checkpoint_steps == 10
+    assert mc_obj.checkpoint_secs == 0
+    assert mc_obj.counter == 0
+    assert mc_obj._log_started is False
+    assert mc_obj.score_cache is None
+    assert mc_obj.max_lag == 0
+    assert mc_obj.best_key is None
+    assert mc_obj.convergence_callback is None
 
     # Set all keywords
     mc_obj = mcmcmc.MCMCMC([foo_var, bar_var], lambda *_: print("Called func"), params=["args"], steps=100,
                            sample_rate=10, num_walkers=2, num_chains=2, quiet=True, include_lava=False,
                            include_ice=False, outfile_root='./new_out', burn_in=1000, r_seed=2,
-                           convergence=1.09, cold_heat=0.25, hot_heat=0.7, min_max=(3, 10))
+                           convergence=1.09, cold_heat=0.25, hot_heat=0.7, min_max=(3, 10), checkpoint_steps=0,
+                           checkpoint_secs=300, memo_key=lambda *_: "key", memo_size=50, max_lag=2)
 
     assert mc_obj.global_variables == [foo_var, bar_var]
     assert mc_obj.steps == 100
@@ -485,6 +958,11 @@ def test_mcmcmc_init(monkeypatch, capsys):
     assert mc_obj.burn_in == 1000
     assert mc_obj.convergence == 1.09
     assert mc_obj.quiet is True
+    assert mc_obj.checkpoint_steps == 0
+    assert mc_obj.checkpoint_secs == 300
+    assert mc_obj.score_cache.max_size == 50
+    assert mc_obj.max_lag == 2
+    assert len(mc_obj.score_cache) == 0
 
     # Include ice and lava walkers
     mc_obj = mcmcmc.MCMCMC([foo_var, bar_var], lambda *_: 0, include_lava=True, num_chains=2)
@@ -497,98 +975,166 @@ def test_mcmcmc_init(monkeypatch, capsys):
         mcmcmc.MCMCMC([foo_var, bar_var], lambda *_: print("Called func"), convergence=0.5)
     assert "Gelman-Rubin convergence ratio must be greater than 1" in str(err)
 
+    with pytest.raises(ValueError) as err:
+        mcmcmc.MCMCMC([foo_var, bar_var], lambda *_: print("Called func"), max_lag=-1)
+    assert "max_lag must be zero or a positive integer" in str(err)
+
+
+def test_mcmcmc_checkpoint():
+    tmp_file = br.TempFile()
+    chain1 = SimpleNamespace(_dump_obj=lambda: "chain1_obj")
+    chain2 = SimpleNamespace(_dump_obj=lambda: "chain2_obj")
+    mc_obj = SimpleNamespace(_checkpoint=mcmcmc.MCMCMC._checkpoint, dumpfile=tmp_file.path, rand_gen=random.Random(1),
+                             best={"score": 10}, best_key="key", chains=[chain1, chain2])
+
+    # Records are appended to the log
+    mc_obj._checkpoint(mc_obj, 5)
+    mc_obj.best = {"score": 20}
+    mc_obj._checkpoint(mc_obj, 10)
+
+    with open(tmp_file.path, "br") as ifile:
+        record1 = dill.load(ifile)
+        record2 = dill.load(ifile)
+        with pytest.raises(EOFError):
+            dill.load(ifile)
+
+    assert record1 == {"version": mcmcmc.DUMP_VERSION, "counter": 5, "rand_state": random.Random(1).getstate(),
+                       "best": {"score": 10}, "best_key": "key", "chains": ["chain1_obj", "chain2_obj"]}
+    assert record2["counter"] == 10
+    assert record2["best"] == {"score": 20}
+
 
 def test_mcmcmc_resume(capsys):
-    mc_obj = SimpleNamespace(dumpfile="does_not_exist", resume=mcmcmc.MCMCMC.resume)
+    mc_obj = SimpleNamespace(dumpfile="does_not_exist", resume=mcmcmc.MCMCMC.resume, rand_gen=random.Random(1),
+                             best=None, counter=0, _log_started=False)
     assert mc_obj.resume(mc_obj) is False
 
+    # An empty log has nothing to resume from
     tmp_file = br.TempFile(byte_mode=True)
-    dill.dump(["a", "b", "c"], tmp_file)
-
     mc_obj.dumpfile = tmp_file.path
-    chain1 = SimpleNamespace(_apply_dump=lambda *_: print("applying chain1"))
-    chain2 = SimpleNamespace(_apply_dump=lambda *_: print("applying chain2"))
-    chain3 = SimpleNamespace(_apply_dump=lambda *_: print("applying chain3"))
+    assert mc_obj.resume(mc_obj) is False
+
+    chain1 = SimpleNamespace(_apply_dump=lambda dump: print("applying chain1 %s" % dump))
+    chain2 = SimpleNamespace(_apply_dump=lambda dump: print("applying chain2 %s" % dump))
+    chain3 = SimpleNamespace(_apply_dump=lambda dump: print("applying chain3 %s" % dump))
     mc_obj.chains = [chain1, chain2, chain3]
     mc_obj.run = lambda *_: print("Running")
 
+    with open(tmp_file.path, "wb") as ofile:
+        dill.dump({"version": mcmcmc.DUMP_VERSION, "counter": 0, "rand_state": random.Random(2).getstate(),
+                   "best": {"score": 1}, "best_key": None, "chains": ["a", "b", "c"]}, ofile)
+        dill.dump({"version": mcmcmc.DUMP_VERSION, "counter": 10, "rand_state": random.Random(3).getstate(),
+                   "best": {"score": 2}, "best_key": "b2", "chains": ["d", "e", "f"]}, ofile)
+        good_bytes = ofile.tell()
+        # Partial record, as though the run was killed mid-write
+        ofile.write(dill.dumps({"version": mcmcmc.DUMP_VERSION, "counter": 20, "rand_state": None, "best": None,
+                                "chains": ["g", "h", "i"]})[:20])
+
     assert mc_obj.resume(mc_obj) is True
     out, err = capsys.readouterr()
-    assert out == "applying chain1\napplying chain2\napplying chain3\nRunning\n", print(out)
+    assert out == "applying chain1 a\napplying chain2 b\napplying chain3 c\n" \
+                  "applying chain1 d\napplying chain2 e\napplying chain3 f\nRunning\n", print(out)
+    assert mc_obj.counter == 10
+    assert mc_obj.best == {"score": 2}
+    assert mc_obj.best_key == "b2"
+    assert mc_obj.rand_gen.random() == random.Random(3).random()
+    assert mc_obj._log_started is True
+    assert os.path.getsize(tmp_file.path) == good_bytes
+
+    # Dumpfiles from older versions start the run over instead of crashing
+    mc_obj._log_started = False
+    for old_dump in [[{"walkers": [], "cold_heat": 0.1}], {"counter": 5, "chains": ["x", "y", "z"]}]:
+        with open(tmp_file.path, "wb") as ofile:
+            dill.dump(old_dump, ofile)
+        with pytest.warns(RuntimeWarning, match="older version of mcmcmc"):
+            assert mc_obj.resume(mc_obj) is False
+        out, err = capsys.readouterr()
+        assert out == ""
+        assert mc_obj._log_started is False
 
 
 def test_mcmcmc_mc_step_run():
-    tmp_file = br.TempFile()
-    walker = SimpleNamespace(function=lambda func_args: 1234, params=[], proposed_score_file=tmp_file)
-    mcmcmc.MCMCMC.mc_step_run(walker, ["foo"])
-    assert tmp_file.read() == "1234"
+    walker = SimpleNamespace(function=lambda func_args: 1234, params=[])
+    assert mcmcmc.MCMCMC.mc_step_run(walker, ["foo"]) == 1234
 
-    tmp_file.clear()
     walker.params = ["bar", "baz"]
     walker.function = lambda func_args, params: 4321
-    mcmcmc.MCMCMC.mc_step_run(walker, ["foo"])
-    assert tmp_file.read() == "4321"
+    assert mcmcmc.MCMCMC.mc_step_run(walker, ["foo"]) == 4321
+
+
+def test_mcmcmc_mc_step_key():
+    walker = SimpleNamespace(memo_key=lambda func_args: tuple(func_args[:-1]), params=[])
+    assert mcmcmc.MCMCMC.mc_step_key(walker, [[1.5, 2.5, 1234]]) == (1.5, 2.5)
+
+    walker.params = ["bar", "baz"]
+    walker.memo_key = lambda func_args, params: (func_args[0], params[0])
+    assert mcmcmc.MCMCMC.mc_step_key(walker, [[1.5, 2.5, 1234]]) == (1.5, "bar")
 
 
 def test_mcmcmc_step_parse(capsys):
     rand_gen = random.Random(4)
-    tmp_file = br.TempFile()
-    walker = SimpleNamespace(name="qwerty", proposed_score=None, score_history=[1.12, 3.42], current_score=3.42,
+    walker = SimpleNamespace(name="qwerty", proposed_score=None, score_history=mcmcmc._RingBuffer(1000),
+                             score_stats=mcmcmc._RunningStats(1), current_score=3.42,
                              accept=lambda *_: print("Calling accept() method"), rand_gen=rand_gen, heat=0.25,
-                             ice=False, lava=False, proposed_score_file=tmp_file)
+                             ice=False, lava=False)
+    walker.record_score = lambda score: mcmcmc._Walker.record_score(walker, score)
+    walker.record_score(1.12)
+    walker.record_score(3.42)
 
     # Accept higher score
-    tmp_file.write("7.90", mode="w")
+    walker.proposed_score = 7.9
 
     mcmcmc.MCMCMC.step_parse(walker=walker, std=1.5)
-    assert walker.score_history == [1.12, 3.42, 7.9]
+    assert list(walker.score_history) == [1.12, 3.42, 7.9]
     assert walker.proposed_score == 7.9
     out, err = capsys.readouterr()
     assert out == "Calling accept() method\n"
 
     # Reject lower score
-    tmp_file.write("0.91", mode="w")
+    walker.proposed_score = 0.91
 
     mcmcmc.MCMCMC.step_parse(walker=walker, std=3.1)
-    assert walker.score_history == [1.12, 3.42, 7.9, 0.91]
+    assert list(walker.score_history) == [1.12, 3.42, 7.9, 0.91]
     assert walker.proposed_score == 0.91
     out, err = capsys.readouterr()
     assert out == ""
 
     # Accept lower score
-    tmp_file.write("3.3", mode="w")
+    walker.proposed_score = 3.3
 
     mcmcmc.MCMCMC.step_parse(walker=walker, std=3.1)
-    assert walker.score_history == [1.12, 3.42, 7.9, 0.91, 3.3]
+    assert list(walker.score_history) == [1.12, 3.42, 7.9, 0.91, 3.3]
     assert walker.proposed_score == 3.3
     out, err = capsys.readouterr()
     assert out == "Calling accept() method\n", print(out)
 
     # Lava walker accepts any score
-    tmp_file.write("0.1", mode="w")
+    walker.proposed_score = 0.1
 
     walker.lava = True
     mcmcmc.MCMCMC.step_parse(walker=walker, std=3.1)
-    assert walker.score_history == [1.12, 3.42, 7.9, 0.91, 3.3, 0.1]
+    assert list(walker.score_history) == [1.12, 3.42, 7.9, 0.91, 3.3, 0.1]
     out, err = capsys.readouterr()
     assert out == "Calling accept() method\n"
 
     # Ice walker rejects any lower scores
-    tmp_file.write("3.4", mode="w")
+    walker.proposed_score = 3.4
 
     walker.lava = False
     walker.ice = True
     mcmcmc.MCMCMC.step_parse(walker=walker, std=3.1)
-    assert walker.score_history == [1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4]
+    assert list(walker.score_history) == [1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4]
     out, err = capsys.readouterr()
     assert out == ""
 
     # Do not allow history to grow over 1000 items long
-    walker.score_history = [1 for _ in range(1000)]
+    for _ in range(1000):
+        walker.record_score(1)
     assert len(walker.score_history) == 1000
     mcmcmc.MCMCMC.step_parse(walker, 3.1)
     assert len(walker.score_history) == 1000
     assert walker.score_history[-1] == 3.4
+    assert walker.score_stats.count == 1000
 
 
 def test_mcmcmc_run(capsys):
@@ -600,33 +1146,47 @@ def test_mcmcmc_run(capsys):
                               draw_new_value=lambda heat: print("bar_var draw_new_value()"), draw_value=0.23)
 
     walker1_1 = SimpleNamespace(name="1_1", variables=[foo_var, bar_var], lava=False, current_score=3, heat=0.25,
-                                score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
+                                current_key=None, score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
     walker1_2 = SimpleNamespace(name="1_2", variables=[foo_var, bar_var], lava=False, current_score=3, heat=0.25,
-                                score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
+                                current_key=None, score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
     walker1_3 = SimpleNamespace(name="1_3", variables=[foo_var, bar_var], lava=False, current_score=3, heat=0.25,
-                                score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
+                                current_key=None, score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
     walker2_1 = SimpleNamespace(name="2_1", variables=[foo_var, bar_var], lava=False, current_score=3, heat=0.25,
-                                score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
+                                current_key=None, score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
     walker2_2 = SimpleNamespace(name="2_2", variables=[foo_var, bar_var], lava=False, current_score=3, heat=0.25,
-                                score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
+                                current_key=None, score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
     walker2_3 = SimpleNamespace(name="2_3", variables=[foo_var, bar_var], lava=False, current_score=3, heat=0.25,
-                                score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
+                                current_key=None, score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
     walker3_1 = SimpleNamespace(name="3_1", variables=[foo_var, bar_var], lava=False, current_score=3, heat=0.25,
-                                score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
+                                current_key=None, score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
     walker3_2 = SimpleNamespace(name="3_2", variables=[foo_var, bar_var], lava=False, current_score=3, heat=0.25,
-                                score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
+                                current_key=None, score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
     walker3_3 = SimpleNamespace(name="3_3", variables=[foo_var, bar_var], lava=False, current_score=3, heat=0.25,
-                                score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
+                                current_key=None, score_history=[1.12, 3.42, 7.9, 0.91, 3.3, 0.1, 3.4])
+
+    def draw_proposals(walkers):
+        proposals = []
+        for walker in walkers:
+            for variable in walker.variables:
+                if walker.lava:
+                    variable.draw_random()
+                else:
+                    variable.draw_new_value(walker.heat)
+            proposals.append([variable.draw_value for variable in walker.variables])
+        return proposals
 
     chain1 = SimpleNamespace(walkers=[walker1_1, walker1_2, walker1_3], step_counter=99,
                              _dump_obj=lambda: b"chain1_obj\n", swap_hot_cold=lambda: print("Chain1 swap_hot_cold()"),
-                             write_sample=lambda: print("Chain1 write_sample()"))
+                             write_sample=lambda: print("Chain1 write_sample()"), score_std=lambda: 1.5)
+    chain1.draw_proposals = lambda: draw_proposals(chain1.walkers)
     chain2 = SimpleNamespace(walkers=[walker2_1, walker2_2, walker2_3], step_counter=99,
                              _dump_obj=lambda: b"chain2_obj\n", swap_hot_cold=lambda: print("Chain2 swap_hot_cold()"),
-                             write_sample=lambda: print("Chain2 write_sample()"))
+                             write_sample=lambda: print("Chain2 write_sample()"), score_std=lambda: 1.5)
+    chain2.draw_proposals = lambda: draw_proposals(chain2.walkers)
     chain3 = SimpleNamespace(walkers=[walker3_1, walker3_2, walker3_3], step_counter=99,
                              _dump_obj=lambda: b"chain3_obj\n", swap_hot_cold=lambda: print("Chain3 swap_hot_cold()"),
-                             write_sample=lambda: print("Chain3 write_sample()"))
+                             write_sample=lambda: print("Chain3 write_sample()"), score_std=lambda: 1.5)
+    chain3.draw_proposals = lambda: draw_proposals(chain3.walkers)
 
     global convergence_counter
     convergence_counter = 0
@@ -639,9 +1199,14 @@ def test_mcmcmc_run(capsys):
     tmp_file = br.TempFile()
     mc_obj = SimpleNamespace(run=mcmcmc.MCMCMC.run, _check_convergence=mock_check_convergence, steps=1,
                              dumpfile=tmp_file.path, chains=[chain1, chain2, chain3], rand_gen=rand_gen,
-                             mc_step_run=lambda *args: print("mc_step_run", args),
+                             mc_step_run=lambda *args: 1.5,
                              step_parse=lambda *args: print("step_parse:", args), best={"score": None, "variables": {}},
-                             sample_rate=1)
+                             sample_rate=1, counter=0, checkpoint_steps=1, checkpoint_secs=0, _log_started=False,
+                             _checkpoint=lambda counter: print("checkpoint: %s" % counter), score_cache=None,
+                             mc_step_key=lambda *args: None, max_lag=0, best_key=None, convergence_callback=None)
+    mc_obj._propose_step = lambda chain, pool: mcmcmc.MCMCMC._propose_step(mc_obj, chain, pool)
+    mc_obj._finish_step = lambda chain, scores, step: mcmcmc.MCMCMC._finish_step(mc_obj, chain, scores, step)
+    tmp_file.write("Stale log from a previous run")
 
     # Break out when counter > steps
     mc_obj.run(mc_obj)
@@ -662,18 +1227,26 @@ def test_mcmcmc_run(capsys):
     assert out.count("Chain2 write_sample()") == 2
     assert out.count("Chain3 write_sample()") == 2
 
-    # assert len([None for x in out if "mc_step_run:" in x]) == 18, print(out)
     assert len([None for x in out if "step_parse:" in x]) == 18
-
-    with open(tmp_file.path, "br") as ifile:
-        dump_file = dill.load(ifile)
-    assert dump_file == [b'chain1_obj\n', b'chain2_obj\n', b'chain3_obj\n']
-
-    # Break when _check_convergence() pops, and include a lava walker
+    # Scores come back from the walker pool
+    assert walker1_1.proposed_score == 1.5
+    assert walker3_3.proposed_score == 1.5
+
+    # A new log is started and checkpointed at each step
+    assert tmp_file.read() == ""
+    assert mc_obj._log_started is True
+    assert out.count("checkpoint: 0") == 1
+    assert out.count("checkpoint: 1") == 1
+    assert mc_obj.counter == 2
+
+    # Break when _check_convergence() pops, and include a lava walker. Checkpointing can also be turned off.
     mc_obj.steps = 0
+    mc_obj.counter = 0
+    mc_obj.checkpoint_steps = 0
     walker1_1.lava = True
     mc_obj.run(mc_obj)
     out, err = capsys.readouterr()
+    assert "checkpoint" not in out
 
     out = out.split("\n")
     assert out.count("foo_var draw_raindom()") == 2
@@ -682,27 +1255,141 @@ def test_mcmcmc_run(capsys):
     assert out.count("bar_var draw_raindom()") == 2
     assert out.count("bar_var draw_new_value()") == 16
 
+    # A convergence callback can also end the run
+    convergence_counter = -100
+    mc_obj.counter = 0
+    mc_obj.convergence_callback = lambda mc: mc.counter >= 3
+    mc_obj.run(mc_obj)
+    out, err = capsys.readouterr()
+    assert out.count("Chain1 swap_hot_cold()") == 3
+    assert mc_obj.counter == 3
+
+
+def test_partition_stability():
+    walker1 = SimpleNamespace(current_key=None)
+    walker2 = SimpleNamespace(current_key=None)
+    chain1 = SimpleNamespace(get_cold_walker=lambda: walker1)
+    chain2 = SimpleNamespace(get_cold_walker=lambda: walker2)
+    mc_obj = SimpleNamespace(chains=[chain1, chain2], best_key=None)
+
+    stability = mcmcmc.PartitionStability(steps=2)
+    assert stability.steps == 2
+
+    # No keys yet
+    assert stability(mc_obj) is False
+
+    mc_obj.best_key = "a"
+    walker1.current_key = "a"
+    walker2.current_key = "b"
+    assert stability(mc_obj) is False
+    assert stability.cold_keys == {"a", "b"}
+    assert stability(mc_obj) is False
+    assert stability.stable_steps == 1
+
+    # Cold walkers swapping between partitions that have already been visited doesn't reset the count
+    walker1.current_key = "b"
+    assert stability(mc_obj) is True
+
+    # A new cold partition or a new best resets the count
+    walker2.current_key = "c"
+    assert stability(mc_obj) is False
+    assert stability.stable_steps == 0
+    assert stability(mc_obj) is False
+    mc_obj.best_key = "c"
+    assert stability(mc_obj) is False
+    assert stability.stable_steps == 0
+    assert stability.best_key == "c"
+    assert stability(mc_obj) is False
+    assert stability(mc_obj) is True
+
+
+def test_mcmcmc_run_async():
+    def func(func_args):
+        x, y, seed = func_args
+        if seed % 3 == 0:
+            sleep(0.01)
+        return (-6 * (x ** 2)) + (-2 * (y ** 2)) + 2
+
+    tmp_dir = br.TempDir()
+    mc_obj = mcmcmc.MCMCMC([mcmcmc.Variable("x", -100, 100, r_seed=1), mcmcmc.Variable("y", -100, 100, r_seed=2)],
+                           func, steps=20, r_seed=1, quiet=True, include_ice=True,
+                           outfile_root=os.path.join(tmp_dir.path, "chain"), max_lag=1)
+
+    completed = [0, 0, 0]
+    finish_step = mc_obj._finish_step
+
+    def track_finish_step(chain, scores, step):
+        indx = mc_obj.chains.index(chain)
+        completed[indx] = step
+        # Chains only start a new step while they are no more than max_lag steps ahead of the slowest chain
+        assert step - min(completed) <= 2
+        finish_step(chain, scores, step)
+
+    mc_obj._finish_step = track_finish_step
+    mc_obj.run()
+    assert completed == [21, 21, 21]
+    assert mc_obj.counter == 21
+    assert [chain.step_counter for chain in mc_obj.chains] == [21, 21, 21]
+    assert mc_obj.best["score"] is not None
+
+    # The best recorded sample is the top row across all of the chain output files
+    best = mc_obj.best_sample()
+    results = [mcmcmc.pd.read_csv(chain.outfile, sep="\t") for chain in mc_obj.chains]
+    assert best["score"] == max([result["result"].max() for result in results])
+    for result in results:
+        top = result.loc[result["result"] == best["score"]]
+        if not top.empty:
+            assert list(best["variables"].items()) == [("x", top["x"].iloc[0]), ("y", top["y"].iloc[0])]
+            break
+    assert best["score"] <= mc_obj.best["score"]
+
+
+def test_mcmcmc_spill_history():
+    tmp_dir = br.TempDir()
+    outfile_root = os.path.join(tmp_dir.path, "chain")
+    mc_obj = mcmcmc.MCMCMC([mcmcmc.Variable("x", -100, 100, r_seed=1)], lambda func_args: -func_args[0] ** 2, steps=2, r_seed=1,
+                           quiet=True, outfile_root=outfile_root, spill_history=True)
+    walker = mc_obj.chains[1].walkers[0]
+    assert walker.score_history.spill_file == "%s_2_1_score.txt" % outfile_root
+    assert walker.variables[0].history["draws"].spill_file == "%s_2_1_x_draws.txt" % outfile_root
+    assert walker.variables[0].history["accepts"].spill_file == "%s_2_1_x_accepts.txt" % outfile_root
+
 
 def test_mcmcmc_check_convergence(hf):
     csv_path = os.path.join(hf.resource_path, "mcmcmc", "chain")
-    chain1 = SimpleNamespace(step_counter=99, outfile=csv_path + "1.csv")
-    chain2 = SimpleNamespace(step_counter=99, outfile=csv_path + "2.csv")
-    chain3 = SimpleNamespace(step_counter=99, outfile=csv_path + "3.csv")
-
-    mc_obj = SimpleNamespace(_check_convergence=mcmcmc.MCMCMC._check_convergence, chains=[chain1, chain2, chain3],
+    chains = []
+    tmp_dir = br.TempDir()
+    for indx in range(1, 4):
+        walker = SimpleNamespace(variables=[SimpleNamespace(name="I"), SimpleNamespace(name="gq")])
+        chain = mcmcmc._Chain(walkers=[walker], outfile=os.path.join(tmp_dir.path, "chain%s.csv" % indx),
+                              cold_heat=0.1, hot_heat=0.2)
+        results = pd.read_csv(csv_path + "%s.csv" % indx, sep="\t")
+        for row in results[["I", "gq"]].values:
+            chain.add_sample(row)
+        chain.step_counter = 99
+        chains.append(chain)
+
+    mc_obj = SimpleNamespace(_check_convergence=mcmcmc.MCMCMC._check_convergence, chains=chains,
                              convergence=1.01)
 
     # Return False when step_counter < 100
     assert mc_obj._check_convergence(mc_obj) is False
 
     # Return False when convergence is not met
-    chain1.step_counter = chain2.step_counter = chain3.step_counter = 100
+    for chain in chains:
+        chain.step_counter = 100
     assert mc_obj._check_convergence(mc_obj) is False
 
     # Return True on convergence
     mc_obj.convergence = 1.1
     assert mc_obj._check_convergence(mc_obj) is True
 
+    # Threshold falls between these (PSRF over the full files is ~1.0326)
+    mc_obj.convergence = 1.032
+    assert mc_obj._check_convergence(mc_obj) is False
+    mc_obj.convergence = 1.033
+    assert mc_obj._check_convergence(mc_obj) is True
+
 
 def test_mcmcmc_reset_params():
     walker1 = SimpleNamespace(params=[1, 2])
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import sqlite3
+from urllib.request import urlopen
+from urllib.error import HTTPError
+import pytest
+from buddysuite import buddy_resources as br
+from .. import monitor_dbs
+
+
+def make_monitor(hf, **kwargs):
+    temp_dir = br.TempDir()
+    temp_dir.copy_to("%swork_db.sqlite" % hf.resource_path)
+    temp_dir.copy_to("%sheartbeat_db.sqlite" % hf.resource_path)
+    monitor = monitor_dbs.Monitor(os.path.join(temp_dir.path, "heartbeat_db.sqlite"),
+                                  os.path.join(temp_dir.path, "work_db.sqlite"), **kwargs)
+    return monitor, temp_dir
+
+
+def fill_dbs(monitor):
+    now = time.time()
+    hb_con = sqlite3.connect(monitor.hbdb_path)
+    hb_con.execute("INSERT INTO heartbeat (thread_type, pulse) VALUES ('master', ?)", (now - 10,))
+    for _ in range(4):
+        hb_con.execute("INSERT INTO heartbeat (thread_type, pulse) VALUES ('worker', ?)", (now - 2,))
+    hb_con.commit()
+    hb_con.close()
+
+    work_con = sqlite3.connect(monitor.wdb_path)
+    work_con.execute("INSERT INTO queue (hash, queued) VALUES ('foo', ?)", (now - 30,))
+    work_con.execute("INSERT INTO queue (hash, queued) VALUES ('2_2_bar', ?)", (now - 10,))
+    work_con.execute("INSERT INTO queue (hash) VALUES ('baz')")  # No queue time from older masters
+    work_con.execute("INSERT INTO processing (hash, worker_id) VALUES ('bar', 2)")
+    work_con.execute("INSERT INTO processing (hash, worker_id) VALUES ('1_2_bar', 2)")
+    work_con.execute("INSERT INTO processing (hash, worker_id) VALUES ('qux', 3)")
+    work_con.execute("INSERT INTO complete (hash) VALUES ('quux')")
+    for seq_hash, master_id in [("foo", 1), ("bar", 1), ("bar", 5), ("baz", 1), ("qux", 1), ("quux", 1)]:
+        work_con.execute("INSERT INTO waiting (hash, master_id) VALUES (?, ?)", (seq_hash, master_id))
+    work_con.execute("INSERT INTO throughput (worker_id, rate, updated) VALUES (2, 1234.5678, ?)", (now,))
+    work_con.commit()
+    work_con.close()
+    return
+
+
+def test_snapshot(hf):
+    monitor, temp_dir = make_monitor(hf)
+    fill_dbs(monitor)
+    stats = monitor.snapshot()
+    assert (stats["masters"], stats["workers"]) == (1, 4)
+    assert 9 < stats["heartbeat_age"]["master"] < 20
+    assert 1 < stats["heartbeat_age"]["worker"] < 20
+    assert stats["queue"] == {"job": 2, "subjob": 1}
+    assert stats["processing"] == {"job": 2, "subjob": 1}
+    assert (stats["complete"], stats["proc_comp"]) == (1, 0)
+    assert (stats["waiting_hashes"], stats["waiting_masters"]) == (5, 2)
+    assert 30 <= stats["queue_wait"]["max"] < 40
+    assert 20 <= stats["queue_wait"]["mean"] < 30
+    assert stats["idle_percent"] == 50  # Split jobs only count their subjobs
+    assert stats["throughput"] == {2: 1234.57}
+    assert stats["lock_wait"]["heartbeat"] >= 0 and stats["lock_wait"]["work"] >= 0
+
+    # Workers and masters aren't held up while the monitor is looking, and vice versa
+    work_con = sqlite3.connect(monitor.wdb_path, isolation_level=None)
+    work_con.execute("BEGIN IMMEDIATE")
+    work_con.execute("DELETE FROM queue")
+    assert monitor.snapshot()["queue"] == {"job": 2, "subjob": 1}
+    work_con.execute("COMMIT")
+    assert monitor.snapshot()["queue"] == {"job": 0, "subjob": 0}
+
+    # Same numbers the old way
+    monitor.exclusive = True
+    assert monitor.snapshot()["processing"] == {"job": 2, "subjob": 1}
+
+    # Nothing there yet
+    monitor = monitor_dbs.Monitor(os.path.join(temp_dir.path, "foo.sqlite"), os.path.join(temp_dir.path, "bar.sqlite"))
+    with pytest.raises(sqlite3.OperationalError):
+        monitor.snapshot()
+    assert not os.path.isfile(os.path.join(temp_dir.path, "foo.sqlite"))
+
+
+def test_snapshot_unmigrated(hf):
+    # Work databases made by older versions don't have queue times or a throughput table until a worker migrates them
+    monitor, temp_dir = make_monitor(hf)
+    os.remove(monitor.wdb_path)
+    work_con = sqlite3.connect(monitor.wdb_path)
+    for sql in ["CREATE TABLE queue (hash TEXT PRIMARY KEY, psi_pred_dir TEXT, align_m TEXT, align_p TEXT, "
+                "trimal TEXT, gap_open FLOAT, gap_extend FLOAT)",
+                "CREATE TABLE processing (hash TEXT PRIMARY KEY, worker_id INTEGER)",
+                "CREATE TABLE complete (hash TEXT PRIMARY KEY)",
+                "CREATE TABLE proc_comp (hash TEXT PRIMARY KEY, master_id INTEGER)",
+                "CREATE TABLE waiting (hash TEXT, master_id INTEGER)",
+                "INSERT INTO queue (hash) VALUES ('foo')"]:
+        work_con.execute(sql)
+    work_con.commit()
+    work_con.close()
+
+    stats = monitor.snapshot()
+    assert stats["queue"] == {"job": 1, "subjob": 0}
+    assert "queue_wait" not in stats and "throughput" not in stats
+    metrics = monitor_dbs.prometheus_metrics(stats)
+    assert "rdmcl_queue_jobs" in metrics
+    assert "rdmcl_queue_wait_seconds" not in metrics and "rdmcl_worker_throughput" not in metrics
+
+    monitor.metrics_file = os.path.join(temp_dir.path, "rdmcl.prom")
+    monitor.export(stats)
+    with open(monitor.metrics_file, "r") as ifile:
+        assert ifile.read() == metrics
+
+
+def test_export(hf):
+    monitor, temp_dir = make_monitor(hf)
+    fill_dbs(monitor)
+    stats = monitor.snapshot()
+    metrics = monitor_dbs.prometheus_metrics(stats)
+    assert """\
+# HELP rdmcl_masters Masters with a heartbeat
+# TYPE rdmcl_masters gauge
+rdmcl_masters 1
+""" in metrics
+    assert """\
+rdmcl_queue_jobs{kind="job"} 2
+rdmcl_queue_jobs{kind="subjob"} 1
+""" in metrics
+    assert 'rdmcl_worker_throughput{worker_id="2"} 1234.57\n' in metrics
+    assert "rdmcl_worker_idle_percent 50.0\n" in metrics
+    assert 'rdmcl_lock_wait_seconds{db="work"}' in metrics
+    assert len([line for line in metrics.split("\n") if line.startswith("# TYPE")]) == len(monitor_dbs.METRICS)
+
+    # No file unless asked for
+    monitor.export(stats)
+    assert monitor.metrics == metrics
+    assert sorted(os.listdir(temp_dir.path)) == ["heartbeat_db.sqlite", "work_db.sqlite"]
+
+    monitor.metrics_file = os.path.join(temp_dir.path, "rdmcl.prom")
+    monitor.export(stats)
+    with open(monitor.metrics_file, "r") as ifile:
+        assert ifile.read() == metrics
+    assert not os.path.isfile("%s.tmp" % monitor.metrics_file)
+
+    server = monitor.serve_metrics(0)
+    address = "http://127.0.0.1:%s" % server.server_address[1]
+    with urlopen("%s/metrics" % address) as response:
+        assert response.read().decode() == metrics
+        assert response.headers["Content-Type"].startswith("text/plain")
+    with pytest.raises(HTTPError):
+        urlopen("%s/foo" % address)
+    server.shutdown()
+    server.server_close()
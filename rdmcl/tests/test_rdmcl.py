@@ -12,8 +12,13 @@ from .. import rdmcl
 from .. import helpers
 from math import ceil
 from collections import OrderedDict
+from io import BytesIO
 from buddysuite import buddy_resources as br
 from copy import deepcopy
+import threading
+from multiprocessing import Pipe, Process
+import time
+import logging
 
 pd.set_option('expand_frame_repr', False)
 
@@ -53,12 +58,22 @@ class MockHeartBeat(object):
         self.thread_type = thread_type
         self.dummy = dummy
 
+    @property
+    def location(self):
+        return self.hbdb_path
+
     def start(self):
         return
 
     def end(self):
         return
 
+    def attach(self, job_id):
+        return self.id
+
+    def detach(self, job_id):
+        return
+
 
 def mock_keyboardinterupt(*args, **kwargs):
     raise KeyboardInterrupt(args, kwargs)
@@ -700,6 +715,39 @@ def test_orthogroup_caller(hf):
         assert clust in orthogroup_seqs, print(orthogroup_seqs)
 
 
+def test_run_sibling_tasks(monkeypatch):
+    monkeypatch.setattr(rdmcl, "SIBLING_SLOTS", rdmcl.BoundedSemaphore(0))
+    threads = []
+
+    def task(indx):
+        threads.append(threading.get_ident())
+        rdmcl.time.sleep(0.01 * (5 - indx))  # Earlier tasks finish last
+        return indx
+
+    # No free slots, so everything runs in the calling thread
+    tasks = [rdmcl.partial(task, indx) for indx in range(5)]
+    assert rdmcl.run_sibling_tasks(tasks) == [0, 1, 2, 3, 4]
+    assert len(set(threads)) == 1
+
+    # Results are gathered in task order, however long each task takes
+    threads = []
+    monkeypatch.setattr(rdmcl, "SIBLING_SLOTS", rdmcl.BoundedSemaphore(2))
+    assert rdmcl.run_sibling_tasks(tasks) == [0, 1, 2, 3, 4]
+    assert len(set(threads)) == 3
+    assert rdmcl.SIBLING_SLOTS.acquire(blocking=False) and rdmcl.SIBLING_SLOTS.acquire(blocking=False)
+    rdmcl.SIBLING_SLOTS.release()
+    rdmcl.SIBLING_SLOTS.release()
+
+    # Errors from other threads are raised once every task is done, and slots are returned
+    def bad_task():
+        raise ValueError("Bad task")
+
+    with pytest.raises(ValueError) as err:
+        rdmcl.run_sibling_tasks([bad_task, rdmcl.partial(task, 1)])
+    assert "Bad task" in str(err)
+    assert rdmcl.SIBLING_SLOTS.acquire(blocking=False) and rdmcl.SIBLING_SLOTS.acquire(blocking=False)
+
+
 # #########  Miscellaneous  ########## #
 def test_progress(hf):
     cluster = rdmcl.Cluster(*hf.base_cluster_args())
@@ -712,7 +760,14 @@ def test_progress(hf):
         # {"placed": 0, "mcl_runs": 0, "total": 119}
         assert "".join(sorted(ifile.read())) == '     """""",,00134:::_aaccdelllmnoprsttu{}'
 
+    # Updates stay in shared memory until the next flush
     progress.update("mcl_runs", 2)
+    assert progress.read()["mcl_runs"] == 2
+    with open("{0}{1}.progress".format(tmpdir.path, hf.sep), "r") as ifile:
+        assert '"mcl_runs": 0' in ifile.read()
+
+    progress.flush()
+    assert not [f for f in os.listdir(tmpdir.path) if f != ".progress"]
     with open("{0}{1}.progress".format(tmpdir.path, hf.sep), "r") as ifile:
         # {"placed": 0, "mcl_runs": 2, "total": 119}
         assert "".join(sorted(ifile.read())) == '     """""",,01234:::_aaccdelllmnoprsttu{}'
@@ -724,6 +779,20 @@ def test_progress(hf):
 
     assert str(progress) == "MCL runs processed: 2. Sequences placed: 0/134. Run time: "
 
+    # Forked processes share the same counters
+    procs = [Process(target=progress.update, args=("placed", 1)) for _ in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert progress.read()["placed"] == 4
+
+    # No throttling
+    progress = rdmcl.Progress(tmpdir.path, cluster, flush_secs=0)
+    progress.update("placed", 3)
+    with open("{0}{1}.progress".format(tmpdir.path, hf.sep), "r") as ifile:
+        assert '"placed": 3' in ifile.read()
+
 
 def test_check_sequences(hf, monkeypatch, capsys):
     monkeypatch.setattr(rdmcl, "logging", MockLogging)
@@ -887,6 +956,70 @@ def test_heartbeat_end():
     assert heartbeat.id is None
 
 
+def test_master_heartbeat(monkeypatch):
+    tmpdir = br.TempDir()
+    hbdb_path = tmpdir.subfile("hbdb.sqlite")
+    monkeypatch.setattr(rdmcl, "HEARTBEAT_DB", hbdb_path)
+    monkeypatch.setattr(rdmcl, "MASTER_HEARTBEAT", None)
+    monkeypatch.setattr(rdmcl, "MASTER_PULSE", 60)
+
+    heartbeat = rdmcl.master_heartbeat()
+    assert type(heartbeat) == rdmcl.MasterHeartBeat
+    assert rdmcl.master_heartbeat() is heartbeat
+    assert heartbeat.thread_type == "master"
+    assert heartbeat.pulse_rate == 60
+
+    conn = sqlite3.connect(hbdb_path)
+    cursor = conn.cursor()
+
+    # All outstanding jobs share one heartbeat row and process
+    master_id = heartbeat.attach("job1")
+    running_process = heartbeat.running_process
+    assert heartbeat.attach("job2") == master_id
+    assert heartbeat.running_process is running_process
+    assert heartbeat.jobs == {"job1", "job2"}
+    assert cursor.execute("SELECT thread_id, thread_type FROM heartbeat").fetchall() == [(master_id, "master")]
+
+    # Stopped once the last job is done
+    heartbeat.detach("job1")
+    assert heartbeat.running_process is running_process
+    heartbeat.detach("job2")
+    assert heartbeat.running_process is None
+    assert heartbeat.id is None
+    assert not cursor.execute("SELECT * FROM heartbeat").fetchall()
+
+    # A run-wide heartbeat keeps going after its jobs are done
+    heartbeat.start()
+    master_id = heartbeat.id
+    assert heartbeat.keep_alive
+    assert heartbeat.attach("job1") == master_id
+    heartbeat.detach("job1")
+    assert heartbeat.id == master_id
+    assert heartbeat.running_process.is_alive()
+
+    # Starting again while attached jobs are running doesn't change the master id
+    heartbeat.attach("job1")
+    heartbeat.start()
+    assert heartbeat.id == master_id
+
+    # Forked processes reuse the run-wide heartbeat instead of spinning up their own
+    parent, child = Pipe()
+    proc = Process(target=lambda conn: conn.send((heartbeat.attach("job2"), heartbeat.running_process is None)),
+                   args=(child,))
+    proc.start()
+    assert parent.recv() == (master_id, False)
+    proc.join()
+
+    heartbeat.end()
+    assert not heartbeat.keep_alive
+    assert not heartbeat.jobs
+    assert not cursor.execute("SELECT * FROM heartbeat").fetchall()
+
+    # A new heartbeat database gets a new object
+    monkeypatch.setattr(rdmcl, "HEARTBEAT_DB", tmpdir.subfile("hbdb2.sqlite"))
+    assert rdmcl.master_heartbeat() is not heartbeat
+
+
 # ################ SCORING FUNCTIONS ################ #
 def test_mc_score_sequences1(hf):
     outfile = br.TempFile()
@@ -980,11 +1113,29 @@ MPPIQISAS-I
     assert subs_mat_score == 0.40982529375386517
 
 
+def test_compare_aligned_seqs():
+    # Columns that are only gaps in this pair are skipped, as if the pair had been pulled out of the alignment
+    assert rdmcl.compare_aligned_seqs("MP--QMSASWI", "MPPIQISAS-I", -5, -1) == 0.40982529375386517
+    assert rdmcl.compare_aligned_seqs("MP---QMSA-SWI", "MPP-IQISA-S-I", -5, -1) == 0.40982529375386517
+    assert rdmcl.compare_aligned_seqs("MPPIQISAS-I", "MP--QMSASWI", -5, -1) == 0.40982529375386517
+
+
+def test_compare_psi_pred_arrays():
+    psi1 = pd.DataFrame([[0, 0.9, 0.1, 0.0], [1, 0.5, 0.5, 0.0], [3, 0.2, 0.2, 0.6]], columns=rdmcl.PSIPRED_COLUMNS)
+    psi2 = pd.DataFrame([[0, 0.8, 0.2, 0.0], [1, 0.5, 0.5, 0.0], [2, 0.1, 0.1, 0.8]], columns=rdmcl.PSIPRED_COLUMNS)
+    # Two matching rows scored out of three rows in psi2 plus one extra gap
+    expected = ((1 - 0.1 / 3 * 2) + 1) / 4
+    assert round(rdmcl.compare_psi_pred_arrays(psi1.to_numpy(dtype=float), psi2.to_numpy(dtype=float)), 12) == \
+        round(expected, 12)
+    assert rdmcl.compare_psi_pred(psi1, psi2) == \
+        rdmcl.compare_psi_pred_arrays(psi1.to_numpy(dtype=float), psi2.to_numpy(dtype=float))
+
+
 def test_mc_create_all_by_all_scores(capsys, monkeypatch):
     monkeypatch.setattr(rdmcl, "retrieve_all_by_all_scores", lambda *args, **kwargs: print(args, kwargs))
-    rdmcl.mc_create_all_by_all_scores("seqbuddy", ["arg1", "arg2"])
+    rdmcl.mc_create_all_by_all_scores("seqbuddy", ["arg1", "arg2", 2])
     out, err = capsys.readouterr()
-    assert out == "('seqbuddy', 'arg1', 'arg2') {'quiet': True}\n"
+    assert out == "('seqbuddy', 'arg1', 'arg2') {'quiet': True, 'depth': 2}\n"
 
 
 def test_retrieve_all_by_all_scores_single(hf):
@@ -1019,6 +1170,51 @@ def test_retrieve_all_by_all_scores_from_db(hf, monkeypatch):
     sql_broker.close()
 
 
+def test_retrieve_all_by_all_scores_single_flight(hf, monkeypatch):
+    sql_broker = helpers.SQLiteBroker(os.path.join(hf.resource_path, "db.sqlite"))
+    sql_broker.start_broker()
+    seqbuddy = rdmcl.Sb.pull_recs(hf.get_data("cteno_panxs"), "Bfo-PanxαF|Hca-PanxαD|Mle-Panxα6")
+    seq_id_hash = helpers.md5_hash(", ".join(sorted([rec.id for rec in seqbuddy.records])))
+    stored = sql_broker.query("SELECT graph, alignment FROM data_table WHERE hash=?", (seq_id_hash,))
+    sql_broker.close()
+
+    class MockBroker(object):
+        # Nothing in the database until the first caller has finished building the graph
+        def __init__(self, results):
+            self.results = results
+
+        def query(self, *args):
+            return self.results.pop(0) if self.results else []
+
+    flights = helpers.SingleFlight()
+    monkeypatch.setattr(rdmcl, "ALL_BY_ALL_FLIGHTS", flights)
+    monkeypatch.setattr(rdmcl, "MIN_SIZE_TO_WORKER", 1000)
+    monkeypatch.setattr(rdmcl.AllByAllScores, "create", mock_keyboardinterupt)
+
+    def first_caller(_pipe):
+        with flights.claim(seq_id_hash):
+            _pipe.send("claimed")
+            rdmcl.time.sleep(0.3)
+
+    parent_pipe, child_pipe = Pipe()
+    proc = rdmcl.Process(target=first_caller, args=(child_pipe,))
+    proc.start()
+    assert parent_pipe.recv() == "claimed"
+    sim_scores, alignbuddy = rdmcl.retrieve_all_by_all_scores(seqbuddy, "psi_pred_files", MockBroker([[], stored]))
+    proc.join()
+    assert len(alignbuddy.records()) == 3
+    assert len(sim_scores) == 3
+
+    # If the first caller didn't manage to store anything, do the work instead
+    monkeypatch.setattr(rdmcl.AllByAllScores, "create", lambda *_, **__: ["create_sim_scores", "create_alignment"])
+    proc = rdmcl.Process(target=first_caller, args=(child_pipe,))
+    proc.start()
+    assert parent_pipe.recv() == "claimed"
+    sim_scores, alignbuddy = rdmcl.retrieve_all_by_all_scores(seqbuddy, "psi_pred_files", MockBroker([[], []]))
+    proc.join()
+    assert sim_scores == "create_sim_scores"
+
+
 def test_retrieve_all_by_all_scores_feed_worker(hf, monkeypatch):
     sql_broker = helpers.SQLiteBroker(os.path.join(hf.resource_path, "db.sqlite"))
     sql_broker.start_broker()
@@ -1030,18 +1226,146 @@ def test_retrieve_all_by_all_scores_feed_worker(hf, monkeypatch):
         def __init__(self, *args, **kwargs):
             self.args = args
             self.kwargs = kwargs
+            self.service_secs = 12
 
         @staticmethod
         def run():
             return "worker_sim_scores", "worker_alignment"
 
+    recorded = []
     monkeypatch.setattr(rdmcl, "WorkerJob", MockWorkerJob)
     monkeypatch.setattr(rdmcl, "WORKER_DB", tmpfile.path)
     monkeypatch.setattr(rdmcl, "MIN_SIZE_TO_WORKER", 1)
+    monkeypatch.setattr(rdmcl, "OFFLOAD_POLICY", rdmcl.OffloadPolicy())
+    monkeypatch.setattr(rdmcl.OFFLOAD_POLICY, "record_worker", lambda *args: recorded.append(args[1]))
 
     sim_scores, alignbuddy = rdmcl.retrieve_all_by_all_scores(seqbuddy, "psi_pred_files", sql_broker)
     assert sim_scores == "worker_sim_scores"
     assert alignbuddy == "worker_alignment"
+    assert recorded == [12]  # The worker's service time, not the round trip
+
+
+def _offload_dbs(workers, jobs_ahead):
+    temp_dir = br.TempDir()
+    work_db = temp_dir.subfile("work_db.sqlite")
+    hb_db = temp_dir.subfile("heartbeat_db.sqlite")
+    with helpers.ExclusiveConnect(work_db) as cursor:
+        cursor.execute("CREATE TABLE queue (hash TEXT PRIMARY KEY, psi_pred_dir TEXT, align_m TEXT, align_p TEXT, "
+                       "trimal TEXT, gap_open FLOAT, gap_extend FLOAT)")
+        cursor.execute("CREATE TABLE processing (hash TEXT PRIMARY KEY, worker_id INTEGER)")
+        for indx in range(jobs_ahead):
+            cursor.execute("INSERT INTO queue (hash) VALUES (?)", (str(indx),))
+    with helpers.ExclusiveConnect(hb_db) as cursor:
+        cursor.execute("CREATE TABLE heartbeat (thread_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                       "thread_type TEXT, pulse INTEGER)")
+        for _ in range(workers):
+            cursor.execute("INSERT INTO heartbeat (thread_type, pulse) VALUES ('worker', ?)", (round(time.time()),))
+    return temp_dir, work_db, hb_db
+
+
+def test_offload_policy(hf, monkeypatch):
+    seqbuddy = hf.get_data("cteno_panxs")
+    policy = rdmcl.OffloadPolicy()
+    monkeypatch.setattr(rdmcl, "WORKER_DB", "")
+    assert not policy.offload(seqbuddy)
+
+    tmpfile = br.TempFile()
+    monkeypatch.setattr(rdmcl, "WORKER_DB", tmpfile.path)
+    monkeypatch.setattr(rdmcl, "MIN_SIZE_TO_WORKER", len(seqbuddy))
+    assert not policy.offload(seqbuddy)
+    monkeypatch.setattr(rdmcl, "MIN_SIZE_TO_WORKER", len(seqbuddy) - 1)
+    assert policy.offload(seqbuddy)
+    assert policy.record_local(seqbuddy, 10, 4) is None
+    assert policy.record_worker(seqbuddy, 10) is None
+
+
+def test_cost_model_offload_policy(hf, monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    seqbuddy = hf.get_data("cteno_panxs")
+    monkeypatch.setattr(rdmcl, "CPU_BUDGET", helpers.CpuBudget(2))
+    monkeypatch.setattr(rdmcl, "CPUS", 2)
+
+    score_cost, msa_cost = rdmcl.CostModelOffloadPolicy.job_cost(seqbuddy)
+    num_seqs = len(seqbuddy)
+    ave_len = sum([len(rec.seq) for rec in seqbuddy.records]) / num_seqs
+    assert score_cost == (num_seqs * (num_seqs - 1) / 2) * ave_len
+    assert round(msa_cost, 6) == round(num_seqs * ave_len * rdmcl.log2(num_seqs + 1), 6)
+
+    # No workers set up
+    policy = rdmcl.CostModelOffloadPolicy(score_rate=1000, msa_rate=1e9, worker_job_secs=60, worker_overhead=10,
+                                          worker_cpus=16)
+    monkeypatch.setattr(rdmcl, "WORKER_DB", "")
+    assert not policy.offload(seqbuddy)
+
+    # Idle workers take the job when it is expensive to run here
+    temp_dir, work_db, hb_db = _offload_dbs(workers=2, jobs_ahead=0)
+    monkeypatch.setattr(rdmcl, "WORKER_DB", work_db)
+    monkeypatch.setattr(rdmcl, "HEARTBEAT_DB", hb_db)
+    assert policy.offload(seqbuddy)
+    assert "Offload policy: %s sequences -> worker" % num_seqs in caplog.text
+    assert "2 workers, 0 jobs ahead" in caplog.text
+
+    # Cheap jobs stay local
+    policy = rdmcl.CostModelOffloadPolicy(score_rate=1e9, msa_rate=1e9, worker_job_secs=60, worker_overhead=10,
+                                          worker_cpus=16)
+    assert not policy.offload(seqbuddy)
+    assert "Offload policy: %s sequences -> local" % num_seqs in caplog.text
+
+    # A long queue keeps the job local
+    temp_dir, work_db, hb_db = _offload_dbs(workers=1, jobs_ahead=100)
+    monkeypatch.setattr(rdmcl, "WORKER_DB", work_db)
+    monkeypatch.setattr(rdmcl, "HEARTBEAT_DB", hb_db)
+    policy = rdmcl.CostModelOffloadPolicy(score_rate=1000, msa_rate=1e9, worker_job_secs=60, worker_overhead=10,
+                                          worker_cpus=16)
+    assert not policy.offload(seqbuddy)
+    assert "1 workers, 100 jobs ahead" in caplog.text
+
+    # No live workers
+    temp_dir, work_db, hb_db = _offload_dbs(workers=0, jobs_ahead=0)
+    monkeypatch.setattr(rdmcl, "WORKER_DB", work_db)
+    monkeypatch.setattr(rdmcl, "HEARTBEAT_DB", hb_db)
+    policy = rdmcl.CostModelOffloadPolicy(score_rate=1000, msa_rate=1e9, worker_job_secs=60, worker_overhead=10,
+                                          worker_cpus=16)
+    assert not policy.offload(seqbuddy)
+    assert "workers ~n/a" in caplog.text
+
+    # Small jobs stay local without reading the databases, like the old fixed rule
+    monkeypatch.setattr(rdmcl, "MIN_SIZE_TO_WORKER", len(seqbuddy))
+    monkeypatch.setattr(policy, "read_queue_status", lambda: 1 / 0)
+    assert not policy.offload(seqbuddy)
+    monkeypatch.setattr(rdmcl, "MIN_SIZE_TO_WORKER", 15)
+
+    # The worker queue is only read every status_ttl seconds, and only changes of decision are logged
+    reads = []
+    policy = rdmcl.CostModelOffloadPolicy(score_rate=1000, msa_rate=1e9, worker_job_secs=60, worker_overhead=10,
+                                          worker_cpus=16, status_ttl=60)
+    monkeypatch.setattr(policy, "read_queue_status", lambda: reads.append(1) or (2, 0))
+    caplog.clear()
+    for _ in range(5):
+        assert policy.offload(seqbuddy)
+    assert len(reads) == 1
+    assert caplog.text.count("Offload policy") == 1
+    policy.status_ttl = 0
+    monkeypatch.setattr(policy, "read_queue_status", lambda: reads.append(1) or (0, 0))
+    time.sleep(0.01)
+    assert not policy.offload(seqbuddy)
+    assert len(reads) == 2
+    assert caplog.text.count("Offload policy") == 2
+
+    # Learning from completed jobs
+    policy = rdmcl.CostModelOffloadPolicy(score_rate=1000, worker_job_secs=60, smoothing=0.5)
+    policy.record_local(seqbuddy, score_cost / 3000, 1)
+    assert round(policy.score_rate.value, 6) == 2000
+    policy.record_worker(seqbuddy, 20)
+    assert policy.worker_job_secs.value == 40
+    policy.record_worker(seqbuddy, 0)  # Service time wasn't reported
+    assert policy.worker_job_secs.value == 40
+
+    # Rates are shared with forked processes
+    proc = Process(target=policy.record_worker, args=(seqbuddy, 60))
+    proc.start()
+    proc.join()
+    assert policy.worker_job_secs.value == 50
 
 
 def test_retrieve_all_by_all_scores_new_run(hf, monkeypatch):
@@ -1223,7 +1547,8 @@ def test_set_final_sim_scores(hf):
 
 
 def test_workerjob_init(hf, monkeypatch):
-    monkeypatch.setattr(rdmcl, "HeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MasterHeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MASTER_HEARTBEAT", None)
     seqbuddy = hf.get_data("cteno_panxs")
     seq_ids = hf.get_data("cteno_ids")
     seq_ids_hash = hf.string2hash(", ".join(seq_ids))
@@ -1241,6 +1566,9 @@ def test_workerjob_init(hf, monkeypatch):
     assert worker.sql_broker == sql_broker
     assert worker.heartbeat.hbdb_path == rdmcl.HEARTBEAT_DB
     assert worker.heartbeat.pulse_rate == rdmcl.MASTER_PULSE
+    assert worker.cost == 8911  # 134 sequences
+    assert worker.priority == helpers.job_priority(8911, 0, rdmcl.TIMER.start)
+    assert rdmcl.WorkerJob(seqbuddy, sql_broker, depth=3).priority > worker.priority
 
 
 def test_workerjob_run(hf, monkeypatch, capsys):
@@ -1256,7 +1584,10 @@ def test_workerjob_run(hf, monkeypatch, capsys):
     seqbuddy = hf.get_data("cteno_panxs")
 
     rdmcl.HEARTBEAT_DB = hb_db
-    monkeypatch.setattr(rdmcl, "HeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MasterHeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MASTER_HEARTBEAT", None)
+    monkeypatch.setattr(rdmcl, "WORKER_OUT", temp_dir.path)
+    monkeypatch.setattr(rdmcl, "WORKER_POLL_FALLBACK", 0)
     monkeypatch.setattr(rdmcl.WorkerJob, "queue_job", lambda *_: print("queue_job()"))
 
     worker = rdmcl.WorkerJob(seqbuddy, "sql_broker")
@@ -1294,9 +1625,39 @@ def test_workerjob_run(hf, monkeypatch, capsys):
     monkeypatch.setattr(rdmcl, "random", lambda *_: 0.01)
     assert not worker.run()
 
+    # A completion marker from a worker wakes the loop up without waiting out the fallback
+    monkeypatch.setattr(rdmcl, "WORKER_POLL_FALLBACK", 60)
+    marker = os.path.join(temp_dir.path, "%s.done" % worker.job_id)
+    checks = []
+
+    def mock_check_finished(*_):
+        checks.append(time.time())
+        if len(checks) == 1:
+            threading.Timer(0.3, lambda: open(marker, "w").close()).start()
+            return False
+        return True
+
+    monkeypatch.setattr(rdmcl.WorkerJob, "pull_from_db", lambda *_: False)
+    monkeypatch.setattr(rdmcl.WorkerJob, "check_finished", mock_check_finished)
+    start_time = time.time()
+    assert worker.run() == "process_finished"
+    assert len(checks) == 2
+    assert time.time() - start_time < 10
+
+    # A marker that never shows up (e.g., hidden by an NFS attribute cache) only delays things by WORKER_POLL_FALLBACK
+    monkeypatch.setattr(rdmcl, "WORKER_POLL_FALLBACK", 0.3)
+    monkeypatch.setattr(helpers, "file_state", lambda *_: None)
+    monkeypatch.setattr(rdmcl.WorkerJob, "check_finished", lambda *_: checks.append(time.time()) or len(checks) == 3)
+    del checks[:]
+    start_time = time.time()
+    assert worker.run() == "process_finished"
+    assert len(checks) == 3
+    assert 0.5 < time.time() - start_time < 10
+
 
 def test_workerjob_queue_job(hf, monkeypatch):
-    monkeypatch.setattr(rdmcl, "HeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MasterHeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MASTER_HEARTBEAT", None)
     temp_dir = br.TempDir()
     work_db = temp_dir.copy_to(os.path.join(hf.resource_path, "work_db.sqlite"))
     rdmcl.WORKER_DB = work_db
@@ -1311,12 +1672,14 @@ def test_workerjob_queue_job(hf, monkeypatch):
     assert not worker.queue_job()
     assert os.path.isfile(os.path.join(temp_dir.path, "%s.seqs" % worker.job_id))
     queue = work_cursor.execute("SELECT * FROM queue").fetchall()
-    assert queue == [('a2aaca4f79bd56fbf8debfdc281660fd', '', 'clustalo', '',
-                      'gappyout 0.5 0.75 0.9 0.95 clean', -5.0, 0.0)], print(queue)
+    assert queue[0][:9] == ('a2aaca4f79bd56fbf8debfdc281660fd', '', 'clustalo', '',
+                            'gappyout 0.5 0.75 0.9 0.95 clean', -5.0, 0.0, 8911.0, worker.priority), print(queue)
+    assert time.time() - 10 < queue[0][9] <= time.time()
 
 
 def test_workerjob_pull_from_db(hf, monkeypatch):
-    monkeypatch.setattr(rdmcl, "HeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MasterHeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MASTER_HEARTBEAT", None)
     temp_dir = br.TempDir()
     broker_db = temp_dir.copy_to(os.path.join(hf.resource_path, "db.sqlite"))
     sql_broker = helpers.SQLiteBroker(broker_db)
@@ -1371,7 +1734,8 @@ MTGLILIL
 
 
 def test_workerjob_check_finished(hf, monkeypatch):
-    monkeypatch.setattr(rdmcl, "HeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MasterHeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MASTER_HEARTBEAT", None)
     temp_dir = br.TempDir()
     work_db = temp_dir.copy_to("%swork_db.sqlite" % hf.resource_path)
     rdmcl.WORKER_DB = work_db
@@ -1397,17 +1761,19 @@ def test_workerjob_check_finished(hf, monkeypatch):
     assert work_cursor.execute("SELECT  COUNT(*) FROM waiting").fetchone()[0] == 2
 
     # Other jobs waiting
-    work_cursor.execute("INSERT INTO complete (hash) "
-                        "VALUES (?)", ('a2aaca4f79bd56fbf8debfdc281660fd',))
+    work_cursor.execute("INSERT INTO complete (hash, secs) "
+                        "VALUES (?, ?)", ('a2aaca4f79bd56fbf8debfdc281660fd', 42,))
     work_con.commit()
     assert worker.check_finished()
+    assert worker.service_secs == 42
     assert work_cursor.execute("SELECT  COUNT(*) FROM waiting").fetchone()[0] == 1
     assert work_cursor.execute("SELECT  COUNT(*) FROM complete").fetchone()[0] == 0
     assert work_cursor.execute("SELECT  COUNT(*) FROM proc_comp").fetchone()[0] == 1
 
 
 def test_workerjob_process_finished(hf, monkeypatch):
-    monkeypatch.setattr(rdmcl, "HeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MasterHeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MASTER_HEARTBEAT", None)
     monkeypatch.setattr(rdmcl, "cluster2database", lambda *_: True)
     temp_dir = br.TempDir()
     work_db = temp_dir.copy_to("%swork_db.sqlite" % hf.resource_path)
@@ -1431,7 +1797,7 @@ def test_workerjob_process_finished(hf, monkeypatch):
     aln_path = os.path.join(temp_dir.path, "%s.aln" % worker.job_id)
     alignment.write(aln_path)
     graph_path = temp_dir.subfile("%s.graph" % worker.job_id)
-    sim_scores.to_csv(graph_path, header=None, index=False)
+    helpers.write_graph(sim_scores, graph_path)
 
     assert os.path.isfile(seqs_path)
     assert os.path.isfile(aln_path)
@@ -1445,9 +1811,18 @@ def test_workerjob_process_finished(hf, monkeypatch):
     assert not os.path.isfile(aln_path)
     assert not os.path.isfile(graph_path)
 
+    # Completion marker is also removed, if the worker left one
+    open(os.path.join(temp_dir.path, "%s.done" % worker.job_id), "w").close()
+    seqbuddy.write(seqs_path)
+    alignment.write(aln_path)
+    helpers.write_graph(sim_scores, graph_path)
+    worker.process_finished()
+    assert not os.path.isfile(os.path.join(temp_dir.path, "%s.done" % worker.job_id))
+
 
 def test_workerjob_check_if_active(hf, monkeypatch, capsys):
-    monkeypatch.setattr(rdmcl, "HeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MasterHeartBeat", MockHeartBeat)
+    monkeypatch.setattr(rdmcl, "MASTER_HEARTBEAT", None)
     temp_dir = br.TempDir()
 
     seqbuddy = hf.get_data("cteno_panxs")
@@ -1524,13 +1899,77 @@ def test_workerjob_check_if_active(hf, monkeypatch, capsys):
     assert not work_cursor.execute("SELECT * FROM proc_comp WHERE hash='a2aaca4f79bd56fbf8debfdc281660fd'").fetchone()
 
 
+def test_server_workerjob_run(hf, monkeypatch, capsys):
+    temp_dir = br.TempDir()
+    server = rdmcl.job_server.JobServer("unix://%s" % temp_dir.subfile("jobs.sock"))
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    while not os.path.exists(server.listen_address):
+        time.sleep(0.01)
+    client = rdmcl.job_server.JobClient(server.address)
+
+    monkeypatch.setattr(rdmcl, "JOB_SERVER", server.address)
+    monkeypatch.setattr(rdmcl, "MASTER_HEARTBEAT", None)
+    monkeypatch.setattr(rdmcl, "PSIPREDDIR", os.path.join(hf.resource_path, "psi_pred"))
+    monkeypatch.setattr(rdmcl, "WORKER_POLL_FALLBACK", 0.2)
+    monkeypatch.setattr(rdmcl, "cluster2database", lambda *_: True)
+    assert rdmcl.workers_configured()
+
+    seqbuddy = hf.get_data("cteno_panxs")
+    alignment = hf.get_data("cteno_panxs_aln")
+    sim_scores = hf.get_data("cteno_sim_scores")
+    worker = rdmcl.ServerWorkerJob(seqbuddy, "sql_broker")
+    assert type(worker.heartbeat) == rdmcl.job_server.ServerHeartBeat
+
+    # No workers available
+    assert not worker.run()
+    assert not client.status()["queue"]
+
+    # The job goes out with its sequences and psipred data, and comes back with the alignment and graph
+    worker_id = client.register("worker")
+
+    def fake_worker():
+        job = client.claim(worker_id, timeout=30)
+        assert len(job["params"]["psipred"]) == len(seqbuddy)
+        assert job["params"]["trimal"] == "gappyout 0.5 0.75 0.9 0.95 clean"
+        assert job["seqs"].count(">") == len(seqbuddy)
+        graph = BytesIO()
+        helpers.write_graph(sim_scores, graph)
+        client.complete(job["job_id"], worker_id, str(alignment), graph.getvalue())
+
+    worker_thread = threading.Thread(target=fake_worker)
+    worker_thread.start()
+    ret_sim_scores, ret_alignment = worker.run()
+    worker_thread.join()
+    assert str(ret_sim_scores) == str(sim_scores)
+    assert str(ret_alignment) == str(alignment)
+    assert 0 <= worker.service_secs < 30
+
+    # The job vanishes from the server, but another master already put the result in the database
+    monkeypatch.setattr(rdmcl.ServerWorkerJob, "read_from_db", lambda *_: "db_result")
+    monkeypatch.setattr(rdmcl.job_server.JobClient, "result", lambda *_, **__: {"status": "missing"})
+    assert worker.run() == "db_result"
+
+    # All of the workers go away while waiting
+    monkeypatch.setattr(rdmcl.job_server.JobClient, "result", lambda *_, **__: {"status": "pending", "workers": 0})
+    assert not worker.run()
+    assert not client.status()["waiting"]
+
+    # Job server goes down, so the job is run locally
+    server.shutdown()
+    server_thread.join()
+    caplog_out = []
+    monkeypatch.setattr(rdmcl.logging, "warning", lambda msg: caplog_out.append(msg))
+    assert not worker.run()
+    assert "running job locally" in caplog_out[0]
+
+
 # #########  MCL stuff  ########## #
 def test_mcmcmc_mcl(hf):
     # Need to monkeypatch Cluster, mc_create_all_by_all_scores, Progress.update, helpers.MarkovClustering,
     # and retrieve_all_by_all_scores()
 
     ext_tmp_dir = br.TempDir()
-    ext_tmp_dir.subfile("max.txt")
     cluster_ids = ['BOL-PanxαA', 'Bab-PanxαB', 'Bfo-PanxαB', 'Dgl-PanxαE', 'Hca-PanxαB',
                    'Hru-PanxαA', 'Lcr-PanxαH', 'Mle-Panxα10A', 'Tin-PanxαC',
                    'Vpa-PanxαB', 'Oma-PanxαC', 'Edu-PanxαA', 'Bch-PanxαC']
@@ -1548,39 +1987,67 @@ def test_mcmcmc_mcl(hf):
     progress = rdmcl.Progress(os.path.join(ext_tmp_dir.path, "progress"), cluster)
 
     args = (6.372011782427792, 0.901221218627, 1)  # inflation, gq, r_seed
-    params = [ext_tmp_dir.path, seqbuddy, cluster, taxa_sep, sql_broker, hf.get_data("ss2_paths"), progress, 3]
+    params = [helpers.SeqIndex(seqbuddy), cluster, taxa_sep, sql_broker, hf.get_data("ss2_paths"), progress]
 
     assert rdmcl.mcmcmc_mcl(args, params) == 19.538461538461537
-    with open(os.path.join(ext_tmp_dir.path, "max.txt"), "r") as ifile:
-        output = ifile.read()
-        assert output == "6b39ebc4f5fe7dfef786d8ee3e1594ed,cb23cf3b4d355140e525a1158af5102d," \
-                         "8521872b6c07205f3198bb70699f3d93,a06adee8cc3631773890bb5842bf8df9," \
-                         "09cac4f034df8a2805171e1e61cc8666", print(output)
 
     args = (3.1232, 0.73432, 1)  # inflation, gq, r_seed
     assert rdmcl.mcmcmc_mcl(args, params) == 20.923076923076923
-    with open(os.path.join(ext_tmp_dir.path, "max.txt"), "r") as ifile:
-        output = ifile.read()
-        assert output == "6b39ebc4f5fe7dfef786d8ee3e1594ed,cb23cf3b4d355140e525a1158af5102d," \
-                         "8521872b6c07205f3198bb70699f3d93,a06adee8cc3631773890bb5842bf8df9," \
-                         "09cac4f034df8a2805171e1e61cc8666\n" \
-                         "fdffc226205a71dfbdd6cc093cab56cf,cb23cf3b4d355140e525a1158af5102d," \
-                         "a06adee8cc3631773890bb5842bf8df9,09cac4f034df8a2805171e1e61cc8666", print(output)
 
     args = (10.1232, 0.43432, 1)  # inflation, gq, r_seed
     assert rdmcl.mcmcmc_mcl(args, params) == 24.153846153846153
-    with open(os.path.join(ext_tmp_dir.path, "max.txt"), "r") as ifile:
-        output = ifile.read()
-        assert output == "", print(output)
 
-    with open(os.path.join(ext_tmp_dir.path, "best_group"), "r") as ifile:
-        output = ifile.read()
-        assert output == "BOL-PanxαA	Bab-PanxαB	Bch-PanxαC	Bfo-PanxαB	Dgl-PanxαE	Hca-PanxαB	Hru-PanxαA	" \
-                         "Lcr-PanxαH	Mle-Panxα10A	Oma-PanxαC	Tin-PanxαC	Vpa-PanxαB\n" \
-                         "Edu-PanxαA", print(output)
+    # Walkers report back to MCMCMC through their scores and partition keys, so nothing is written to disk
+    assert os.listdir(ext_tmp_dir.path) == ["progress"]
+    partition = "BOL-PanxαA	Bab-PanxαB	Bch-PanxαC	Bfo-PanxαB	Dgl-PanxαE	Hca-PanxαB	Hru-PanxαA	Lcr-PanxαH	" \
+                "Mle-Panxα10A	Oma-PanxαC	Tin-PanxαC	Vpa-PanxαB\nEdu-PanxαA"
+    assert rdmcl.mcmcmc_mcl_key(args, params) == helpers.md5_hash(partition)
     sql_broker.close()
 
 
+def test_mcl_partition(hf, monkeypatch):
+    cluster = rdmcl.Cluster(*hf.base_cluster_args())
+    tmp_dir = br.TempDir()
+    progress = rdmcl.Progress(tmp_dir.path, cluster)
+    monkeypatch.setattr(rdmcl, "MCL_STASH", rdmcl.local())
+
+    clusters = rdmcl.mcl_partition(cluster, 6.372011782427792, 0.901221218627, progress)
+    assert progress.read()["mcl_runs"] == 1
+    assert sorted([seq_id for clust in clusters for seq_id in clust]) == sorted(cluster.seq_ids)
+
+    # Same values are pulled from the stash instead of running MCL again
+    assert rdmcl.mcl_partition(cluster, 6.372011782427792, 0.901221218627, progress) is clusters
+    assert progress.read()["mcl_runs"] == 1
+
+    # Only the most recent result is held
+    rdmcl.mcl_partition(cluster, 3.1232, 0.73432, progress)
+    assert progress.read()["mcl_runs"] == 2
+    assert rdmcl.MCL_STASH.result[0] == (cluster.seq_id_hash, 3.1232, 0.73432)
+
+    # Threads (sibling recursion) don't see or replace each other's results
+    thread_results = []
+    thread = rdmcl.Thread(target=lambda: thread_results.append(rdmcl.mcl_partition(cluster, 3.1232, 0.73432,
+                                                                                   progress)))
+    thread.start()
+    thread.join()
+    assert progress.read()["mcl_runs"] == 3
+    assert thread_results[0] == rdmcl.MCL_STASH.result[1]
+    assert rdmcl.MCL_STASH.result[0] == (cluster.seq_id_hash, 3.1232, 0.73432)
+
+
+def test_mcmcmc_mcl_key(hf, monkeypatch):
+    cluster = rdmcl.Cluster(*hf.base_cluster_args())
+    monkeypatch.setattr(rdmcl, "MCL_STASH", rdmcl.local())
+    monkeypatch.setattr(rdmcl, "mcl_partition", lambda *_: [["b", "a"], ["c"], ["e", "d"]])
+    params = [None, cluster, "-", None, None, None]
+    key = rdmcl.mcmcmc_mcl_key((6.3, 0.9, 1), params)
+    assert key == helpers.md5_hash("a\tb\nd\te\nc")  # Fixed size, however big the cluster
+
+    # Cluster order in the partition doesn't matter
+    monkeypatch.setattr(rdmcl, "mcl_partition", lambda *_: [["c"], ["d", "e"], ["a", "b"]])
+    assert rdmcl.mcmcmc_mcl_key((6.3, 0.9, 1), params) == key
+
+
 def test_parse_mcl_clusters(hf):
     clusters = rdmcl.parse_mcl_clusters("%sCteno_pannexins_mcl_clusters.clus" % hf.resource_path)
     assert clusters[6] == ["BOL-PanxαH", "Dgl-PanxαH", "Edu-PanxαC", "Hca-PanxαF", "Mle-Panxα8", "Pba-PanxαC"]
@@ -1994,6 +2461,10 @@ parser.add_argument("-ch", "--chains", default=rdmcl.MCMC_CHAINS, type=int,
                     help="Specify how many MCMCMC chains to run (default=3)")
 parser.add_argument("-wlk", "--walkers", default=3, type=int,
                     help="Specify how many Metropolis-Hastings walkers are in each chain (default=2)")
+parser.add_argument("-stb", "--stable_steps", type=int, default=0,
+                    help="Also end MCMCMC once the best partition has been stable for this many steps")
+parser.add_argument("-sib", "--sibling_threads", type=int, default=0,
+                    help="Recurse into this many sibling sub clusters at the same time")
 parser.add_argument("-lwt", "--lock_wait_time", type=int, default=1200, metavar="",
                     help="Specify num seconds a process should wait on the SQLite database before crashing"
                          " out (default=1200)")
@@ -2024,6 +2495,8 @@ def test_argparse_init(monkeypatch, hf):
     assert temp_in_args.mcmc_steps == 0
     assert temp_in_args.open_penalty == -5
     assert temp_in_args.ext_penalty == 0
+    assert temp_in_args.stable_steps == 0
+    assert temp_in_args.sibling_threads == 0
 
 
 @pytest.mark.slow
@@ -2048,6 +2521,7 @@ def test_full_run(hf, capsys):
     for expected_file in ["final_clusters.txt", "placement.log", "paralog_cliques", "rdmcl.log"]:
         expected_file = os.path.join(out_dir.path, expected_file)
         assert os.path.isfile(expected_file), print(expected_file)
+    assert not os.path.exists(os.path.join(out_dir.path, ".locks"))  # Lock files don't outlive the run
 
     with open(os.path.join(out_dir.path, "final_clusters.txt"), "r") as ifile:
         content = ifile.read()
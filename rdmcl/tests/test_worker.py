@@ -8,12 +8,15 @@ from .. import launch_worker
 import os
 import sqlite3
 import pandas as pd
-from io import StringIO
+from io import StringIO, BytesIO
+from collections import OrderedDict
 from buddysuite import buddy_resources as br
 from buddysuite import AlignBuddy as Alb
 from buddysuite import SeqBuddy as Sb
 import time
 import argparse
+import threading
+from functools import partial
 
 pd.set_option('expand_frame_repr', False)
 
@@ -238,7 +241,7 @@ def test_start_worker_deal_with_subjobs(hf, capsys, monkeypatch):
         worker.terminate("unit test kill")
         return args, kwargs
 
-    monkeypatch.setattr(br, "run_multicore_function", kill_worker)
+    monkeypatch.setattr(launch_worker._ScoringPool, "score", kill_worker)
 
     seqbuddy = hf.get_data("cteno_panxs")
     seqbuddy.write(os.path.join(worker.output, "foo.seqs"))
@@ -303,6 +306,85 @@ def test_worker_idle_workers(hf):
     work_con.close()
 
 
+def test_worker_record_throughput(hf):
+    temp_dir = br.TempDir()
+    temp_dir.copy_to("%swork_db.sqlite" % hf.resource_path)
+    temp_dir.copy_to("%sheartbeat_db.sqlite" % hf.resource_path)
+    worker = launch_worker.Worker(temp_dir.path, cpus=3)
+    worker.heartbeat.id = 1
+
+    work_con = sqlite3.connect(os.path.join(temp_dir.path, "work_db.sqlite"))
+    work_cursor = work_con.cursor()
+
+    def flush():
+        with helpers.ExclusiveConnect(worker.wrkdb_path) as cursor:
+            worker.flush_throughput(cursor)
+
+    worker.record_throughput(1, 100, 10)  # Fewer pairs than CPUs isn't recorded
+    worker.record_throughput(10, 100, 0)
+    flush()
+    assert not work_cursor.execute("SELECT * FROM throughput").fetchall()
+
+    # Nothing is written until the job is finished
+    worker.record_throughput(100, 100, 10)
+    assert worker.throughput == 1000
+    assert not work_cursor.execute("SELECT * FROM throughput").fetchall()
+    flush()
+    worker_id, rate, updated = work_cursor.execute("SELECT * FROM throughput").fetchone()
+    assert worker_id == 1
+    assert rate == 1000
+    assert updated > time.time() - 10
+    assert not worker.throughput_pending
+
+    # Later measurements are smoothed into the running estimate
+    worker.record_throughput(100, 100, 5)
+    flush()
+    assert work_cursor.execute("SELECT rate FROM throughput").fetchall() == [(1300,)]
+
+    # The rate goes out with the transaction that marks a subjob complete
+    worker.record_throughput(100, 100, 2)
+    work_cursor.execute("INSERT INTO waiting (hash, master_id) VALUES ('foo', 3)")
+    work_cursor.execute("INSERT INTO processing (hash, worker_id) VALUES ('2_3_foo', 1)")
+    work_con.commit()
+    os.makedirs(os.path.join(worker.output, "foo"))
+    worker.process_subjob("foo", pd.DataFrame(columns=["seq1", "seq2", "subsmat", "psi"]), 2, 3)
+    assert work_cursor.execute("SELECT rate FROM throughput").fetchall() == [(2410,)]
+    work_con.close()
+
+
+def test_worker_plan_subjobs(hf, monkeypatch):
+    temp_dir = br.TempDir()
+    temp_dir.copy_to("%swork_db.sqlite" % hf.resource_path)
+    temp_dir.copy_to("%sheartbeat_db.sqlite" % hf.resource_path)
+    worker = launch_worker.Worker(temp_dir.path, cpus=3, job_size_coff=2, chunk_time=10)  # Static max job size of 4
+    monkeypatch.setattr(launch_worker.Worker, "idle_workers", lambda *_: 0)
+
+    # No throughput recorded yet, so fall back on job_size_coff
+    assert worker.plan_subjobs(4, 100) == 1
+    assert worker.plan_subjobs(10, 100) == 3
+
+    # Median throughput of 2000 (the stale row is ignored) at 10 sec per chunk gives 200 pairs per chunk at width 100
+    work_con = sqlite3.connect(os.path.join(temp_dir.path, "work_db.sqlite"))
+    work_cursor = work_con.cursor()
+    work_cursor.execute("INSERT INTO throughput (worker_id, rate, updated) VALUES (1, 1000, ?)", (time.time(),))
+    work_cursor.execute("INSERT INTO throughput (worker_id, rate, updated) VALUES (2, 2000, ?)", (time.time(),))
+    work_cursor.execute("INSERT INTO throughput (worker_id, rate, updated) VALUES (3, 3000, ?)", (time.time(),))
+    work_cursor.execute("INSERT INTO throughput (worker_id, rate, updated) VALUES (4, 9000, 0)")
+    work_con.commit()
+
+    assert worker.plan_subjobs(200, 100) == 1
+    assert worker.plan_subjobs(1000, 100) == 5
+    assert worker.plan_subjobs(1000, 400) == 20  # Wider alignments get smaller chunks
+    assert worker.plan_subjobs(100, 100000) == 50  # But never fewer pairs than CPUs per chunk
+
+    # Jobs being split anyway are spread across the idle workers
+    monkeypatch.setattr(launch_worker.Worker, "idle_workers", lambda *_: 9)
+    assert worker.plan_subjobs(200, 100) == 1
+    assert worker.plan_subjobs(1000, 100) == 10
+    assert worker.plan_subjobs(10, 100000) == 5
+    work_con.close()
+
+
 def test_worker_check_master(hf, capsys):
     temp_dir = br.TempDir()
     temp_dir.copy_to("%swork_db.sqlite" % hf.resource_path)
@@ -403,7 +485,7 @@ def test_worker_clean_dead_threads(hf):
     work_con.close()
 
 
-def test_worker_fetch_queue_job(hf):
+def test_worker_fetch_queue_job(hf, monkeypatch):
     temp_dir = br.TempDir()
     temp_dir.copy_to("%swork_db.sqlite" % hf.resource_path)
     worker = launch_worker.Worker(temp_dir.path)
@@ -422,6 +504,60 @@ def test_worker_fetch_queue_job(hf):
     queued_job = worker.fetch_queue_job()
     assert queued_job == ['bar', './', '', '', ['gappyout', 50.0, 90.0, 'clean'], 0, 0]
     assert not work_cursor.execute("SELECT * FROM queue").fetchall()
+    assert work_cursor.execute("SELECT hash, worker_id FROM processing WHERE hash='bar'").fetchone() == ("bar", None)
+    claimed = work_cursor.execute("SELECT claimed FROM processing WHERE hash='bar'").fetchone()[0]
+    assert time.time() - 10 < claimed <= time.time()
+    assert worker.claim_stats["attempts"] == 1
+    assert worker.claim_stats["claimed"] == 1
+
+    # Empty queue
+    assert worker.fetch_queue_job() is None
+    assert worker.claim_stats["attempts"] == 2
+    assert worker.claim_stats["claimed"] == 1
+    assert "Claimed 1 jobs in 2 attempts; mean claim latency" in worker.claim_report()
+
+    # Giving up on the write lock still counts the time spent waiting for it
+    real_connect = helpers.ImmediateConnect
+    monkeypatch.setattr(helpers, "ImmediateConnect", partial(real_connect, timeout=0.1))
+    work_cursor.execute("INSERT INTO queue (hash) VALUES ('locked')")  # Holds the write lock until rolled back
+    assert worker.fetch_queue_job() is None
+    assert worker.claim_stats["attempts"] == 3
+    assert worker.claim_stats["lock_wait"] >= 0.1
+    assert worker.claim_stats["max_lock_wait"] >= 0.1
+    work_con.rollback()
+    monkeypatch.setattr(helpers, "ImmediateConnect", real_connect)
+
+    # Jobs are claimed oldest first among equals, with or without 'RETURNING' support
+    for returning in [True, False]:
+        monkeypatch.setattr(launch_worker, "SQLITE_RETURNING", returning)
+        for job in ["zzz", "aaa"]:
+            work_cursor.execute("INSERT INTO queue (hash, psi_pred_dir, align_m, align_p, trimal, gap_open, "
+                                "gap_extend) VALUES (?, './', '', '', '', 0, 0)", ("%s%s" % (job, returning),))
+        work_con.commit()
+        assert worker.fetch_queue_job()[0] == "zzz%s" % returning
+        assert worker.fetch_queue_job()[0] == "aaa%s" % returning
+        assert worker.fetch_queue_job() is None
+
+        # Bigger jobs go first, but jobs that have been waiting long enough catch up
+        now = time.time()
+        for job, priority, queued in [("small", 2, now), ("big", 10, now), ("old", 2, now - 7 * helpers.QUEUE_AGING),
+                                      ("older", 2, now - 20 * helpers.QUEUE_AGING)]:
+            work_cursor.execute("INSERT INTO queue (hash, priority, queued) VALUES (?, ?, ?)",
+                                ("%s%s" % (job, returning), priority, queued))
+        work_con.commit()
+        assert [worker.fetch_queue_job()[0] for _ in range(4)] == ["%s%s" % (job, returning) for job in
+                                                                   ["older", "big", "old", "small"]]
+        assert worker.job_priority == (2, now)
+
+    # Somebody else is sitting on the write lock
+    monkeypatch.setattr(launch_worker.helpers, "ImmediateConnect",
+                        partial(launch_worker.helpers.ImmediateConnect, timeout=0.1))
+    work_cursor.execute("INSERT INTO queue (hash) VALUES ('baz')")
+    work_con.commit()
+    work_cursor.execute("BEGIN IMMEDIATE")
+    assert worker.fetch_queue_job() is None
+    work_con.rollback()
+    assert worker.fetch_queue_job()[0] == "baz"
     work_con.close()
 
 
@@ -448,6 +584,152 @@ Name: 0, dtype: object"""
     assert "Foo.ss2" in str(err)
 
 
+def test_job_cache():
+    cache = launch_worker._JobCache(max_size=2)
+    assert cache.get("foo", (1, 1)) is None
+    cache.put("foo", (1, 1), "foo_data")
+    cache.put("bar", (1, 1), "bar_data")
+    assert cache.get("foo", (1, 1)) == "foo_data"
+    assert cache.get("foo", (2, 1)) is None  # Source file has changed
+    assert cache.get("foo", None) is None  # Unversioned lookups aren't counted
+
+    cache.put("baz", (1, 1), "baz_data")  # 'bar' is least recently used, so it goes
+    assert len(cache) == 2
+    assert cache.get("bar", (1, 1)) is None
+    assert cache.get("baz", (1, 1)) == "baz_data"
+    assert cache.report() == "Cache hits 2/5 (40.0%), 2 entries"
+
+    cache = launch_worker._JobCache(max_size=0)
+    cache.put("foo", (1, 1), "foo_data")
+    assert not len(cache)
+
+
+def test_worker_cached_job_inputs(hf, monkeypatch):
+    temp_dir = br.TempDir()
+    temp_dir.copy_to("%swork_db.sqlite" % hf.resource_path)
+    worker = launch_worker.Worker(temp_dir.path)
+    seqbuddy = Sb.pull_recs(hf.get_data("cteno_panxs"), "Oma")
+    seqbuddy.write(os.path.join(worker.output, "foo.seqs"))
+    alignment = hf.get_data("cteno_panxs_aln")
+    alignment.write(os.path.join(worker.output, "foo.aln"))
+
+    # Sibling subjobs read the sequences and alignment once
+    assert worker.load_seqs("foo") is worker.load_seqs("foo")
+    assert str(worker.load_seqs("foo")) == str(seqbuddy)
+    cached_aln = worker.load_alignment("foo")
+    assert worker.load_alignment("foo") is cached_aln
+
+    # A new alignment file means a new job, so nothing cached from the old one is used
+    time.sleep(0.01)
+    alignment.write(os.path.join(worker.output, "foo.aln"))
+    assert worker.load_alignment("foo") is not cached_aln
+
+    ss2_reads = []
+
+    def read_ss2_file(path):
+        ss2_reads.append(path)
+        return pd.DataFrame()
+
+    monkeypatch.setattr(launch_worker.rdmcl, "read_ss2_file", read_ss2_file)
+    psipred_dir = os.path.join(hf.resource_path, "psi_pred")
+    worker.prepare_psipred_dfs(seqbuddy, psipred_dir, "foo")
+    worker.prepare_psipred_dfs(seqbuddy, psipred_dir, "foo")
+    assert len(ss2_reads) == 4
+
+    # Full jobs aren't cached, because update_psipred() modifies the dataframes
+    worker.prepare_psipred_dfs(seqbuddy, psipred_dir)
+    worker.prepare_psipred_dfs(seqbuddy, psipred_dir)
+    assert len(ss2_reads) == 12
+
+    # Splitting a job primes the cache for its subjobs
+    worker.cache_job("bar", "bar_alignment", OrderedDict([(rec.id, "bar_df") for rec in seqbuddy.records]))
+    assert len(worker.cache) == 6  # No bar.aln to tie the entries to, so nothing is added
+    alignment.write(os.path.join(worker.output, "bar.aln"))
+    worker.cache_job("bar", "bar_alignment", OrderedDict([(rec.id, "bar_df") for rec in seqbuddy.records]))
+    assert worker.load_alignment("bar") == "bar_alignment"
+    assert list(worker.prepare_psipred_dfs(seqbuddy, psipred_dir, "bar").values()) == ["bar_df"] * 4
+    assert len(ss2_reads) == 12
+    assert worker.cache.report() == "Cache hits 12/19 (63.2%), 11 entries"
+
+
+def test_scoring_pool():
+    results_file = br.TempFile()
+    reference_file = br.TempFile()
+    alb_obj = Alb.AlignBuddy("""\
+>seq1
+MP-QMSASWI
+>seq2
+MPPQISAS-I
+>seq3
+MP-QISGAWI
+>seq4
+MPPQISGAWI
+""")
+
+    def make_psipred_dfs(seed):
+        psipred_dfs = OrderedDict()
+        for num, rec in enumerate(alb_obj.records()):
+            rows = [[indx, (seed + num + indx) % 10 / 10, (seed * num + indx) % 7 / 10, 0.1]
+                    for indx, residue in enumerate(str(rec.seq)) if residue != "-"]
+            psipred_dfs[rec.id] = pd.DataFrame(rows, columns=rdmcl.PSIPRED_COLUMNS)
+        return psipred_dfs
+
+    def reference(pairs, psipred_dfs, gap_open):
+        reference_file.clear()
+        rdmcl.mc_score_sequences([(id1, id2, psipred_dfs[id1], psipred_dfs[id2]) for id1, id2 in pairs],
+                                 [alb_obj, gap_open, 0, reference_file.path])
+        return sorted(reference_file.read().strip().split("\n"))
+
+    pool = launch_worker._ScoringPool(2, chunk_size=2)
+    pool.start()
+    assert len(pool) == 2
+    pids = [p.pid for p in pool.processes]
+
+    # Only the ids go out with each chunk, and the scores match the single process version
+    pairs = [("seq1", "seq2"), ("seq1", "seq3"), ("seq1", "seq4"), ("seq2", "seq3"), ("seq2", "seq4"), ("seq3", "seq4")]
+    data = [[(id1, id2, None, None) for id1, id2 in pairs[:3]], [(id1, id2, None, None) for id1, id2 in pairs[3:]]]
+    psipred_dfs = make_psipred_dfs(1)
+    pool.score(data, psipred_dfs, alb_obj, -5, 0, results_file.path)
+    assert sorted(results_file.read().strip().split("\n")) == reference(pairs, psipred_dfs, -5)
+
+    # The job sits in shared memory, and is only published once for subjobs over the same objects
+    blocks = [block.name for block in pool.blocks]
+    assert len(blocks) == 2
+    results_file.clear()
+    pool.score([[("seq3", "seq4", None, None)]], {"seq3": psipred_dfs["seq3"], "seq4": psipred_dfs["seq4"]},
+               alb_obj, -5, 0, results_file.path)
+    assert results_file.read().strip().split("\n") == reference([("seq3", "seq4")], psipred_dfs, -5)
+    assert [block.name for block in pool.blocks] == blocks
+
+    # The same processes pick up the next job, and the last one's shared memory is freed
+    results_file.clear()
+    psipred_dfs = make_psipred_dfs(2)
+    pool.score([[("seq1", "seq2", None, None)]], psipred_dfs, alb_obj, -3, 0, results_file.path)
+    assert results_file.read().strip().split("\n") == reference([("seq1", "seq2")], psipred_dfs, -3)
+    assert [p.pid for p in pool.processes] == pids
+    assert not set(block.name for block in pool.blocks) & set(blocks)
+    with pytest.raises(FileNotFoundError):
+        launch_worker.shared_memory.SharedMemory(name=blocks[0])
+
+    # Nothing to do
+    pool.score([], {}, alb_obj, -3, 0, results_file.path)
+
+    # Failures are passed back, and the pool is restarted on the next job
+    with pytest.raises(RuntimeError) as err:
+        pool.score(data, {"seq1": psipred_dfs["seq1"]}, alb_obj, -5, 0, results_file.path)
+    assert "KeyError" in str(err)
+    assert not len(pool)
+    assert not pool.blocks
+
+    results_file.clear()
+    pool.score([[("seq1", "seq2", None, None)]], psipred_dfs, alb_obj, -3, 0, results_file.path)
+    assert results_file.read().strip().split("\n") == reference([("seq1", "seq2")], psipred_dfs, -3)
+    assert len(pool) == 2
+    pool.shutdown()
+    assert not len(pool)
+    assert not pool.blocks
+
+
 def test_worker_process_final_results(hf, monkeypatch, capsys):
     temp_dir = br.TempDir()
     temp_dir.copy_to("%swork_db.sqlite" % hf.resource_path)
@@ -466,7 +748,7 @@ def test_worker_process_final_results(hf, monkeypatch, capsys):
     worker.heartbeat.id = 2
 
     work_cursor.execute("INSERT INTO waiting (hash, master_id) VALUES ('foo', 3)")
-    work_cursor.execute("INSERT INTO processing (hash, worker_id) VALUES ('foo', 2)")
+    work_cursor.execute("INSERT INTO processing (hash, worker_id, claimed) VALUES ('foo', 2, ?)", (time.time() - 100,))
     work_cursor.execute("INSERT INTO processing (hash, worker_id) VALUES ('1_3_foo', 2)")
     work_cursor.execute("INSERT INTO complete (hash) VALUES ('2_3_foo')")
     work_con.commit()
@@ -484,6 +766,7 @@ def test_worker_process_final_results(hf, monkeypatch, capsys):
     assert os.path.isfile(aln_file)
     assert os.path.isfile(seqs_file)
     assert not os.path.isfile(graph_file)
+    assert not os.path.isfile(os.path.join(worker.output, "foo.done"))
     assert os.path.isdir(subjob_dir)
 
     # Confirm that the sim_scores will be collected from process_subjob if num_subjobs > 1
@@ -521,12 +804,13 @@ Oma-PanxαC,Oma-PanxαD,0.47123287364498306,0.6647632735397735
     assert worker.process_final_results("foo", 1, 1) is None
     assert work_cursor.execute("SELECT * FROM waiting WHERE hash='foo'").fetchone()
     assert not work_cursor.execute("SELECT * FROM processing WHERE hash='foo'").fetchone()
-    assert work_cursor.execute("SELECT * FROM complete WHERE hash='foo'").fetchone()
+    assert 100 <= work_cursor.execute("SELECT secs FROM complete WHERE hash='foo'").fetchone()[0] < 110
     assert not work_cursor.execute("SELECT * FROM complete WHERE hash LIKE '%%_foo'").fetchone()
     assert os.path.isfile(aln_file)
     assert os.path.isfile(seqs_file)
     assert os.path.isfile(graph_file)
     assert not os.path.isdir(subjob_dir)
+    assert os.path.isfile(os.path.join(worker.output, "foo.done"))
 
     # Process a result with no masters waiting around
     work_cursor.execute("DELETE FROM waiting WHERE hash='foo'")
@@ -541,6 +825,7 @@ Oma-PanxαC,Oma-PanxαD,0.47123287364498306,0.6647632735397735
     assert not os.path.isfile(aln_file)
     assert not os.path.isfile(seqs_file)
     assert not os.path.isfile(graph_file)
+    assert not os.path.isfile(os.path.join(worker.output, "foo.done"))
     work_con.close()
 
 
@@ -567,6 +852,7 @@ def test_worker_spawn_subjobs(hf):
 
     data = [pairs[i:i + 5] for i in range(0, len(pairs), 5)]  # This gives two groups of five
 
+    worker.job_priority = (12.5, 1000.)
     data_len, data, subjob_num, num_subjobs = worker.spawn_subjobs("foo", data, ss2_dfs, 3, -5)
 
     assert data_len == len(data[0]) == 2
@@ -592,18 +878,29 @@ Bch-PanxαD Bch-PanxαE
 
     queue = work_cursor.execute("SELECT * FROM queue").fetchall()
     assert len(queue) == 2
-    hash_id, psi_pred_dir, align_m, align_p, trimal, gap_open, gap_extend = queue[0]
+    hash_id, psi_pred_dir, align_m, align_p, trimal, gap_open, gap_extend, cost, priority, queued = queue[0]
     assert hash_id == "2_3_foo"
     assert psi_pred_dir == subjob_dir
     assert align_m is align_p is trimal is None
     assert gap_open, gap_extend == (-5, 0)
+    assert (cost, priority, queued) == (4, 12.5, 1000.)  # Subjobs are queued at the same priority as their parent
 
     processing = work_cursor.execute("SELECT * FROM processing").fetchall()
     assert len(processing) == 1
 
-    hash_id, worker_id = processing[0]
+    hash_id, worker_id, claimed = processing[0]
     assert hash_id == "1_3_foo"
     assert worker_id == worker.heartbeat.id
+    assert time.time() - 10 < claimed <= time.time()
+
+    # Ask for a specific number of subjobs. Ten pairs can't go evenly into six, so only five are made.
+    data = [pairs[i:i + 5] for i in range(0, len(pairs), 5)]
+    data_len, data, subjob_num, num_subjobs = worker.spawn_subjobs("bar", data, ss2_dfs, 3, -5, 6)
+    assert num_subjobs == 5
+    assert data_len == 1
+    assert os.path.isfile(os.path.join(worker.output, "bar", "5_of_5.txt"))
+    assert not os.path.isfile(os.path.join(worker.output, "bar", "6_of_6.txt"))
+    assert len(work_cursor.execute("SELECT * FROM queue WHERE hash LIKE '%bar'").fetchall()) == 4
     work_con.close()
 
 
@@ -654,8 +951,7 @@ Oma-PanxαA,Oma-PanxαC,0.5135617078978646,0.7301561315022769
     assert work_cursor.execute("SELECT * FROM complete").fetchone()[0] == "2_3_foo"
     assert not work_cursor.execute("SELECT * FROM processing").fetchall()
 
-    with open(os.path.join(subjob_dir, "2_of_3.sim_df"), "r") as ifile:
-        assert ifile.read() == sim_scores
+    assert helpers.read_graph(os.path.join(subjob_dir, "2_of_3.graph")).equals(pd.read_csv(StringIO(sim_scores)))
 
     # Now test the final processing after all subjobs complete
     work_cursor.execute("INSERT INTO "
@@ -665,12 +961,11 @@ Oma-PanxαA,Oma-PanxαC,0.5135617078978646,0.7301561315022769
     work_cursor.execute("INSERT INTO waiting (hash, master_id) VALUES ('3_3_foo', 3)")
     work_con.commit()
 
-    with open(os.path.join(subjob_dir, "1_of_3.sim_df"), "w") as ofile:
-        ofile.write("""\
+    helpers.write_graph(pd.read_csv(StringIO("""\
 seq1,seq2,subsmat,psi
 Oma-PanxαA,Oma-PanxαD,0.587799312776859,0.7428144752048478
 Oma-PanxαB,Oma-PanxαC,0.2302289845944233,0.5027489193831555
-""")
+""")), os.path.join(subjob_dir, "1_of_3.graph"))
 
     sim_scores = """\
 seq1,seq2,subsmat,psi
@@ -684,10 +979,10 @@ Oma-PanxαC,Oma-PanxαD,0.4712328736449831,0.6647632735397735
          seq1        seq2         subsmat             psi
 0  Oma-PanxαA  Oma-PanxαD  0.587799312777  0.742814475205
 1  Oma-PanxαB  Oma-PanxαC  0.230228984594  0.502748919383
-0  Oma-PanxαA  Oma-PanxαB  0.244091847349  0.482156668931
-1  Oma-PanxαA  Oma-PanxαC  0.513561707898  0.730156131502
-0  Oma-PanxαB  Oma-PanxαD  0.238296271178  0.448141037435
-1  Oma-PanxαC  Oma-PanxαD  0.471232873645  0.664763273540""", print(sim_scores_df)
+2  Oma-PanxαA  Oma-PanxαB  0.244091847349  0.482156668931
+3  Oma-PanxαA  Oma-PanxαC  0.513561707898  0.730156131502
+4  Oma-PanxαB  Oma-PanxαD  0.238296271178  0.448141037435
+5  Oma-PanxαC  Oma-PanxαD  0.471232873645  0.664763273540""", print(sim_scores_df)
     work_con.close()
 
 
@@ -719,6 +1014,80 @@ def test_worker_terminate(hf, monkeypatch, capsys):
     work_con.close()
 
 
+def test_server_worker(hf, monkeypatch, capsys):
+    temp_dir = br.TempDir()
+    server = launch_worker.job_server.JobServer("unix://%s" % os.path.join(temp_dir.path, "jobs.sock"))
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    while not os.path.exists(server.listen_address):
+        time.sleep(0.01)
+    client = launch_worker.job_server.JobClient(server.address)
+
+    worker = launch_worker.ServerWorker(server.address, temp_dir.subdir("local"), claim_wait=0.1)
+    assert not worker.split_jobs
+    assert worker.working_dir == os.path.join(temp_dir.path, "local")
+    assert type(worker.heartbeat) == launch_worker.job_server.ServerHeartBeat
+    assert worker.idle_workers() == 0
+    assert worker.clean_dead_threads() is None
+    worker.heartbeat.start()
+    worker.data_file = os.path.join(worker.working_dir, ".Worker_%s.dat" % worker.heartbeat.id)
+
+    # Empty queue
+    assert worker.fetch_queue_job() is None
+
+    # Job inputs are written out locally
+    seqbuddy = Sb.SeqBuddy(hf.get_data("cteno_panxs").records[:3])
+    seqbuddy.out_format = "fasta"
+    psipred = {}
+    for rec in seqbuddy.records:
+        with open(os.path.join(hf.resource_path, "psi_pred", "%s.ss2" % rec.id), "r") as ifile:
+            psipred[rec.id] = ifile.read()
+    master_id = client.register("master")
+    client.submit("foo", master_id, str(seqbuddy), {"psipred": psipred, "align_m": "clustalo", "align_p": "",
+                                                    "trimal": "gappyout 0.5 clean", "gap_open": -5, "gap_extend": 0})
+    data = worker.fetch_queue_job()
+    assert data == ["foo", os.path.join(worker.output, "foo_psipred"), "clustalo", "",
+                    ["gappyout", 0.5, "clean"], -5, 0]
+    assert worker.claim_stats["claimed"] == 1
+    assert str(Sb.SeqBuddy(os.path.join(worker.output, "foo.seqs"))) == str(seqbuddy)
+    assert sorted(os.listdir(data[1])) == sorted(["%s.ss2" % rec.id for rec in seqbuddy.records])
+    with open(os.path.join(data[1], "%s.ss2" % seqbuddy.records[0].id), "r") as ifile:
+        assert ifile.read() == psipred[seqbuddy.records[0].id]
+
+    # Results go back to the server and local files are cleaned up
+    with open(worker.data_file, "w") as ofile:
+        ofile.write("seq1,seq2,subsmat,psi\nA,B,0.5,0.5\nA,C,0.2,0.4\n")
+    with open(os.path.join(worker.output, "foo.aln"), "w") as ofile:
+        ofile.write(">A\nMK\n>B\nMR\n")
+    assert worker.process_final_results("foo", 1, 1) is None
+    result = client.result("foo", master_id)
+    assert result["status"] == "complete"
+    assert result["alignment"] == ">A\nMK\n>B\nMR\n"
+    graph = helpers.read_graph(BytesIO(result["graph"]))
+    assert graph.drop(columns="raw_score").values.tolist() == [["A", "B", 1., 1., 1.], ["A", "C", 0., 0., 0.]]
+    assert not os.listdir(worker.output)
+
+    # Jobs are handed back when the worker bails
+    client.submit("bar", master_id, "", {"psipred": {}, "align_m": "", "align_p": "", "trimal": "",
+                                         "gap_open": -5, "gap_extend": 0})
+    assert worker.fetch_queue_job()[0] == "bar"
+    worker.release_jobs()
+    assert client.status()["queue"] == 1
+
+    # No masters around
+    client.end(master_id)
+    worker.last_heartbeat_from_master = 0
+    worker.worker_file = temp_dir.subfile(os.path.join("local", "Worker_%s" % worker.heartbeat.id))
+    with pytest.raises(SystemExit):
+        worker.check_masters(20)
+    out, err = capsys.readouterr()
+    assert "of master inactivity (spent 20% time idle)" in out
+    assert not os.path.isfile(worker.worker_file)
+
+    server.shutdown()
+    server_thread.join()
+
+
 # #########  User Interface  ########## #
 parser = argparse.ArgumentParser(prog="launch_worker", description="",
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -766,12 +1135,20 @@ def test_main(monkeypatch, capsys):
                         (3, 'align_p', 'TEXT', 0, None, 0),
                         (4, 'trimal', 'TEXT', 0, None, 0),
                         (5, 'gap_open', 'FLOAT', 0, None, 0),
-                        (6, 'gap_extend', 'FLOAT', 0, None, 0)],
+                        (6, 'gap_extend', 'FLOAT', 0, None, 0),
+                        (7, 'cost', 'FLOAT', 0, '0', 0),
+                        (8, 'priority', 'FLOAT', 0, '0', 0),
+                        (9, 'queued', 'FLOAT', 0, '0', 0)],
               'processing': [(0, 'hash', 'TEXT', 0, None, 1),
-                             (1, 'worker_id', 'INTEGER', 0, None, 0)],
-              'complete': [(0, 'hash', 'TEXT', 0, None, 1)],
+                             (1, 'worker_id', 'INTEGER', 0, None, 0),
+                             (2, 'claimed', 'FLOAT', 0, '0', 0)],
+              'complete': [(0, 'hash', 'TEXT', 0, None, 1),
+                           (1, 'secs', 'FLOAT', 0, '0', 0)],
               'waiting': [(0, 'hash', 'TEXT', 0, None, 0),
-                          (1, 'master_id', 'INTEGER', 0, None, 0)]}
+                          (1, 'master_id', 'INTEGER', 0, None, 0)],
+              'throughput': [(0, 'worker_id', 'INTEGER', 0, None, 1),
+                             (1, 'rate', 'FLOAT', 0, None, 0),
+                             (2, 'updated', 'FLOAT', 0, None, 0)]}
 
     workdb_tables = workdb_cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
     for table in tables:
@@ -54,6 +54,7 @@ ENTRY_POINTS = {
     'console_scripts': [
         'rdmcl = rdmcl.rdmcl:main',
         'launch_worker = rdmcl.launch_worker:main',
+        'job_server = rdmcl.job_server:main',
         'reset_workers = rdmcl.reset_workers:main',
         'monitor_dbs = rdmcl.monitor_dbs:main',
         'group_by_cluster = rdmcl.group_by_cluster:main',